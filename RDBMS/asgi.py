@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'RDBMS.settings')
+# async views: database calls are awaited, not run on a thread per request
+os.environ.setdefault('MINIRDBMS_ASYNC_VIEWS', '1')
 
 application = get_asgi_application()
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/6.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -70,6 +71,11 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'RDBMS.wsgi.application'
 
+# Serve the async views (myapp/async_views.py, myapp/async_api.py), which
+# wait on the database without holding a thread. RDBMS/asgi.py turns
+# them on; under WSGI the sync views are used.
+ASYNC_VIEWS = os.environ.get('MINIRDBMS_ASYNC_VIEWS') == '1'
+
 
 # Database
 # https://docs.djangoproject.com/en/6.0/ref/settings/#databases
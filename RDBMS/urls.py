@@ -14,11 +14,16 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path, include
 
+# the async views under ASGI (settings.ASYNC_VIEWS), else the sync ones
+views = "myapp.async_urls" if settings.ASYNC_VIEWS else "myapp.urls"
+api = "myapp.async_api_urls" if settings.ASYNC_VIEWS else "myapp.api_urls"
+
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path("", include("myapp.urls")),
-    path("api/", include("myapp.api_urls")),
+    path("", include(views)),
+    path("api/", include(api)),
 ]
@@ -0,0 +1,178 @@
+"""asyncio interface to the database, for async views and scripts.
+
+    from main.aio import connect
+    database = connect()
+    rows = await database.execute("SELECT * FROM users WHERE id = ?", [1])
+    page = await database.call("page", table="users", after=50, limit=51)
+
+It wraps main.client.connect() (the database server, or this process's
+own copy) and has the same methods, as coroutines. Each call runs on a
+thread, so the event loop never waits on a socket, on db.reload()
+reading another process's log, or on a commit's log flush and
+checkpoint:
+
+* Reads (SELECT, EXPLAIN without ANALYZE, and the read-only calls) run
+  on a pool of READ_THREADS threads, side by side: reads of the engine
+  never wait for each other or for writers (MVCC).
+* Writes go through an asyncio queue and run one at a time, in order,
+  on a thread of their own. The engine serializes writers anyway;
+  queueing them keeps a burst of writes from taking every thread from
+  the reads. At most WRITE_QUEUE writes wait: beyond that, callers wait
+  to get in the queue instead of piling up in memory.
+
+So thousands of requests can be in flight in one event loop while only
+READ_THREADS + 1 threads touch the database.
+
+Every call is one statement or one batch, and consecutive calls may run
+on different threads, so a transaction has to be a single batch:
+
+    await database.batch(["BEGIN", ("INSERT INTO users VALUES (?, ?)", [7, "Ann"]), "COMMIT"])
+
+which is all or nothing. BEGIN, COMMIT or ROLLBACK on their own are
+refused.
+"""
+import asyncio
+import functools
+import re
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from main import client
+
+# Threads that run reads
+READ_THREADS = 8
+
+# Writes that may wait in the queue of one event loop
+WRITE_QUEUE = 1000
+
+# Server calls that only read
+READ_CALLS = {"page", "join_page", "find", "all", "metrics"}
+
+_READ_SQL = re.compile(r"\s*(SELECT|EXPLAIN(?!\s+ANALYZE))\b", re.IGNORECASE)
+_TRANSACTION_SQL = re.compile(r"\s*(BEGIN|START|COMMIT|END|ROLLBACK)\b", re.IGNORECASE)
+
+
+def _is_read(statement):
+    # "SQL", ("SQL", params) or a request dict, as client batches take
+    if isinstance(statement, dict):
+        if "call" in statement:
+            return statement["call"] in READ_CALLS
+        return "many" not in statement and bool(_READ_SQL.match(statement["sql"]))
+    query = statement if isinstance(statement, str) else statement[0]
+    return bool(_READ_SQL.match(query))
+
+
+def _check_statement(query):
+    if _TRANSACTION_SQL.match(query):
+        raise Exception(
+            "BEGIN, COMMIT and ROLLBACK need one connection: send the "
+            "transaction as one batch"
+        )
+
+
+class _WriteQueue:
+    """The writes waiting in one event loop, and the task running them."""
+
+    def __init__(self, size):
+        self.queue = asyncio.Queue(size)
+        self.task = None
+
+    async def put(self, job, future, run):
+        await self.queue.put((job, future))
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.drain(run))
+
+    async def drain(self, run):
+        # runs the queued writes one after another; ends once the queue
+        # is empty, and the next put starts a new one
+        while not self.queue.empty():
+            job, future = self.queue.get_nowait()
+            if future.cancelled():
+                # its caller gave up before its turn
+                continue
+            try:
+                result = await run(job)
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+
+
+class AsyncDatabase:
+    """Coroutine versions of a connection's execute, execute_many, call,
+    batch and pipeline (see the module docstring)."""
+
+    def __init__(self, database=None, read_threads=READ_THREADS, write_queue=WRITE_QUEUE):
+        self.database = database or client.connect()
+        self.readers = ThreadPoolExecutor(read_threads, thread_name_prefix="db-read")
+        self.writer = ThreadPoolExecutor(1, thread_name_prefix="db-write")
+        self.write_queue = write_queue
+        # event loop -> _WriteQueue; a loop that is gone takes its queue along
+        self._queues = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    async def execute(self, query, params=()):
+        _check_statement(query)
+        run = self._read if _READ_SQL.match(query) else self._write
+        return await run(self.database.execute, query, params)
+
+    async def execute_many(self, query, params_seq):
+        return await self._write(self.database.execute_many, query, list(params_seq))
+
+    async def call(self, name, **args):
+        run = self._read if name in READ_CALLS else self._write
+        return await run(functools.partial(self.database.call, name, **args))
+
+    async def batch(self, statements):
+        statements = list(statements)
+        run = self._read if all(_is_read(s) for s in statements) else self._write
+        return await run(self.database.batch, statements)
+
+    async def pipeline(self, statements):
+        statements = list(statements)
+        for statement in statements:
+            if isinstance(statement, (str, tuple, list)):
+                _check_statement(statement if isinstance(statement, str) else statement[0])
+        run = self._read if all(_is_read(s) for s in statements) else self._write
+        return await run(self.database.pipeline, statements)
+
+    def close(self):
+        self.readers.shutdown()
+        self.writer.shutdown()
+
+    # ---------- threads ----------
+    async def _read(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.readers, functools.partial(fn, *args))
+
+    async def _write(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        await self._queue(loop).put(functools.partial(fn, *args), future, self._run_write)
+        return await future
+
+    async def _run_write(self, job):
+        return await asyncio.get_running_loop().run_in_executor(self.writer, job)
+
+    def _queue(self, loop):
+        with self._lock:
+            queue = self._queues.get(loop)
+            if queue is None:
+                queue = self._queues[loop] = _WriteQueue(self.write_queue)
+            return queue
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def connect():
+    """The process-wide AsyncDatabase, over main.client.connect()."""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = AsyncDatabase()
+        return _default
@@ -0,0 +1,377 @@
+"""Benchmarks of the engine, the SQL layer and the web views.
+
+    python -m main.bench [--sizes 10000,100000,1000000] [--out FILE]
+                         [--baseline FILE] [--save-baseline] [--tolerance 0.25]
+
+For each size a fresh database (in a temporary directory, the default
+schema: users, orders and their join views) is filled with size orders
+and size / 10 users from a fixed random seed, then every benchmark runs
+against it. Results are written as JSON (--out, bench_results.json by
+default): per size and benchmark, the seconds per operation and how
+many operations were timed.
+
+With a baseline file (bench_baseline.json by default, written by
+--save-baseline), each result is compared with the baseline's and the
+run fails (exit status 1) when one is slower by more than --tolerance
+(a fraction: 0.25 is 25%). Operations that take under MIN_SECONDS are
+too noisy to compare and are only reported.
+
+The Django views are timed through the test client when Django is
+installed; the SQL layer and the views are pointed at the benchmark
+database for the run, so db.json is not touched.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+from main import client, server, sql, vector
+from main.core import BASE_DIR, Database, inner_join, left_join
+from main.protocol import SERVER_ENV
+
+SIZES = (10000, 100000, 1000000)
+RESULTS_FILE = "bench_results.json"
+BASELINE_FILE = os.path.join(BASE_DIR, "bench_baseline.json")
+
+# Slowdown (as a fraction) that counts as a regression
+TOLERANCE = 0.25
+
+# Operations timed per micro benchmark (finds, single inserts, ...);
+# the same at every size, so per-operation times are comparable
+OPS = 1000
+
+# Read-only benchmarks run this many times; the fastest run counts
+REPEAT = 3
+
+# Per-operation times below this are not compared against the baseline
+MIN_SECONDS = 0.00001
+
+SEED = 42
+
+
+# -------------------------------
+# Data
+# -------------------------------
+def populate(database, size, rng):
+    """Fill database with size orders of size // 10 users."""
+    users = max(size // 10, 1)
+    database.table("users").insert_many(
+        {"id": i, "name": f"user{i}"} for i in range(users)
+    )
+    database.table("orders").insert_many(
+        {"id": i, "user_id": rng.randrange(users), "amount": rng.randrange(10000)}
+        for i in range(size)
+    )
+    return users
+
+
+@contextmanager
+def serving(database):
+    """Point the SQL layer, the server calls and the in-process client
+    (so the Django views) at database for the duration."""
+    connection = client.connect()
+    saved = sql.db, server.db, connection.db
+    sql.db = server.db = connection.db = database
+    try:
+        yield
+    finally:
+        sql.db, server.db, connection.db = saved
+
+
+# -------------------------------
+# Timing
+# -------------------------------
+class Bench:
+    """Collects {name: {"seconds", "ops"}} for one size."""
+
+    def __init__(self, verbose=True):
+        self.results = {}
+        self.verbose = verbose
+
+    def run(self, name, fn, ops=1, repeat=1):
+        # seconds per operation of fn(), which performs ops operations;
+        # the fastest of repeat runs
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        self.results[name] = {"seconds": best / ops, "ops": ops}
+        if self.verbose:
+            print(f"  {name:<24} {_format(best / ops):>10} /op  ({ops} ops)")
+
+
+def _format(seconds):
+    if seconds >= 1:
+        return f"{seconds:.2f} s"
+    if seconds >= 0.001:
+        return f"{seconds * 1000:.2f} ms"
+    return f"{seconds * 1000000:.1f} us"
+
+
+# -------------------------------
+# Benchmarks
+# -------------------------------
+def bench_engine(bench, database, path, size, users, rng):
+    orders = database.table("orders")
+    users_table = database.table("users")
+
+    bench.run("engine.save", database.save)
+    bench.run("engine.load", lambda: Database(path, sync=False).close())
+
+    ids = [rng.randrange(size) for _ in range(OPS)]
+    user_ids = [rng.randrange(users) for _ in range(OPS)]
+    bench.run("engine.find", lambda: [orders.find("id", i) for i in ids], OPS, REPEAT)
+    bench.run(
+        "engine.find_all", lambda: [orders.find_all("user_id", u) for u in user_ids],
+        OPS, REPEAT
+    )
+
+    new_ids = range(size, size + OPS)
+
+    def insert():
+        for i in new_ids:
+            orders.insert({"id": i, "user_id": rng.randrange(users), "amount": i % 10000})
+    bench.run("engine.insert", insert, OPS)
+    bench.run(
+        "engine.update",
+        lambda: [orders.update("id", i, {"amount": i % 97}) for i in new_ids], OPS
+    )
+    bench.run("engine.delete", lambda: [orders.delete("id", i) for i in new_ids], OPS)
+
+    bench.run(
+        "engine.inner_join",
+        lambda: sum(1 for _ in inner_join(users_table, orders, "id", "user_id")),
+        size, REPEAT
+    )
+    bench.run(
+        "engine.left_join",
+        lambda: sum(1 for _ in left_join(users_table, orders, "id", "user_id")),
+        size, REPEAT
+    )
+
+
+def bench_sql(bench, size, users, rng):
+    execute = sql.execute
+    ids = [rng.randrange(size) for _ in range(OPS)]
+    bench.run(
+        "sql.select_pk",
+        lambda: [execute("SELECT * FROM orders WHERE id = ?", (i,)) for i in ids],
+        OPS, REPEAT
+    )
+    bench.run(
+        "sql.select_range",
+        lambda: [
+            execute("SELECT * FROM orders WHERE id BETWEEN ? AND ?", (i, i + 99))
+            for i in ids[:100]
+        ],
+        100, REPEAT
+    )
+    bench.run(
+        "sql.select_filter",
+        lambda: execute("SELECT * FROM orders WHERE amount > 9900 ORDER BY id LIMIT 100"),
+        1, REPEAT
+    )
+    bench.run(
+        "sql.count_where",
+        lambda: execute("SELECT COUNT(*) FROM orders WHERE amount < 5000"),
+        1, REPEAT
+    )
+    bench.run(
+        "sql.group_by",
+        lambda: execute("SELECT user_id, SUM(amount), COUNT(*) FROM orders GROUP BY user_id"),
+        1, REPEAT
+    )
+    bench.run(
+        "sql.join",
+        lambda: execute("SELECT * FROM users JOIN orders ON users.id = orders.user_id"),
+        1, REPEAT
+    )
+
+    new_ids = range(size, size + OPS)
+    bench.run(
+        "sql.insert",
+        lambda: [
+            execute("INSERT INTO orders (id, user_id, amount) VALUES (?, ?, ?)",
+                    (i, rng.randrange(users), i % 10000))
+            for i in new_ids
+        ],
+        OPS
+    )
+    bench.run(
+        "sql.update",
+        lambda: [execute("UPDATE orders SET amount = ? WHERE id = ?", (i % 97, i)) for i in new_ids],
+        OPS
+    )
+    bench.run(
+        "sql.delete",
+        lambda: [execute("DELETE FROM orders WHERE id = ?", (i,)) for i in new_ids],
+        OPS
+    )
+
+    def transaction():
+        for i in new_ids[:100]:
+            execute("BEGIN")
+            execute("INSERT INTO orders VALUES (?, ?, ?)", (i, 0, 1))
+            execute("DELETE FROM orders WHERE id = ?", (i,))
+            execute("COMMIT")
+    bench.run("sql.transaction", transaction, 100)
+
+    rows = [(i, rng.randrange(users), i % 10000) for i in new_ids]
+    bench.run(
+        "sql.execute_many",
+        lambda: sql.execute_many("INSERT INTO orders VALUES (?, ?, ?)", rows), OPS
+    )
+    sql.execute_many("DELETE FROM orders WHERE id = ?", [(i,) for i in new_ids])
+
+
+def bench_django(bench, size, users):
+    try:
+        import django
+    except ImportError:
+        print("  (Django is not installed: views skipped)")
+        return
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "RDBMS.settings")
+    django.setup()
+    from django.test import Client
+    from django.test.utils import setup_test_environment
+    if "testserver" not in _allowed_hosts():
+        setup_test_environment()
+
+    web = Client()
+
+    def get(url, times=20):
+        def run():
+            for _ in range(times):
+                response = web.get(url)
+                if response.status_code != 200:
+                    raise Exception(f"GET {url}: {response.status_code}")
+                if response.streaming:
+                    for _ in response.streaming_content:
+                        pass
+        return run
+
+    pages = [
+        ("django.users", "/"),
+        ("django.users_search", "/?q=user1"),
+        ("django.orders", "/orders/"),
+        ("django.join", "/join/"),
+        ("django.join_left", "/join-left/"),
+        ("django.api_users", "/api/users/"),
+        ("django.api_orders", f"/api/orders/?after={size // 2}"),
+        ("django.api_user_orders", "/api/user-orders/"),
+    ]
+    for name, url in pages:
+        bench.run(name, get(url), 20, REPEAT)
+    bench.run("django.export_orders", get("/api/export/orders/", 1), size)
+
+
+def _allowed_hosts():
+    from django.conf import settings
+    return settings.ALLOWED_HOSTS
+
+
+def run(sizes=SIZES, django=True, verbose=True):
+    """Run every benchmark at each size; returns the results document."""
+    # the in-process client, not a server, serves the views
+    os.environ.pop(SERVER_ENV, None)
+    results = {}
+    for size in sizes:
+        if verbose:
+            print(f"{size} rows")
+        bench = Bench(verbose)
+        directory = tempfile.mkdtemp(prefix="minirdbms-bench-")
+        try:
+            path = os.path.join(directory, "db.json")
+            database = Database(path, sync=False)
+            rng = random.Random(SEED)
+            users = {}
+
+            def load():
+                users["count"] = populate(database, size, rng)
+            bench.run("engine.insert_many", load, size)
+            users = users["count"]
+
+            bench_engine(bench, database, path, size, users, rng)
+            with serving(database):
+                bench_sql(bench, size, users, rng)
+                if django:
+                    bench_django(bench, size, users)
+            database.close()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        results[str(size)] = bench.results
+    return {
+        "python": platform.python_version(),
+        "numpy": vector.numpy is not None,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+
+
+# -------------------------------
+# Baseline
+# -------------------------------
+def compare(current, baseline, tolerance=TOLERANCE):
+    """(size, name, baseline seconds, current seconds) of every result
+    slower than the baseline's by more than tolerance."""
+    slower = []
+    for size, results in current["results"].items():
+        base_results = baseline.get("results", {}).get(size, {})
+        for name, result in results.items():
+            base = base_results.get(name)
+            if base is None or base["seconds"] < MIN_SECONDS:
+                continue
+            if result["seconds"] > base["seconds"] * (1 + tolerance):
+                slower.append((size, name, base["seconds"], result["seconds"]))
+    return slower
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python -m main.bench")
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)),
+                        help="comma-separated row counts")
+    parser.add_argument("--out", default=RESULTS_FILE)
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="write the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    parser.add_argument("--no-django", action="store_true")
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    current = run(sizes, django=not args.no_django)
+    with open(args.out, "w") as f:
+        json.dump(current, f, indent=2)
+    print(f"Wrote {args.out}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(current, f, indent=2)
+        print(f"Wrote baseline {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; --save-baseline writes one")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    slower = compare(current, baseline, args.tolerance)
+    for size, name, before, now in slower:
+        print(f"SLOWER {size:>8} {name:<24} {_format(before):>10} -> {_format(now):>10} "
+              f"(+{(now / before - 1) * 100:.0f}%)")
+    if slower:
+        return 1
+    print(f"No benchmark slower than the baseline by more than {args.tolerance:.0%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
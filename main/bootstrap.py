@@ -8,3 +8,9 @@ def init_schema():
     if "orders" not in db.tables:
         db.create_table("orders", ["id","user_id","amount"], {"id":"INT","user_id":"INT","amount":"INT"}, pk="id")
 
+    # deleting a user deletes their orders; the foreign key also keeps
+    # an index on orders.user_id for joins and the cascade
+    orders = db.table("orders")
+    if "user_id" not in orders.foreign_keys:
+        orders.add_foreign_key("user_id", "users", "id", on_delete="CASCADE")
+
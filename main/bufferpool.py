@@ -0,0 +1,73 @@
+import threading
+from collections import OrderedDict
+
+# Decoded pages a database keeps in memory at once (0 = no limit)
+BUFFER_PAGES = 1024
+
+
+# -------------------------------
+# Buffer pool
+# -------------------------------
+class BufferPool:
+    """Bounded set of decoded pages of paged tables, evicted in LRU order.
+
+    Pages are decoded on a miss and admitted here; once more than
+    capacity pages are resident the least recently used one is dropped
+    back to disk. Only clean pages are tracked: a page holding a changed
+    row is pinned by its RowStore, because the file does not have the
+    change yet. Shared by all tables of a Database.
+    """
+
+    def __init__(self, capacity=BUFFER_PAGES):
+        self.capacity = capacity
+        self.pages = OrderedDict()   # (store, chunk) -> None, oldest first
+        # held while pages are decoded or evicted, by every store using
+        # the pool (re-entrant: a load admits, which may evict)
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.pages)
+
+    def hit(self, store, chunk):
+        self.hits += 1
+        try:
+            self.pages.move_to_end((store, chunk))
+        except KeyError:
+            # pinned, or evicted while a reader still held the row
+            pass
+
+    def admit(self, store, chunk):
+        """Record a page just decoded (a miss) and evict beyond capacity."""
+        self.misses += 1
+        with self.lock:
+            self.pages[(store, chunk)] = None
+            while self.capacity and len(self.pages) > self.capacity:
+                (victim, victim_chunk), _ = self.pages.popitem(last=False)
+                victim.evict(victim_chunk)
+                self.evictions += 1
+
+    def discard(self, store, chunk):
+        with self.lock:
+            self.pages.pop((store, chunk), None)
+
+    def clear(self):
+        """Forget every page (the database was reloaded)."""
+        with self.lock:
+            self.pages.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "capacity": self.capacity,
+            "resident": len(self.pages),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
+
+    def reset_stats(self):
+        self.hits = self.misses = self.evictions = 0
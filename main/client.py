@@ -0,0 +1,296 @@
+"""Client side of main/server.py.
+
+    database = connect()
+    database.execute("SELECT * FROM users WHERE id = ?", [1])
+    database.call("page", table="users", after=50, limit=51)
+
+connect() returns a ConnectionPool to the server named by
+$MINIRDBMS_SERVER, or, when that is not set, a LocalConnection that runs
+the same requests against this process's own copy of the database.
+Both have the same methods, so callers do not care which they got.
+"""
+import itertools
+import os
+import socket
+import threading
+from contextlib import contextmanager
+
+from main.protocol import SERVER_ENV, encode, parse_address, read_frame
+
+# Rows per page of the web app (same as main.core.PAGE_SIZE, which
+# clients do not import)
+PAGE_SIZE = 50
+
+# Connections a pool keeps open to the server
+POOL_SIZE = 8
+
+
+def _request(statement):
+    # "SQL", ("SQL", params) or a request dict as-is
+    if isinstance(statement, dict):
+        return dict(statement)
+    if isinstance(statement, str):
+        return {"sql": statement}
+    query, params = statement
+    return {"sql": query, "params": list(params)}
+
+
+# -------------------------------
+# Connection
+# -------------------------------
+class Connection:
+    """One socket to the server.
+
+    Not thread-safe: a thread takes a connection from a ConnectionPool,
+    uses it, and gives it back. A transaction opened with BEGIN stays
+    open on this connection until COMMIT or ROLLBACK.
+    """
+
+    def __init__(self, address, timeout=None):
+        self.address = address
+        family, addr = parse_address(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(addr)
+        if family == socket.AF_INET:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.sock.makefile("rb")
+        self.ids = itertools.count(1)
+        self.in_transaction = False
+        # set once the socket failed; the pool drops the connection
+        self.broken = False
+
+    def close(self):
+        self.broken = True
+        self.file.close()
+        self.sock.close()
+
+    def alive(self):
+        """False if the server closed this (idle) connection."""
+        try:
+            return self.sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) != b""
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+    # ---------- requests ----------
+    def execute(self, query, params=()):
+        return self.request({"sql": query, "params": list(params)})
+
+    def execute_many(self, query, params_seq):
+        return self.request({"sql": query, "many": [list(p) for p in params_seq]})
+
+    def call(self, name, **args):
+        return self.request({"call": name, "args": args})
+
+    def request(self, request):
+        return self.pipeline([request])[0]
+
+    def pipeline(self, statements):
+        """Send every statement before reading any answer; their results
+        in order. Each runs on its own; the first error is raised once
+        all answers are in."""
+        requests = [_request(s) for s in statements]
+        for request in requests:
+            request["id"] = next(self.ids)
+        self._send(b"".join(encode(request) for request in requests))
+        responses = [self._receive() for _ in requests]
+        return [self._result(response) for response in responses]
+
+    def batch(self, statements):
+        """Run statements in one round trip and one frame; their results.
+
+        The server stops at the first failure and raises it here; a
+        transaction the batch opened itself is rolled back then.
+        """
+        requests = [_request(s) for s in statements]
+        for request in requests:
+            request["id"] = next(self.ids)
+        self._send(encode(requests))
+        return [self._result(response) for response in self._receive()]
+
+    # ---------- wire ----------
+    def _send(self, data):
+        try:
+            self.sock.sendall(data)
+        except OSError:
+            self.close()
+            raise
+
+    def _receive(self):
+        try:
+            message = read_frame(self.file)
+        except Exception:
+            self.close()
+            raise
+        if message is None:
+            self.close()
+            raise ConnectionError(f"Server at {self.address} closed the connection")
+        return message
+
+    def _result(self, response):
+        self.in_transaction = response.get("txn", False)
+        if not response["ok"]:
+            raise Exception(response["error"])
+        return response.get("result")
+
+
+# -------------------------------
+# Connection pool
+# -------------------------------
+class ConnectionPool:
+    """Up to size connections to one server, shared by threads.
+
+    execute/execute_many/call/batch/pipeline borrow a connection for one
+    call; use connection() to keep one across calls (a transaction). A
+    connection given back with a transaction still open is rolled back
+    first.
+    """
+
+    def __init__(self, address, size=POOL_SIZE, timeout=None):
+        self.address = address
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise Exception(f"No free connection to {self.address}")
+        conn = None
+        try:
+            conn = self._take()
+            yield conn
+        finally:
+            if conn is not None:
+                self._give_back(conn)
+            self.slots.release()
+
+    def _take(self):
+        while True:
+            with self.lock:
+                conn = self.idle.pop() if self.idle else None
+            if conn is None:
+                return Connection(self.address, self.timeout)
+            if conn.alive():
+                return conn
+            # the server restarted since this connection was last used
+            conn.close()
+
+    def _give_back(self, conn):
+        if not conn.broken and conn.in_transaction:
+            try:
+                conn.execute("ROLLBACK")
+            except Exception:
+                conn.close()
+        if conn.broken:
+            return
+        with self.lock:
+            self.idle.append(conn)
+
+    def execute(self, query, params=()):
+        with self.connection() as conn:
+            return conn.execute(query, params)
+
+    def execute_many(self, query, params_seq):
+        with self.connection() as conn:
+            return conn.execute_many(query, params_seq)
+
+    def call(self, name, **args):
+        with self.connection() as conn:
+            return conn.call(name, **args)
+
+    def batch(self, statements):
+        with self.connection() as conn:
+            return conn.batch(statements)
+
+    def pipeline(self, statements):
+        with self.connection() as conn:
+            return conn.pipeline(statements)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+
+# -------------------------------
+# In-process fallback
+# -------------------------------
+class LocalConnection:
+    """Same interface as ConnectionPool, served by this process.
+
+    Used when no server is configured: the database is loaded into
+    every process and reloaded before each call when another process
+    changed it, as the app did before the server existed.
+    """
+
+    def __init__(self):
+        # imported here so that clients of a server never load the engine
+        from main import server
+        self.server = server
+        self.db = server.db
+
+    @contextmanager
+    def connection(self):
+        try:
+            yield self
+        finally:
+            while self.db.in_transaction():
+                self.db.rollback()
+
+    @property
+    def in_transaction(self):
+        return self.db.in_transaction()
+
+    def execute(self, query, params=()):
+        return self.request({"sql": query, "params": list(params)})
+
+    def execute_many(self, query, params_seq):
+        return self.request({"sql": query, "many": [list(p) for p in params_seq]})
+
+    def call(self, name, **args):
+        return self.request({"call": name, "args": args})
+
+    def request(self, request):
+        return self._results([request])[0]
+
+    def pipeline(self, statements):
+        return self._results(_request(s) for s in statements)
+
+    def batch(self, statements):
+        if not self.db.in_transaction():
+            self.db.reload()
+        return [
+            self._result(response)
+            for response in self.server.respond([_request(s) for s in statements])
+        ]
+
+    def _results(self, requests):
+        if not self.db.in_transaction():
+            self.db.reload()
+        responses = [self.server.respond(request) for request in requests]
+        return [self._result(response) for response in responses]
+
+    def _result(self, response):
+        if not response["ok"]:
+            raise Exception(response["error"])
+        return response.get("result")
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def connect():
+    """The process-wide database handle (see the module docstring)."""
+    global _default
+    with _default_lock:
+        if _default is None:
+            address = os.environ.get(SERVER_ENV)
+            _default = ConnectionPool(address) if address else LocalConnection()
+        return _default
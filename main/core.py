@@ -1,18 +1,77 @@
+import itertools
 import json
 import os
+import re
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+try:
+    import fcntl
+except ImportError:
+    # no flock (Windows): only one process may write a database
+    fcntl = None
+
+from main.bufferpool import BUFFER_PAGES, BufferPool
+from main.index import SortedIndex, TrigramIndex, text_key
+from main.metrics import counters, metrics
+from main.pagefile import PageFile, PageWriter, is_paged
+from main.parser import Select, parse
+from main.planner import aggregate_rows, bind, grouping, plan_aggregate, plan_join
+from main.rows import (
+    LATEST, PENDING, UNLOADED, Deleted, RowStore, encode_row, getter, row_class,
+    visible,
+)
 
 # -------------------------------
 # Paths
 # -------------------------------
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 DB_FILE = os.path.join(BASE_DIR, "db.json")
+# Paged binary database (see main/pagefile.py, main/migrate.py); used
+# instead of db.json when it exists
+PAGED_DB_FILE = os.path.join(BASE_DIR, "db.pages")
+
+# Reserved top-level key in the snapshot for engine metadata
+META_KEY = "__meta__"
+
+# Fold the log back into the snapshot after this many records
+CHECKPOINT_EVERY = 1000
+
+# Bytes read from the end of the log to find its last lsn; a record
+# ends with its "lsn" and "by" fields, so this always holds them
+LOG_TAIL = 256
+_LOG_TAIL_LSN = re.compile(rb'"lsn":(\d+),"by":"\w*"\}\n\Z')
+
+# Default page size for keyset pagination
+PAGE_SIZE = 50
+
+# Rows insert_many (and COPY) validates, applies and logs at a time
+INSERT_BATCH = 10000
+
+# Columns the web app's search boxes look in; each is given a trigram
+# index
+SEARCH_COLUMNS = {
+    "users": ["id", "name"],
+    "orders": ["id", "user_id", "amount"],
+    "user_orders": ["user_id", "user_name", "order_id", "order_amount"],
+    "user_orders_left": ["user_id", "user_name", "order_id", "order_amount"],
+}
+
+# ON DELETE actions a foreign key can declare
+FK_ACTIONS = ("CASCADE", "RESTRICT", "SET NULL")
+
+# Bumped whenever a table's set of indexes changes, so cached query
+# plans know to re-plan
+_schema_versions = itertools.count(1)
 
 
 # -------------------------------
 # Table Class
 # -------------------------------
 class Table:
-    def __init__(self, name, columns, types, pk=None, unique=None):
+    def __init__(self, name, columns, types, pk=None, unique=None,
+                 foreign_keys=None):
         self.name = name
         self.columns = columns
         self.types = types
@@ -20,15 +79,54 @@ class Table:
         self.primary_key = pk
         self.unique = unique or []
 
-        self.rows = []
+        # Rows are compact slotted objects kept in stable slots; every
+        # index maps values to row ids (see main/rows.py)
+        self.row_type = row_class(name, columns)
+        self.rows = RowStore()
         self.indexes = {}
         self.database = None  # set when table added to Database
+        self.schema_version = next(_schema_versions)
+
+        # Secondary indexes. index_defs maps name -> {"column", "using"};
+        # hash indexes are column -> {value: {row ids}}, sorted indexes are
+        # column -> SortedIndex, trigram indexes are column -> TrigramIndex
+        self.index_defs = {}
+        self.secondary_indexes = {}
+        self.ordered_indexes = {}
+        self.text_indexes = {}
 
         # Initialize indexes for primary key and unique columns
         for col in [self.primary_key] + self.unique:
             if col:
                 self.indexes[col] = {}
 
+        # The primary key is also kept in order, for range scans,
+        # ORDER BY and keyset pagination
+        if self.primary_key:
+            self.ordered_indexes[self.primary_key] = SortedIndex()
+
+        # Foreign keys: column -> {"table", "column", "on_delete"}. The
+        # referencing column always has an index (the reverse index), so
+        # a delete in the parent finds its child rows without a scan
+        self.foreign_keys = foreign_keys or {}
+        for col in self.foreign_keys:
+            if not self._has_index(col):
+                self.secondary_indexes[col] = {}
+
+        # Materialized views: the ones computed from this table, which
+        # each change is applied to, and the view this table stores the
+        # rows of (None for a base table)
+        self.views = []
+        self.view = None
+
+        # NumPy arrays of the INT columns as of the last commit, built
+        # by queries that need them (see main/vector.py)
+        self.vectors = None
+
+        # During insert_many: sorted and trigram index entries of the
+        # new rows, by index, added to each in one go (see _bulk)
+        self._deferred = None
+
     # -------------------------------
     # Link table to database
     # -------------------------------
@@ -40,6 +138,8 @@ class Table:
     # -------------------------------
     def _type_check(self, row):
         for col, val in row.items():
+            if val is None and col != self.primary_key:
+                continue  # NULL
             expected = self.types[col]
             if expected == "INT" and not isinstance(val, int):
                 raise Exception(f"{col} must be INT")
@@ -47,44 +147,681 @@ class Table:
                 raise Exception(f"{col} must be TEXT")
 
     def _check_unique(self, row, ignore_row=None):
+        ignore = None if ignore_row is None else ignore_row._rid
         for col in self.indexes:
             val = row[col]
             existing = self.indexes[col].get(val)
-            if existing and existing is not ignore_row:
+            if existing is None or existing == ignore:
+                continue
+            # the entry may be left over from an older version of that row
+            current = self.rows.version(existing)
+            if current is not None and current[col] == val:
                 raise Exception(f"Duplicate value for {col}")
 
+    def _check_foreign_keys(self, row, old=None):
+        # every non-NULL foreign key value must exist in the parent;
+        # the parent column is a primary key or UNIQUE, so this is a
+        # single dict lookup
+        if not self.database:
+            return
+        for col, fk in self.foreign_keys.items():
+            value = row[col]
+            if value is None or (old is not None and old[col] == value):
+                continue
+            parent = self.database.tables[fk["table"]]
+            if parent.find(fk["column"], value) is None:
+                raise Exception(
+                    f"Foreign key violation: {self.name}.{col}={value!r} "
+                    f"not found in {fk['table']}.{fk['column']}"
+                )
+
+    def _check_referenced(self, row, new_row):
+        # a referenced key may not change while child rows point at it
+        if not self.database:
+            return
+        for child, col, fk in self.database.references_to(self.name):
+            value = row[fk["column"]]
+            if new_row[fk["column"]] == value:
+                continue
+            if any(r is not row for r in child.find_all(col, value)):
+                raise Exception(
+                    f"Cannot change {self.name}.{fk['column']}={value!r}: "
+                    f"referenced by {child.name}.{col}"
+                )
+
+    # -------------------------------
+    # Index maintenance
+    # -------------------------------
+    def create_index(self, col, name=None, using="hash"):
+        """Create a secondary index on col and persist its definition.
+
+        using="hash" answers equality lookups; using="sorted" also answers
+        range predicates and ordered scans; using="trigram" answers
+        substring search (LIKE '%x%', CONTAINS, search()).
+        """
+        if col not in self.columns:
+            raise Exception(f"Unknown column {col}")
+        if using not in ("hash", "sorted", "trigram"):
+            raise Exception(f"Unknown index type {using}")
+        if name is None:
+            name = f"idx_{self.name}_{col}" + ("_trgm" if using == "trigram" else "")
+        if name in self.index_defs:
+            raise Exception(f"Index {name} already exists")
+
+        self.index_defs[name] = {"column": col, "using": using}
+        self._build_index(col, using)
+        self.schema_version = next(_schema_versions)
+
+        # index definitions are schema: write them straight to the snapshot
+        if self.database:
+            self.database.save()
+
+    def add_foreign_key(self, col, table, column, on_delete="RESTRICT"):
+        """Declare col as referencing table(column) and persist it.
+
+        Existing rows must already satisfy the constraint.
+        """
+        if col not in self.columns:
+            raise Exception(f"Unknown column {col}")
+        if col in self.foreign_keys:
+            raise Exception(f"{self.name}.{col} already has a foreign key")
+        fk = _foreign_key(self.database, self, col, table, column, on_delete)
+        self.foreign_keys[col] = fk
+        try:
+            for row in self.rows:
+                self._check_foreign_keys(row)
+        except Exception:
+            del self.foreign_keys[col]
+            raise
+        if not self._has_index(col):
+            self._build_index(col, "hash")
+            self.schema_version = next(_schema_versions)
+        if self.database:
+            self.database.save()
+
+    def _has_index(self, col):
+        return (col in self.indexes or col in self.secondary_indexes
+                or col in self.ordered_indexes)
+
+    def _build_index(self, col, using):
+        if using == "trigram":
+            if col in self.text_indexes:
+                return
+            index = TrigramIndex()
+            index.build(self._keyed(col))
+            self.text_indexes[col] = index
+        elif using == "sorted":
+            if col in self.ordered_indexes:
+                return
+            index = SortedIndex()
+            index.build(self._keyed(col))
+            self.ordered_indexes[col] = index
+        else:
+            if col in self.secondary_indexes:
+                return
+            index = {}
+            for value, rid in self._keyed(col):
+                index.setdefault(value, set()).add(rid)
+            self.secondary_indexes[col] = index
+
+    def _keyed(self, col):
+        # (value, row id) for every version a snapshot may still read,
+        # so an index built now also serves open snapshots
+        get = self.getter(col)
+        rows = self.rows
+        for rid in range(len(rows.slots)):
+            row = rows[rid]
+            if row is None:
+                continue
+            if row._prev is None:
+                if not row._deleted:
+                    yield get(row), rid
+                continue
+            values = set()
+            while row is not None:
+                if not row._deleted and get(row) not in values:
+                    values.add(get(row))
+                    yield get(row), rid
+                row = row._prev
+
+    def _index_add(self, row, old=None):
+        # entries for row's values; with old (the version row replaces)
+        # only values no readable version of the row has an entry for
+        rid = row._rid
+        keep = None if old is None else list(_versions(old))
+        for col, index in self.indexes.items():
+            value = row[col]
+            if keep is None or not _kept(keep, col, value):
+                index[value] = rid
+        for col, index in self.secondary_indexes.items():
+            value = row[col]
+            if keep is None or not _kept(keep, col, value):
+                bucket = index.get(value)
+                if bucket is None:
+                    index[value] = {rid}
+                else:
+                    bucket.add(rid)
+        deferred = self._deferred
+        for indexes in (self.ordered_indexes, self.text_indexes):
+            for col, index in indexes.items():
+                value = row[col]
+                if keep is None or not _kept(keep, col, value):
+                    if deferred is None:
+                        index.add(value, rid)
+                    else:
+                        deferred[index].append((value, rid))
+
+    def _index_add_many(self, rows):
+        # _index_add of rows that are new (no older versions)
+        rids = [row._rid for row in rows]
+        getter = self.getter
+        for col, index in self.indexes.items():
+            index.update(zip(map(getter(col), rows), rids))
+        for col, index in self.secondary_indexes.items():
+            for value, rid in zip(map(getter(col), rows), rids):
+                bucket = index.get(value)
+                if bucket is None:
+                    index[value] = {rid}
+                else:
+                    bucket.add(rid)
+        deferred = self._deferred
+        for indexes in (self.ordered_indexes, self.text_indexes):
+            for col, index in indexes.items():
+                pairs = zip(map(getter(col), rows), rids)
+                if deferred is None:
+                    index.add_many(pairs)
+                else:
+                    deferred[index].extend(pairs)
+
+    def _index_remove(self, row, keep=None):
+        # drop row's entries, except values a version in keep (the
+        # versions of this row still readable) also has
+        if self._deferred:
+            self._flush_deferred()
+        rid = row._rid
+        for col, index in self.indexes.items():
+            value = row[col]
+            if _kept(keep, col, value):
+                continue
+            if index.get(value) == rid:
+                del index[value]
+        for col, index in self.secondary_indexes.items():
+            value = row[col]
+            if _kept(keep, col, value):
+                continue
+            bucket = index.get(value)
+            if bucket is None:
+                continue
+            bucket.discard(rid)
+            if not bucket:
+                del index[value]
+        for col, index in self.ordered_indexes.items():
+            value = row[col]
+            if not _kept(keep, col, value):
+                index.remove(value, rid)
+        for col, index in self.text_indexes.items():
+            value = row[col]
+            if not _kept(keep, col, value):
+                # trigrams a kept value shares stay
+                index.remove(value, rid, [v[col] for v in keep or ()])
+
+    def _rebuild_indexes(self, columns=None):
+        # columns: col -> values in row id order (the key vectors of a
+        # paged file), so indexes are built without loading any rows
+        def keyed(col):
+            if columns is not None and col in columns:
+                values = columns[col]
+                return zip(values, range(len(values)))
+            return self._keyed(col)
+
+        for col, index in self.indexes.items():
+            index.clear()
+            index.update(keyed(col))
+        for col, index in self.secondary_indexes.items():
+            index.clear()
+            for value, rid in keyed(col):
+                index.setdefault(value, set()).add(rid)
+        for col, index in self.ordered_indexes.items():
+            index.build(keyed(col))
+        for col, index in self.text_indexes.items():
+            index.build(keyed(col))
+
+    @contextmanager
+    def _bulk(self):
+        # sorted and trigram index entries of the rows inserted
+        # meanwhile, here and in the views over this table, are added at
+        # the end: one sort per sorted index instead of an insertion per
+        # row, and the trigrams of each distinct value computed once
+        tables = [self] + [view.table for view in self.views]
+        tables = [table for table in tables if table._deferred is None]
+        for table in tables:
+            indexes = itertools.chain(
+                table.ordered_indexes.values(), table.text_indexes.values()
+            )
+            table._deferred = {index: [] for index in indexes}
+        try:
+            yield
+        finally:
+            for table in tables:
+                table._flush_deferred()
+                table._deferred = None
+
+    def _flush_deferred(self):
+        deferred = self._deferred
+        for index, pairs in deferred.items():
+            if pairs:
+                index.add_many(pairs)
+                deferred[index] = []
+
+    def _declare_indexes(self, defs):
+        # empty indexes for saved definitions; _rebuild_indexes fills them
+        for index_name, spec in defs.items():
+            if isinstance(spec, str):
+                spec = {"column": spec, "using": "hash"}
+            self.index_defs[index_name] = spec
+            if spec["using"] == "sorted":
+                self.ordered_indexes[spec["column"]] = SortedIndex()
+            elif spec["using"] == "trigram":
+                self.text_indexes[spec["column"]] = TrigramIndex()
+            else:
+                self.secondary_indexes[spec["column"]] = {}
+
+    def indexed_columns(self):
+        return (set(self.indexes) | set(self.secondary_indexes)
+                | set(self.ordered_indexes) | set(self.text_indexes))
+
+    def schema(self):
+        """The table definition as stored in a snapshot (no rows)."""
+        return {
+            "columns": self.columns,
+            "types": self.types,
+            "primary_key": self.primary_key,
+            "unique": self.unique,
+            "indexes": self.index_defs,
+            "foreign_keys": self.foreign_keys,
+        }
+
+    def getter(self, col):
+        """Fast column accessor for loops over many rows."""
+        return getter(self.row_type, col)
+
     # -------------------------------
     # CRUD Operations
     # -------------------------------
+    def _transaction(self):
+        # Every statement runs in a transaction (or a savepoint of the
+        # caller's transaction) so it is atomic and logged in one record
+        if self.database:
+            return self.database.transaction()
+        return nullcontext()
+
+    def _remember(self, *entry):
+        if self.database:
+            self.database._push_undo(self, entry)
+
+    def _log(self, record):
+        # a view's rows are derived: replaying its base tables' changes
+        # rebuilds them, so only base tables are logged
+        if self.database and self.view is None:
+            self.database.log(record)
+
+    def _check_writable(self):
+        if self.view is not None:
+            raise Exception(
+                f"{self.name} is a materialized view: change its base tables instead"
+            )
+
     def insert(self, row):
-        self._type_check(row)
-        self._check_unique(row)
+        self._check_writable()
+        self._insert(row)
+
+    def _insert(self, row):
+        with self._transaction():
+            self._type_check(row)
+            self._check_unique(row)
+
+            row = self.row_type(row)
+            row._begin = PENDING
+            self._check_foreign_keys(row)
+            self.rows.append(row)
+
+            # Update indexes
+            self._index_add(row)
+
+            self._remember("insert", row)
+            for view in self.views:
+                view.apply(self, None, row)
 
+            # Append to write-ahead log
+            self._log({"op": "insert", "table": self.name, "row": row.copy()})
+            counters["rows_inserted"] += 1
+
+    def insert_many(self, rows, batch=INSERT_BATCH):
+        """Insert an iterable of rows in one transaction; returns how many.
+
+        Rows are consumed batch at a time, so they can be streamed from
+        a file: each batch is validated as a whole (one foreign key
+        lookup per distinct value), appended and logged as one record,
+        and sorted and trigram index entries are added at the end (see
+        _bulk). A load costs one commit instead of one per row.
+        """
+        self._check_writable()
+        count = 0
+        with self._transaction(), self._bulk():
+            for chunk in _batches(rows, batch):
+                self._insert_batch(chunk)
+                count += len(chunk)
+        return count
+
+    def _insert_batch(self, rows):
+        seen = {col: set() for col in self.indexes}
+        for row in rows:
+            self._type_check(row)
+            self._check_unique(row)
+            for col, values in seen.items():
+                if row[col] in values:
+                    raise Exception(f"Duplicate value for {col}")
+                values.add(row[col])
+
+        rows = [self.row_type(row) for row in rows]
+        if any(fk["table"] == self.name for fk in self.foreign_keys.values()):
+            # a foreign key to this table may point at rows of the
+            # batch: check row by row as they go in
+            for row in rows:
+                row._begin = PENDING
+                self._check_foreign_keys(row)
+                self.rows.append(row)
+                self._index_add(row)
+                self._remember("insert", row)
+        else:
+            self._check_foreign_keys_batch(rows)
+            self._append_many(rows)
+        for view in self.views:
+            view.apply_many(self, rows)
+
+        self._log({
+            "op": "insert_many", "table": self.name, "columns": self.columns,
+            "rows": [row.values() for row in rows],
+        })
+        counters["rows_inserted"] += len(rows)
+
+    def _check_foreign_keys_batch(self, rows):
+        # _check_foreign_keys for many rows, one parent lookup per value
+        if not self.database:
+            return
+        for col, fk in self.foreign_keys.items():
+            get = self.getter(col)
+            parent = self.database.tables[fk["table"]]
+            for value in {get(row) for row in rows} - {None}:
+                if parent.find(fk["column"], value) is None:
+                    raise Exception(
+                        f"Foreign key violation: {self.name}.{col}={value!r} "
+                        f"not found in {fk['table']}.{fk['column']}"
+                    )
+
+    def _append_many(self, rows):
+        # add checked new rows (row_type objects), then their index
+        # entries an index at a time
+        append = self.rows.append
+        for row in rows:
+            row._begin = PENDING
+            append(row)
+            self._remember("insert", row)
+        self._index_add_many(rows)
+
+    def _insert_derived(self, row):
+        # a view row (a row_type object): computed from rows that were
+        # checked already, inside their change's transaction
+        row._begin = PENDING
         self.rows.append(row)
+        self._index_add(row)
+        self._remember("insert", row)
 
-        # Update indexes
-        for col, index in self.indexes.items():
-            index[row[col]] = row
+    # -------------------------------
+    # Reads
+    # -------------------------------
+    # Every read sees one snapshot: ts is the commit timestamp it reads
+    # at (see Database.reading). Left out, the read takes its own. Index
+    # entries of replaced versions linger until no snapshot needs them,
+    # so every row found through an index is checked against the key.
 
-        # Auto-save
+    def reading(self):
+        """Context manager giving the timestamp a read should use."""
         if self.database:
-            self.database.save()
+            return self.database.reading()
+        return nullcontext(LATEST)
+
+    def _read(self, read, *args):
+        # read(*args, ts) in a snapshot of its own (or the thread's)
+        database = self.database
+        if database is None:
+            return read(*args, LATEST)
+        ts, token = database._begin_read()
+        try:
+            return read(*args, ts)
+        finally:
+            database._end_read(token)
+
+    def _snapshot_read(self, read, *args):
+        # same for a generator: the snapshot is held for as long as the
+        # caller iterates
+        with self.reading() as ts:
+            yield from read(*args, ts=ts)
+
+    def all(self, ts=None):
+        if ts is None:
+            return self._read(self.all)
+        counters["scans"] += 1
+        return list(self.rows.scan(ts))
 
-    def all(self):
-        return self.rows
+    def scan(self, ts=None):
+        """Iterate over the rows without building a list."""
+        counters["scans"] += 1
+        if ts is None:
+            return self._snapshot_read(self.rows.scan)
+        return self.rows.scan(ts)
 
-    def find(self, col, value):
+    def page(self, after=None, limit=PAGE_SIZE, key=None, ts=None):
+        """Keyset pagination: up to limit rows ordered by key (the primary
+        key by default) whose key is greater than after.
+
+        With a sorted index on key this costs O(log n + limit), however
+        deep into the table the page is.
+        """
+        key = key or self.primary_key
+        if key is None:
+            raise Exception(f"Table {self.name} has no primary key to page by")
+        rows = self.range(key, lo=after, lo_inclusive=False, ts=ts)
+        return list(itertools.islice(rows, limit))
+
+    def find(self, col, value, ts=None):
+        if ts is None:
+            return self._read(self.find, col, value)
         if col in self.indexes:
-            return self.indexes[col].get(value)
-        for r in self.rows:
-            if r[col] == value:
-                return r
-        return None
+            counters["index_lookups"] += 1
+            rid = self.indexes[col].get(value)
+            if rid is None:
+                return None
+            row = self.rows[rid] if rid < len(self.rows.slots) else None
+            if row is not None and (row._begin > ts or row._deleted):
+                row = visible(row, ts)
+            if row is not None and row[col] == value:
+                return row
+        return next(self._matches(col, value, ts), None)
+
+    def find_all(self, col, value, ts=None):
+        """Return every row where col == value, using an index if there is one."""
+        if ts is None:
+            return self._read(self.find_all, col, value)
+        return list(self._matches(col, value, ts))
+
+    def _matches(self, col, value, ts):
+        get = self.getter(col)
+        version = self.rows.version
+        if col in self.indexes:
+            counters["index_lookups"] += 1
+            rid = self.indexes[col].get(value)
+            if rid is None:
+                return
+            row = version(rid, ts)
+            if row is not None and get(row) == value:
+                yield row
+            elif ts != LATEST:
+                # the entry may have been taken over by a newer row with
+                # this value since the snapshot: look the old one up
+                yield from (r for r in self.rows.scan(ts) if get(r) == value)
+            return
+        if col in self.secondary_indexes:
+            counters["index_lookups"] += 1
+            rids = tuple(self.secondary_indexes[col].get(value, ()))
+        elif col in self.ordered_indexes and value is not None:
+            counters["index_lookups"] += 1
+            if self._deferred and ts == LATEST:
+                # the writer, mid insert_many: its new rows first
+                self._flush_deferred()
+            rids = [rid for _, rid in self.ordered_indexes[col].items(value, value)]
+        else:
+            counters["scans"] += 1
+            yield from (r for r in self.rows.scan(ts) if get(r) == value)
+            return
+        for rid in rids:
+            row = version(rid, ts)
+            if row is not None and get(row) == value:
+                yield row
+
+    def search(self, text, columns=None, ts=None):
+        """Yield rows where text occurs, ignoring case, in one of columns
+        (all by default), in no particular order.
+
+        With a trigram index on each of the columns only rows that may
+        match are read, so the cost follows the number of matches;
+        otherwise every row is checked.
+        """
+        if ts is None:
+            yield from self._snapshot_read(self.search, text, columns)
+            return
+        text = text_key(text)
+        columns = columns or self.columns
+        gets = [self.getter(col) for col in columns]
+        if text and all(col in self.text_indexes for col in columns):
+            counters["text_searches"] += 1
+            rids = set().union(*(self.text_indexes[col].search(text) for col in columns))
+            rows = self.rows.versions(sorted(rids), ts)
+        else:
+            counters["scans"] += 1
+            rows = self.rows.scan(ts)
+        for row in rows:
+            if row is None:
+                continue
+            for get in gets:
+                value = get(row)
+                if value is not None and text in text_key(value):
+                    yield row
+                    break
+
+    def fetch(self, rids, ts=None):
+        """Rows for a sequence of row ids (as stored in the indexes)."""
+        if ts is None:
+            return self._read(self.fetch, rids)
+        return self.rows.fetch(rids, ts)
+
+    def range(self, col, lo=None, hi=None, lo_inclusive=True,
+              hi_inclusive=True, reverse=False, ts=None):
+        """Yield rows with lo <= row[col] <= hi, ordered by col.
+
+        None leaves that side unbounded. Uses a sorted index when col has
+        one; otherwise falls back to a scan plus sort.
+        """
+        if ts is None:
+            yield from self._snapshot_read(
+                self.range, col, lo, hi, lo_inclusive, hi_inclusive, reverse
+            )
+            return
+
+        get = self.getter(col)
+        if col in self.ordered_indexes:
+            counters["range_scans"] += 1
+            versions = self.rows.versions
+            for keys, rids in self.ordered_indexes[col].blocks(
+                lo, hi, lo_inclusive, hi_inclusive, reverse
+            ):
+                for key, row in zip(keys, versions(rids, ts)):
+                    if row is not None and get(row) == key:
+                        yield row
+            return
+
+        def matches(v):
+            if v is None:
+                return False
+            if lo is not None and (v < lo or (v == lo and not lo_inclusive)):
+                return False
+            if hi is not None and (v > hi or (v == hi and not hi_inclusive)):
+                return False
+            return True
+
+        counters["scans"] += 1
+        rows = [r for r in self.rows.scan(ts) if matches(get(r))]
+        rows.sort(key=get, reverse=reverse)
+        yield from rows
+
+    def ordered(self, col, reverse=False, ts=None):
+        """Yield every row ordered by col (NULLs first when ascending)."""
+        if ts is None:
+            yield from self._snapshot_read(self.ordered, col, reverse)
+            return
+
+        get = self.getter(col)
+        if col in self.ordered_indexes:
+            index = self.ordered_indexes[col]
+            nulls = [
+                row for row in self.rows.fetch(tuple(index.nulls), ts)
+                if get(row) is None
+            ]
+            if not reverse:
+                yield from nulls
+            yield from self.range(col, reverse=reverse, ts=ts)
+            if reverse:
+                yield from reversed(nulls)
+            return
+        counters["scans"] += 1
+        yield from sorted(
+            self.rows.scan(ts),
+            key=lambda r: (get(r) is not None, get(r)),
+            reverse=reverse
+        )
+
+    # -------------------------------
+    # Changes
+    # -------------------------------
+    # Writers hold the database's writer lock, so they are serialized and
+    # read the latest versions. An update or delete must be given the
+    # row's current version: one read from an older snapshot means
+    # another transaction changed the row since, and is a write conflict.
+
+    def _check_current(self, row):
+        if not self._contains(row):
+            raise Exception(
+                f"Write conflict on {self.name}: the row was changed or "
+                f"deleted by another transaction"
+            )
 
     def update(self, where_col, where_val, updates):
-        row = self.find(where_col, where_val)
-        if not row:
-            raise Exception("Row not found")
+        self._check_writable()
+        with self._transaction():
+            row = self.find(where_col, where_val)
+            if not row:
+                raise Exception("Row not found")
+            self._update_row(row, updates)
+
+    def update_rows(self, rows, updates):
+        """Apply updates to each of rows (as returned by find_all or the planner)."""
+        self._check_writable()
+        with self._transaction():
+            for row in rows:
+                self._update_row(row, updates)
+
+    def _update_row(self, row, updates):
+        self._check_current(row)
 
         # Build new row candidate
         new_row = row.copy()
@@ -93,107 +830,823 @@ class Table:
         # Validate
         self._type_check(new_row)
         self._check_unique(new_row, ignore_row=row)
+        self._check_foreign_keys(new_row, old=row)
+        self._check_referenced(row, new_row)
 
-        # Remove old index entries
-        for col in self.indexes:
-            self.indexes[col].pop(row[col], None)
+        key = self._log_key(row)
 
-        # Apply updates
-        row.update(updates)
+        # The new version replaces the row in its slot; the old one stays
+        # readable for snapshots taken before this commits, and so do its
+        # index entries, which are dropped once no snapshot needs them
+        version = self.row_type.from_values(row.values())
+        version.update(updates)
+        version._rid = row._rid
+        version._begin = PENDING
+        version._prev = row
+        self.rows.push(version)
+        self._index_add(version, old=row)
 
-        # Re-add to indexes
-        for col in self.indexes:
-            self.indexes[col][row[col]] = row
+        self._remember("update", version)
+        for view in self.views:
+            view.apply(self, row, version)
 
-        # Auto-save
-        if self.database:
-            self.database.save()
+        # Append to write-ahead log
+        self._log({"op": "update", "table": self.name, **key, "set": dict(updates)})
+        if self.view is None:
+            counters["rows_updated"] += 1
 
     def delete(self, where_col, where_val):
-        row = self.find(where_col, where_val)
-        if not row:
-            raise Exception("Row not found")
-
-        # ---------- CASCADING DELETE ----------
-        # If deleting a user, delete their orders
-        if self.name == "users" and self.database:
-            orders = self.database.tables.get("orders")
-            if orders:
-                orders.rows = [
-                    r for r in orders.rows if r["user_id"] != row["id"]
-                ]
-
-                # rebuild order indexes
-                for col in orders.indexes:
-                    orders.indexes[col].clear()
-                    for r in orders.rows:
-                        orders.indexes[col][r[col]] = r
-                        
+        self._check_writable()
+        with self._transaction():
+            row = self.find(where_col, where_val)
+            if not row:
+                raise Exception("Row not found")
+            self._delete_row(row)
+
+    def delete_rows(self, rows):
+        """Delete each of rows (as returned by find_all or the planner)."""
+        self._check_writable()
+        with self._transaction():
+            for row in rows:
+                self._delete_row(row)
+
+    def _delete_row(self, row):
+        self._check_current(row)
+        key = self._log_key(row)
+        references = self.database.references_to(self.name) if self.database else []
+
+        # ---------- ON DELETE RESTRICT ----------
+        for child, col, fk in references:
+            if fk["on_delete"] != "RESTRICT":
+                continue
+            value = row[fk["column"]]
+            if any(r is not row for r in child.find_all(col, value)):
+                raise Exception(
+                    f"Cannot delete from {self.name}: {child.name}.{col}={value!r} "
+                    f"references it"
+                )
 
         # ---------- DELETE THIS ROW ----------
+        # removed before the cascade, so a child that (directly or
+        # through a cycle) references this row cannot reach it again.
+        # Snapshots taken before the commit still see it, so its index
+        # entries stay until the slot is reclaimed
 
-        self.rows.remove(row)
+        marker = Deleted(row)
+        self.rows.push(marker)
 
-        for col in self.indexes:
-            self.indexes[col].pop(row[col], None)
+        self._remember("delete", marker)
+        for view in self.views:
+            view.apply(self, row, None)
 
-        # Auto-save
-        if self.database:
-            self.database.save()
+        # ---------- ON DELETE CASCADE / SET NULL ----------
+        # children are found through the reverse index on their foreign
+        # key column and logged before this row, so replay finds them
+        for child, col, fk in references:
+            children = child.find_all(col, row[fk["column"]])
+            if not children:
+                continue
+            if fk["on_delete"] == "CASCADE":
+                for r in children:
+                    # an earlier cascade in this loop may have taken it
+                    if child._contains(r):
+                        child._delete_row(r)
+            else:
+                child.update_rows(children, {col: None})
+
+        # Append to write-ahead log
+        self._log({"op": "delete", "table": self.name, **key})
+        if self.view is None:
+            counters["rows_deleted"] += 1
+
+    def _contains(self, row):
+        # row is the current version of a live row
+        slots = self.rows.slots
+        return row._rid < len(slots) and slots[row._rid] is row
+
+    def _log_key(self, row):
+        # How the log identifies a row on replay: by primary key, or by
+        # its full contents when the table has none
+        if self.primary_key:
+            return {"col": self.primary_key, "val": row[self.primary_key]}
+        return {"match": row.copy()}
+
+    # -------------------------------
+    # Old versions
+    # -------------------------------
+    def _prune(self, rid, oldest):
+        """Unlink versions of row rid older than the one a snapshot at
+        oldest (the oldest open snapshot) reads, with the index entries
+        only they had; a delete every snapshot sees frees the slot."""
+        slots = self.rows.slots
+        if rid >= len(slots):
+            return
+        head = keep = slots[rid]
+        if head is None or head is UNLOADED:
+            return
+        while keep._begin > oldest and keep._prev is not None:
+            keep = keep._prev
+        dropped, keep._prev = keep._prev, None
+
+        if keep._deleted:
+            # the row is gone for everyone
+            for row in _versions(dropped):
+                self._index_remove(row)
+            self.rows.reclaim(rid)
+            return
+
+        kept = list(_versions(head))
+        for row in _versions(dropped):
+            self._index_remove(row, keep=kept)
+
+    # -------------------------------
+    # Rollback
+    # -------------------------------
+    def _undo(self, entry):
+        kind, version = entry
+
+        if kind == "insert":
+            self._index_remove(version)
+            self.rows.discard(version._rid)
+
+        elif kind == "update":
+            self.rows.revert(version)
+            self._index_remove(version, keep=list(_versions(version._prev)))
+
+        elif kind == "delete":
+            self.rows.revert(version)
+
+
+def _batches(rows, size):
+    # lists of up to size items of an iterable
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _versions(row):
+    # a row version and the older ones linked behind it (no deletes)
+    while row is not None:
+        if not row._deleted:
+            yield row
+        row = row._prev
+
+
+def _kept(versions, col, value):
+    return versions is not None and any(v[col] == value for v in versions)
 
 
 # -------------------------------
 # Database Class
 # -------------------------------
 class Database:
-    def __init__(self, file=DB_FILE):
+    def __init__(self, file=DB_FILE, sync=True, checkpoint_every=CHECKPOINT_EVERY,
+                 group_commit=0.0, storage=None, buffer_pages=BUFFER_PAGES):
         self.tables = {}
+        self.views = {}           # name -> MaterializedView
         self.file = file
+        self.log_file = file + ".log"
+
+        # Snapshot format written by checkpoints: "json" or "paged".
+        # None keeps the format of the existing file (json for a new one)
+        self.storage = storage
+
+        # Decoded pages of a paged file kept in memory (0 = no limit);
+        # db.json tables are always fully in memory
+        self.buffer_pool = BufferPool(buffer_pages)
+
+        # fsync every log append; turn off to trade durability for speed
+        self.sync = sync
+        self.checkpoint_every = checkpoint_every
+
+        # Seconds a committing writer waits for others to join its flush
+        # (0 = flush every commit on its own)
+        self.group_commit = group_commit
+
+        self.lsn = 0              # last log sequence number applied
+        self._log_handle = None
+        self._log_lock = threading.Lock()
+        self._lock_handle = None  # db.json.lock, locked by log writers
+        self._log_records = 0     # records appended since last checkpoint
+        self._replaying = False
+
+        # Change detection: what the files looked like when we last read
+        # them, and how far into the log we have read. Records this
+        # instance wrote are tagged with _writer so a tail skips them.
+        self._writer = os.urandom(8).hex()
+        self._snapshot_lsn = 0
+        self._snapshot_stamp = None
+        self._log_offset = 0
+
+        # Writer lock, held for the duration of a transaction
+        self.lock = threading.RLock()
+        self._depth = 0
+        self._savepoints = []
+        self._pending = []        # log records of the open transaction
+        self._undo = []
+
+        # Snapshot reads (MVCC): clock is the commit timestamp of the last
+        # committed transaction. Readers register the timestamp they read
+        # at, so versions they may need are not unlinked under them
+        self.clock = 0
+        self._readers = {}        # token -> snapshot timestamp
+        self._tokens = itertools.count()
+        self._local = _ThreadSnapshot()
+        self._garbage = []        # (commit ts, table, row id) of replaced versions
+
+        # Group commit state
+        self._commit_cond = threading.Condition()
+        self._queue = []
+        self._queued_seq = 0
+        self._flushed_seq = 0
+        self._failed_seq = 0
+        self._flushing = False
+
         self.load()
         self._init_empty_tables()
 
-    # Load tables from JSON
+    # Load snapshot from JSON, then replay the log on top of it
     def load(self):
-        if not os.path.exists(self.file):
-            return
-        with open(self.file, "r") as f:
-            try:
-                data = json.load(f)
-            except json.JSONDecodeError:
-                return
+        self.lsn = 0
+        self._snapshot_stamp = _stamp(self.file)
+        data = {}
+        pages = None
+        if self._snapshot_stamp and is_paged(self.file):
+            # only the catalog is read here; rows stay in the mapped
+            # file until a query touches their page
+            pages = PageFile(self.file)
+            data = dict(pages.tables)
+            data[META_KEY] = {"lsn": pages.lsn, "views": pages.views}
+        elif self._snapshot_stamp:
+            with open(self.file, "r") as f:
+                try:
+                    data = json.load(f)
+                except json.JSONDecodeError:
+                    data = {}
+        if self.storage is None:
+            self.storage = "json" if pages is None else "paged"
+        self._load_snapshot(data, pages)
+        self._log_offset = 0
+        self._log_records = 0
+        self._replay_log()
+
+    def _load_snapshot(self, data, pages=None):
+        meta = data.get(META_KEY, {})
+        self.lsn = self._snapshot_lsn = meta.get("lsn", 0)
+
+        old_tables, self.tables = self.tables, {}
+        self.buffer_pool.clear()
+        # row ids of the old stores mean nothing in the new ones
+        self._garbage = []
         for name, info in data.items():
-            table = Table(
+            if name == META_KEY:
+                continue
+            args = (
                 name,
                 info["columns"],
                 info["types"],
+            )
+            kwargs = dict(
                 pk=info.get("primary_key"),
-                unique=info.get("unique", [])
+                unique=info.get("unique", []),
+                foreign_keys=info.get("foreign_keys", {})
             )
-            table.rows = info.get("rows", [])
+            # Reuse the Table object on reload, so references held
+            # elsewhere (myapp/api.py binds tables at import) stay valid
+            table = old_tables.get(name)
+            if table is not None:
+                table.__init__(*args, **kwargs)
+            else:
+                table = Table(*args, **kwargs)
+            if pages is not None:
+                table.rows = RowStore(
+                    pages=pages.table_rows(name, table.row_type.from_values),
+                    pool=self.buffer_pool
+                )
+            else:
+                table.rows = RowStore(table.row_type(r) for r in info.get("rows", []))
+            table._declare_indexes(info.get("indexes", {}))
 
             # rebuild indexes
-            for col, index in table.indexes.items():
-                for row in table.rows:
-                    index[row[col]] = row
+            table._rebuild_indexes(pages.vectors(name) if pages is not None else None)
 
             # link to this database
             table.set_database(self)
 
             self.tables[name] = table
 
-    # Save tables to JSON
+        # views last: they are computed from the tables
+        self.views = {}
+        for name, info in meta.get("views", {}).items():
+            view = MaterializedView(self, name, info["query"])
+            view.table._declare_indexes(info.get("indexes", {}))
+            self._add_view(view)
+
+    # -------------------------------
+    # Transactions
+    # -------------------------------
+    def begin(self):
+        """Start a transaction, or a savepoint if one is already open."""
+        self.lock.acquire()
+        if self._depth == 0:
+            self._pending = []
+            self._undo = []
+        self._savepoints.append((len(self._pending), len(self._undo)))
+        self._depth += 1
+
+    def commit(self):
+        if not self.in_transaction():
+            raise Exception("No transaction in progress")
+
+        self._savepoints.pop()
+        self._depth -= 1
+        if self._depth > 0:
+            # inner savepoint: changes are persisted by the outer commit
+            self.lock.release()
+            return
+
+        records, self._pending = self._pending, []
+        changes, self._undo = self._undo, []
+        try:
+            seq = self._enqueue(records) if records else None
+            if changes:
+                self._publish(changes)
+            # the deletes can no longer be rolled back: reclaim a few
+            # tombstones so their slots get reused
+            for table in self._all_tables():
+                if table.rows.dead:
+                    table.rows.compact()
+        finally:
+            self.lock.release()
+
+        # Wait for durability after releasing the writer lock, so other
+        # writers can commit and share the same flush
+        if seq is not None:
+            self._wait_flushed(seq)
+
+        if self.checkpoint_every and self._log_records >= self.checkpoint_every:
+            with self.lock:
+                if self._depth == 0:
+                    self.checkpoint()
+
+    def rollback(self):
+        if not self.in_transaction():
+            raise Exception("No transaction in progress")
+
+        pending_mark, undo_mark = self._savepoints.pop()
+        try:
+            while len(self._undo) > undo_mark:
+                table, entry = self._undo.pop()
+                table._undo(entry)
+            del self._pending[pending_mark:]
+        finally:
+            self._depth -= 1
+            self.lock.release()
+
+    @contextmanager
+    def transaction(self):
+        """Group several changes into one atomic, single-flush commit.
+
+            with db.transaction():
+                orders.insert(...)
+                orders.insert(...)
+        """
+        self.begin()
+        try:
+            yield self
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
+
+    def in_transaction(self):
+        # RLock._is_owned is what Condition uses for the same check
+        return self._depth > 0 and self.lock._is_owned()
+
+    def _push_undo(self, table, entry):
+        # also the list of versions the commit stamps, so it is kept
+        # while replaying too
+        if self._depth > 0:
+            self._undo.append((table, entry))
+
+    # -------------------------------
+    # Snapshots
+    # -------------------------------
+    @contextmanager
+    def snapshot(self):
+        """Read a consistent snapshot without taking the writer lock.
+
+            with db.snapshot():
+                user = users.find("id", 1)
+                orders.find_all("user_id", 1)
+
+        Every read in the block (in this thread) sees the database as of
+        the last commit before it started, whatever writers do meanwhile.
+        A single read outside a block gets a snapshot of its own.
+        """
+        local = self._local
+        ts, token = self._begin_read()
+        if token is not None:
+            local.ts = ts
+        try:
+            yield ts
+        finally:
+            if token is not None:
+                local.ts = None
+            self._end_read(token)
+
+    @contextmanager
+    def reading(self):
+        """Timestamp a read uses: LATEST for the writer, which sees its own
+        changes, otherwise the thread's snapshot (taking one if needed)."""
+        ts, token = self._begin_read()
+        try:
+            yield ts
+        finally:
+            self._end_read(token)
+
+    def _begin_read(self):
+        # (timestamp, token); token is None when nothing was registered
+        # (the writer, or a read inside the thread's open snapshot)
+        if self._depth and self.lock._is_owned():
+            return LATEST, None
+        ts = self._local.ts
+        if ts is not None:
+            return ts, None
+        token = next(self._tokens)
+        readers = self._readers
+        ts = readers[token] = self.clock
+        while self.clock != ts:
+            # a commit (and its cleanup) slipped in before we registered:
+            # read at that commit instead
+            ts = readers[token] = self.clock
+        return ts, token
+
+    def _end_read(self, token):
+        if token is None:
+            return
+        del self._readers[token]
+        if self._garbage and not self._readers:
+            self._vacuum_idle()
+
+    def _publish(self, changes):
+        # stamp the transaction's versions with the next commit timestamp,
+        # then advance the clock: snapshots taken from here on see them
+        ts = self.clock + 1
+        tables = set()
+        for table, (kind, version) in changes:
+            version._begin = ts
+            if version._prev is not None:
+                self._garbage.append((ts, table, version._rid))
+            tables.add(table)
+        for table in tables:
+            table.rows.stable = ts
+        self.clock = ts
+        self._vacuum()
+
+    def _vacuum_idle(self):
+        # the last reader out cleans up what commits had to leave for it,
+        # unless a writer is busy (it will at its commit)
+        if self.lock.acquire(blocking=False):
+            try:
+                if self._depth == 0:
+                    self._vacuum()
+            finally:
+                self.lock.release()
+
+    def _vacuum(self):
+        # unlink versions replaced before the oldest open snapshot
+        garbage = self._garbage
+        if not garbage:
+            return
+        oldest = min(self._readers.values(), default=self.clock)
+        done = 0
+        for ts, table, rid in garbage:
+            if ts > oldest:
+                break
+            table._prune(rid, oldest)
+            done += 1
+        del garbage[:done]
+
+    # -------------------------------
+    # Write-ahead log
+    # -------------------------------
+    def log(self, record):
+        """Record one change; it is written to disk when the transaction commits."""
+        if self._replaying:
+            return
+        if self._depth == 0:
+            # change made outside any transaction: commit it on its own
+            with self.transaction():
+                self._pending.append(record)
+            return
+        self._pending.append(record)
+
+    def _enqueue(self, records):
+        """Hand one encoded log line to the writer; _write_log numbers it."""
+        if len(records) == 1:
+            record = records[0]
+        else:
+            record = {"op": "txn", "ops": records}
+        # without its closing brace: the lsn and writer go last
+        line = json.dumps(record, separators=(",", ":"), default=encode_row)[:-1]
+        self._log_records += 1
+        counters["commits"] += 1
+
+        with self._commit_cond:
+            self._queue.append(line)
+            self._queued_seq += 1
+            return self._queued_seq
+
+    def _wait_flushed(self, seq):
+        cond = self._commit_cond
+        with cond:
+            while self._flushed_seq < seq:
+                if self._failed_seq >= seq:
+                    raise Exception("Commit failed: log write error")
+                if self._flushing:
+                    cond.wait()
+                    continue
+
+                # become the leader: flush everything queued so far
+                self._flushing = True
+                cond.release()
+                try:
+                    if self.group_commit:
+                        time.sleep(self.group_commit)
+                finally:
+                    cond.acquire()
+                batch, self._queue = self._queue, []
+                upto = self._queued_seq
+
+                cond.release()
+                try:
+                    self._write_log(batch)
+                    ok = True
+                except Exception:
+                    ok = False
+                    raise
+                finally:
+                    cond.acquire()
+                    if ok:
+                        self._flushed_seq = upto
+                    else:
+                        self._failed_seq = upto
+                    self._flushing = False
+                    cond.notify_all()
+
+    def _write_log(self, lines):
+        """Append encoded records (see _enqueue), numbered after the last
+        lsn in the log.
+
+        Other processes append to the same log and checkpoint it, so the
+        next lsn is read from the file, under the lock every writer
+        takes: a record numbered from this process's own count could
+        fall at or below the lsn of a snapshot another process just
+        wrote, and replay would skip it.
+        """
+        with self._log_lock, self._log_locked():
+            f = self._open_log()
+            lsn = max(self.lsn, self._log_tail(f))
+            text = "".join(
+                f'{line},"lsn":{n},"by":"{self._writer}"}}\n'
+                for n, line in enumerate(lines, lsn + 1)
+            )
+            # the log is ASCII (json.dumps escapes the rest)
+            data = text.encode("ascii")
+            f.write(data)
+            f.flush()
+            if self.sync:
+                os.fsync(f.fileno())
+            self.lsn = max(self.lsn, lsn + len(lines))
+        metrics.wrote("log_bytes", len(data))
+
+    def _log_tail(self, f):
+        """Last lsn in the log (0 if it is empty). A torn record left by
+        a writer that crashed mid-append is cut off first: replay stops
+        at it, so records appended after it would never be read."""
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return 0
+        f.seek(max(size - LOG_TAIL, 0))
+        tail = f.read()
+        if not tail.endswith(b"\n"):
+            size = self._cut_torn_record(f, size)
+            if size == 0:
+                return 0
+            f.seek(max(size - LOG_TAIL, 0))
+            tail = f.read()
+        match = _LOG_TAIL_LSN.search(tail)
+        return int(match.group(1)) if match else 0
+
+    def _cut_torn_record(self, f, size):
+        # truncate the log after its last complete line; returns the size
+        end = size
+        while end > 0:
+            start = max(end - 65536, 0)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b"\n")
+            if newline >= 0:
+                size = start + newline + 1
+                break
+            end = start
+        else:
+            size = 0
+        f.truncate(size)
+        return size
+
+    @contextmanager
+    def _log_locked(self):
+        """Hold the database's lock file, which every process takes to
+        append to the log or to checkpoint it."""
+        if fcntl is None:
+            yield
+            return
+        if self._lock_handle is None:
+            self._lock_handle = open(self.file + ".lock", "a")
+        fcntl.flock(self._lock_handle.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_handle.fileno(), fcntl.LOCK_UN)
+
+    def _open_log(self):
+        if self._log_handle is None:
+            # binary, and readable: _log_tail reads the end back
+            self._log_handle = open(self.log_file, "ab+")
+        return self._log_handle
+
+    def _close_log(self):
+        if self._log_handle is not None:
+            self._log_handle.close()
+            self._log_handle = None
+
+    def close(self):
+        """Close the log and lock files; the next write opens them again."""
+        with self._log_lock:
+            self._close_log()
+            if self._lock_handle is not None:
+                self._lock_handle.close()
+                self._lock_handle = None
+
+    def _replay_log(self, skip_own=False):
+        """Apply log records past self._log_offset.
+
+        skip_own is set when tailing the log of a database we already hold
+        in memory: records this instance wrote are applied already.
+        """
+        if not os.path.exists(self.log_file):
+            return
+
+        with open(self.log_file, "rb") as f:
+            f.seek(self._log_offset)
+            data = f.read()
+
+        self._replaying = True
+        try:
+            offset = 0
+            while True:
+                end = data.find(b"\n", offset)
+                if end < 0:
+                    # incomplete line: a writer is mid-append (or crashed)
+                    break
+                try:
+                    record = json.loads(data[offset:end])
+                except json.JSONDecodeError:
+                    # torn write at the tail: everything before it is valid
+                    break
+                offset = end + 1
+                if record["op"] == "checkpoint":
+                    # first line of a truncated log: the snapshot's lsn
+                    self.lsn = max(self.lsn, record["lsn"])
+                    continue
+                if skip_own and record.get("by") == self._writer:
+                    continue
+                self._log_records += 1
+
+                if record["lsn"] <= self._snapshot_lsn:
+                    # already folded into the snapshot
+                    continue
+                self._apply(record)
+                self.lsn = max(self.lsn, record["lsn"])
+        finally:
+            self._replaying = False
+            self._log_offset += offset
+
+    def _apply(self, record):
+        op = record["op"]
+        if op == "txn":
+            with self.transaction():
+                runs = itertools.groupby(record["ops"], key=lambda sub: (sub["op"], sub.get("table")))
+                for (op, name), subs in runs:
+                    if op == "insert_many":
+                        # the batches of one load: insert them as one
+                        self.tables[name].insert_many(
+                            dict(zip(sub["columns"], values))
+                            for sub in subs for values in sub["rows"]
+                        )
+                    else:
+                        for sub in subs:
+                            self._apply(sub)
+            return
+
+        table = self.tables[record["table"]]
+        if op == "insert":
+            table.insert(record["row"])
+        elif op == "insert_many":
+            columns = record["columns"]
+            table.insert_many(dict(zip(columns, values)) for values in record["rows"])
+        elif op == "update":
+            if "match" in record:
+                table.update_rows([_replay_match(table, record)], record["set"])
+            else:
+                table.update(record["col"], record["val"], record["set"])
+        elif op == "delete":
+            if "match" in record:
+                table.delete_rows([_replay_match(table, record)])
+            else:
+                table.delete(record["col"], record["val"])
+        else:
+            raise Exception(f"Unknown log record {op}")
+
+    # -------------------------------
+    # Checkpoint / compaction
+    # -------------------------------
+    def checkpoint(self):
+        """Write a full snapshot and truncate the log."""
+        with self.lock:
+            if self._depth > 0:
+                raise Exception("Cannot checkpoint inside a transaction")
+            # commits of other threads still queued for group commit are
+            # in memory already: log them before the snapshot takes them
+            self._wait_flushed(self._queued_seq)
+            with self._log_lock, self._log_locked():
+                # fold in what other processes logged, or the truncate
+                # loses it; they cannot append until the log is truncated
+                self.refresh()
+                self._checkpoint()
+
+    def _checkpoint(self):
+        # called with the log locked (see checkpoint)
+        self._vacuum()
+        for table in self._all_tables():
+            table.rows.compact(None)
+        f = self._open_log()
+        self.lsn = max(self.lsn, self._log_tail(f))
+        self.write_snapshot(self.file, self.storage)
+        self._snapshot_stamp = _stamp(self.file)
+        self._snapshot_lsn = self.lsn
+
+        # records up to self.lsn now live in the snapshot. The truncated
+        # log starts with that lsn, so writers that have not seen this
+        # snapshot still number their records after it
+        marker = {"op": "checkpoint", "lsn": self.lsn, "by": self._writer}
+        f.truncate(0)
+        f.write(json.dumps(marker, separators=(",", ":")).encode("ascii") + b"\n")
+        f.flush()
+        if self.sync:
+            os.fsync(f.fileno())
+        self._log_records = 0
+        self._log_offset = f.tell()
+
+    def write_snapshot(self, path, storage="json"):
+        """Write every table to path, as JSON or as a paged binary file."""
+        # write to a temp file and swap it in, so a crash never leaves
+        # a half-written snapshot behind
+        tmp = path + ".tmp"
+        start = time.perf_counter()
+        if storage == "paged":
+            writer = PageWriter(tmp)
+            for name, table in self.tables.items():
+                schema = table.schema()
+                schema["vector_columns"] = sorted(table.indexed_columns())
+                writer.write_table(name, schema, (row.values() for row in table.rows))
+            writer.close(self.lsn, self.sync, views=self._view_defs())
+        elif storage == "json":
+            data = {META_KEY: {"lsn": self.lsn}}
+            if self.views:
+                data[META_KEY]["views"] = self._view_defs()
+            for name, table in self.tables.items():
+                data[name] = table.schema()
+                data[name]["rows"] = list(table.rows)
+            with open(tmp, "w") as f:
+                json.dump(data, f, indent=2, default=encode_row)
+                f.flush()
+                if self.sync:
+                    os.fsync(f.fileno())
+        else:
+            raise Exception(f"Unknown storage format {storage}")
+        metrics.wrote("snapshot_bytes", os.path.getsize(tmp))
+        os.replace(tmp, path)
+        counters["saves"] += 1
+        counters["save_ms"] += (time.perf_counter() - start) * 1000
+
+    # Save tables to disk
     def save(self):
-        data = {}
-        for name, table in self.tables.items():
-            data[name] = {
-                "columns": table.columns,
-                "types": table.types,
-                "primary_key": table.primary_key,
-                "unique": table.unique,
-                "rows": table.rows
-            }
-        with open(self.file, "w") as f:
-            json.dump(data, f, indent=2)
+        self.checkpoint()
 
     # Ensure default tables exist
     def _init_empty_tables(self):
@@ -209,11 +1662,31 @@ class Database:
                 name="orders",
                 columns=["id", "user_id", "amount"],
                 types={"id": "INT", "user_id": "INT", "amount": "INT"},
-                pk="id"
+                pk="id",
+                foreign_keys={"user_id": {
+                    "table": "users", "column": "id", "on_delete": "CASCADE"
+                }}
+            )
+        # the web app's join pages read these instead of joining
+        if "user_orders" not in self.views:
+            self.create_view(
+                "user_orders",
+                "SELECT * FROM users JOIN orders ON users.id = orders.user_id"
             )
+        if "user_orders_left" not in self.views:
+            self.create_view(
+                "user_orders_left",
+                "SELECT * FROM users LEFT JOIN orders ON users.id = orders.user_id"
+            )
+        for name, columns in SEARCH_COLUMNS.items():
+            table = self.table(name)
+            for col in columns:
+                if col not in table.text_indexes:
+                    table.create_index(col, using="trigram")
 
     # Create a new table
-    def create_table(self, name, columns, types, pk=None, unique=None):
+    def create_table(self, name, columns, types, pk=None, unique=None,
+                     foreign_keys=None):
         if name in self.tables:
             raise Exception(f"Table {name} already exists")
 
@@ -224,60 +1697,666 @@ class Database:
             pk=pk,
             unique=unique,
         )
+        for col, fk in (foreign_keys or {}).items():
+            if col not in columns:
+                raise Exception(f"Unknown column {col}")
+            table.foreign_keys[col] = _foreign_key(
+                self, table, col, fk["table"], fk["column"], fk.get("on_delete", "RESTRICT")
+            )
+            if not table._has_index(col):
+                table.secondary_indexes[col] = {}
         # link table to db
         table.set_database(self)
         self.tables[name] = table
         self.save()
 
-    # Access table by name
+    # Access table by name (a materialized view reads as its table)
     def table(self, name):
+        if name not in self.tables and name in self.views:
+            return self.views[name].table
         return self.tables[name]
 
+    def _all_tables(self):
+        yield from self.tables.values()
+        for view in self.views.values():
+            yield view.table
+
+    # -------------------------------
+    # Materialized views
+    # -------------------------------
+    def create_view(self, name, query):
+        """CREATE MATERIALIZED VIEW name AS query (see MaterializedView)."""
+        with self.lock:
+            if self._depth > 0:
+                raise Exception("Cannot create a view inside a transaction")
+            if name in self.tables or name in self.views:
+                raise Exception(f"Table {name} already exists")
+            self._add_view(MaterializedView(self, name, query))
+        self.save()
+
+    def _add_view(self, view):
+        view.build()
+        for base in view.bases:
+            base.views.append(view)
+        self.views[view.name] = view
+
+    def _view_defs(self):
+        # what a snapshot keeps of a view: its query and the indexes
+        # created on it
+        return {
+            name: {"query": view.query, "indexes": view.table.index_defs}
+            for name, view in self.views.items()
+        }
+
+    def join_view(self, left, right, left_key, right_key, how="inner"):
+        """A view holding this whole join (every column), or None."""
+        for view in self.views.values():
+            if (view.kind == "join" and view.left.name == left
+                    and view.right.name == right and view.left_key == left_key
+                    and view.right_key == right_key and view.how == how
+                    and len(view.columns) == len(view.left.columns) + len(view.right.columns)):
+                return view
+        return None
+
+    def references_to(self, name):
+        """(child table, column, foreign key) for each foreign key into table name."""
+        return [
+            (child, col, fk)
+            for child in self.tables.values()
+            for col, fk in child.foreign_keys.items()
+            if fk["table"] == name
+        ]
+
+    # -------------------------------
+    # Change detection
+    # -------------------------------
+    def refresh(self):
+        """Pick up changes made by other processes; cheap when there are none.
+
+        Returns True if anything was applied. A rewritten snapshot (another
+        process checkpointed) means a full reload; a grown log means only
+        the new records are replayed. Files are only stat'ed until a change
+        shows up, and a writer busy in this process is not waited for:
+        readers stay on their snapshot and pick the change up next time.
+        """
+        log_stamp = _stamp(self.log_file)
+        if (_stamp(self.file) == self._snapshot_stamp
+                and (log_stamp[1] if log_stamp else 0) == self._log_offset):
+            return False
+        if not self.lock.acquire(blocking=False):
+            return False
+        try:
+            if self._depth > 0:
+                # never mix other writers' changes into an open transaction
+                return False
+
+            if _stamp(self.file) != self._snapshot_stamp:
+                self._reload_all()
+                return True
+
+            log_stamp = _stamp(self.log_file)
+            size = log_stamp[1] if log_stamp else 0
+            if size < self._log_offset:
+                # log truncated under us by another process's checkpoint
+                self._reload_all()
+                return True
+            if size == self._log_offset:
+                return False
+
+            self._replay_log(skip_own=True)
+            return True
+        finally:
+            self.lock.release()
+
     def reload(self):
-        self.tables = {}
+        changed = self.refresh()
+        if changed:
+            counters["reloads"] += 1
+        return changed
+
+    def _reload_all(self):
+        # commits of this process still queued for group commit would
+        # vanish from memory: let them reach the log, which load replays
+        try:
+            self._wait_flushed(self._queued_seq)
+        except Exception:
+            pass  # they never reached the log, so they are gone anyway
+        self._close_log()
         self.load()
+
+
+class _ThreadSnapshot(threading.local):
+    ts = None  # timestamp of the thread's open db.snapshot() block
+
+
+def _stamp(path):
+    # (inode, size, mtime) identifies a version of a file without reading it
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def _foreign_key(database, table, col, parent_name, parent_col, on_delete):
+    # validated foreign key spec; the parent column must be unique so
+    # the check on insert is one index lookup
+    on_delete = on_delete.upper()
+    if on_delete == "NO ACTION":
+        on_delete = "RESTRICT"
+    if on_delete not in FK_ACTIONS:
+        raise Exception(f"Unknown ON DELETE action {on_delete}")
+    if parent_name == table.name:
+        parent = table
+    elif database and parent_name in database.tables:
+        parent = database.tables[parent_name]
+    else:
+        raise Exception(f"Unknown table {parent_name}")
+    if parent_col not in parent.indexes:
+        raise Exception(
+            f"{parent_name}.{parent_col} must be a primary key or UNIQUE to be referenced"
+        )
+    if on_delete == "SET NULL" and col == table.primary_key:
+        raise Exception(f"ON DELETE SET NULL on primary key {table.name}.{col}")
+    return {"table": parent_name, "column": parent_col, "on_delete": on_delete}
+
+
+def _replay_match(table, record):
+    for row in table.rows:
+        if row == record["match"]:
+            return row
+    raise Exception("Row not found")
+
+
 # -------------------------------
 # JOIN FUNCTIONS
 # -------------------------------
-def inner_join(left_table, right_table, left_key, right_key):
-    result = []
-    right_index = {}
-    for row in right_table.rows:
-        right_index.setdefault(row[right_key], []).append(row)
-
-    for lrow in left_table.rows:
-        matches = right_index.get(lrow[left_key])
-        if matches:
-            for rrow in matches:
-                merged = {f"user_{k}": v for k, v in lrow.items()}
-                merged.update({f"order_{k}": v for k, v in rrow.items()})
-                result.append(merged)
-    return result
+def join_prefix(table):
+    """Default column prefix for a table in join output: users -> user_."""
+    name = table.name
+    if len(name) > 1 and name.endswith("s"):
+        name = name[:-1]
+    return f"{name}_"
+
+
+def _joined_rows(pairs, left_table, right_table, prefixes=None):
+    # (left row, right row) pairs -> flat dicts with prefixed columns
+    if prefixes:
+        left_prefix, right_prefix = (f"{p}_" for p in prefixes)
+    else:
+        left_prefix, right_prefix = join_prefix(left_table), join_prefix(right_table)
+    if left_prefix == right_prefix:
+        raise Exception("Both sides of the join have the same column prefix")
+
+    left_names = [left_prefix + col for col in left_table.columns]
+    right_names = [right_prefix + col for col in right_table.columns]
+    no_match = dict.fromkeys(right_names)
+    for lrow, rrow in pairs:
+        merged = dict(zip(left_names, lrow.values()))
+        if rrow is None:
+            merged.update(no_match)
+        else:
+            merged.update(zip(right_names, rrow.values()))
+        yield merged
+
+
+def iter_join(left_table, right_table, left_key, right_key, how="inner",
+              after=None, prefixes=None):
+    """Stream a join in (left primary key, right primary key) order.
+
+    Rows are produced one at a time, so a caller that stops after a page
+    only pays for that page. after is the (left pk, right pk) cursor of
+    the last row already seen; right pk is None when that row was a
+    LEFT JOIN row with no match.
+    """
+    return _joined_rows(
+        _ordered_pairs(left_table, right_table, left_key, right_key, how, after),
+        left_table, right_table, prefixes
+    )
+
+
+def _ordered_pairs(left_table, right_table, left_key, right_key, how, after):
+    left_pk = left_table.primary_key
+    right_pk = right_table.primary_key
+    if left_pk is None:
+        raise Exception(f"Table {left_table.name} has no primary key to join in order")
 
+    with left_table.reading() as ts:
+        yield from _ordered_pairs_at(
+            left_table, right_table, left_key, right_key, how, after, ts
+        )
+
+
+def _ordered_pairs_at(left_table, right_table, left_key, right_key, how, after, ts):
+    left_pk = left_table.primary_key
+    right_pk = right_table.primary_key
+    start, start_right = after if after else (None, None)
+    probe = _probe(right_table, right_key, ts)
+    get_right_pk = right_table.getter(right_pk) if right_pk else None
 
-def left_join(left_table, right_table, left_key, right_key):
-    result = []
-    right_index = {}
-    for row in right_table.rows:
-        right_index.setdefault(row[right_key], []).append(row)
+    for lrow in left_table.range(left_pk, lo=start, ts=ts):
+        key = lrow[left_key]
+        matches = probe(key) if key is not None else []
+        if get_right_pk:
+            matches = sorted(matches, key=get_right_pk)
+
+        if after and lrow[left_pk] == start:
+            # resume inside this left row's matches
+            if start_right is None:
+                continue
+            matches = [m for m in matches if get_right_pk(m) > start_right]
+            if not matches:
+                continue
 
-    for lrow in left_table.rows:
-        matches = right_index.get(lrow[left_key])
         if matches:
             for rrow in matches:
-                merged = {f"user_{k}": v for k, v in lrow.items()}
-                merged.update({f"order_{k}": v for k, v in rrow.items()})
-                result.append(merged)
+                yield lrow, rrow
+        elif how == "left":
+            yield lrow, None
+
+
+def _probe(table, col, ts):
+    # lookup function value -> matching rows, through an index when the
+    # column has one, else through a hash table built once
+    if (col in table.indexes or col in table.secondary_indexes
+            or col in table.ordered_indexes):
+        return lambda value: table.find_all(col, value, ts)
+    by_value = {}
+    get = table.getter(col)
+    for row in table.scan(ts):
+        by_value.setdefault(get(row), []).append(row)
+    return lambda value: by_value.get(value, [])
+
+
+def inner_join(left_table, right_table, left_key, right_key, prefixes=None):
+    """Rows of both tables where left_key = right_key, as flat dicts.
+
+    Columns are prefixed with the singular table name (user_id,
+    order_amount, ...) unless prefixes=(left, right) is given. The
+    strategy (index nested loop, merge or hash join) comes from
+    plan_join.
+    """
+    plan = plan_join(left_table, right_table, left_key, right_key)
+    return list(_joined_rows(plan.pairs(), left_table, right_table, prefixes))
+
+
+def left_join(left_table, right_table, left_key, right_key, prefixes=None):
+    """Like inner_join, plus left rows without a match (right columns None)."""
+    plan = plan_join(left_table, right_table, left_key, right_key, how="left")
+    return list(_joined_rows(plan.pairs(), left_table, right_table, prefixes))
+
+
+# -------------------------------
+# MATERIALIZED VIEWS
+# -------------------------------
+class MaterializedView:
+    """Stored result of a JOIN, or of a GROUP BY over one table.
+
+    The rows live in a Table of their own (table), so reading a view is
+    reading a table: indexes, snapshots and rollback work as usual, and
+    no join or aggregation runs. Each change to a base table is applied
+    to the view in the same transaction: a join view drops and re-adds
+    the joined rows of the changed row only, an aggregate view
+    re-aggregates only the groups the change touches (read through an
+    index on the first GROUP BY column). Only the definition is saved;
+    the rows are rebuilt from the base tables at load, and base changes
+    replayed from the log keep them current.
+    """
+
+    def __init__(self, database, name, query):
+        self.database = database
+        self.name = name
+        self.query = query
+        # joined rows collected by apply_many, None otherwise
+        self._added = None
+
+        node, params = parse(query)
+        if not isinstance(node, Select):
+            raise Exception("A materialized view is defined by a SELECT")
+        if params:
+            raise Exception("A materialized view cannot have ? parameters")
+        if node.order_by is not None or node.limit is not None or node.offset:
+            raise Exception("ORDER BY / LIMIT apply when reading a view, not in its definition")
+
+        tables = database.tables
+        for base in (node.table, node.join and node.join.table):
+            if base and base not in tables:
+                raise Exception(f"Unknown table {base}")
+        if node.join and not node.grouped:
+            self._define_join(node, tables[node.table], tables[node.join.table])
+        elif node.grouped and not node.join:
+            self._define_aggregate(node, tables[node.table])
         else:
-            nulls = {k: None for k in right_table.columns}
-            merged = {f"user_{k}": v for k, v in lrow.items()}
-            merged.update({f"order_{k}": v for k, v in nulls.items()})
-            result.append(merged)
-    return result
+            raise Exception(
+                "A materialized view is a JOIN or a GROUP BY over one table"
+            )
+        self.table.view = self
+        self.table.set_database(database)
+
+    # ---------- definition ----------
+    def _define_join(self, node, left, right):
+        if node.where is not None:
+            raise Exception("WHERE is not supported on JOIN")
+        if left is right:
+            raise Exception("A materialized view cannot join a table to itself")
+        if not left.primary_key or not right.primary_key:
+            raise Exception("Both tables of a join view need a primary key")
+        self.kind = "join"
+        self.bases = [left, right]
+        self.left, self.right = left, right
+        self.left_key, self.right_key = node.join.left_key, node.join.right_key
+        self.how = "left" if node.join.kind == "LEFT" else "inner"
+
+        # view rows are found by the primary keys of the rows they join
+        left_prefix, right_prefix = join_prefix(left), join_prefix(right)
+        self.left_id = left_prefix + left.primary_key
+        self.right_id = right_prefix + right.primary_key
+        types = {left_prefix + col: left.types[col] for col in left.columns}
+        types.update((right_prefix + col, right.types[col]) for col in right.columns)
+        columns = node.columns or list(types)
+        for col in columns:
+            if col not in types:
+                raise Exception(f"Unknown column {col}")
+        # where each view column comes from: (from the left row?, column)
+        sources = {left_prefix + col: (True, col) for col in left.columns}
+        sources.update((right_prefix + col, (False, col)) for col in right.columns)
+        self.picks = [sources[col] for col in columns]
+        for col in (self.left_id, self.right_id):
+            if col not in columns:
+                raise Exception(f"A join view must select {self.left_id} and {self.right_id}")
+        self.columns = columns
+
+        table = self.table = Table(self.name, columns, {c: types[c] for c in columns})
+        table.secondary_indexes[self.left_id] = {}
+        table.secondary_indexes[self.right_id] = {}
+        table.ordered_indexes[self.left_id] = SortedIndex()
+        _view_index(left, self.left_key)
+        _view_index(right, self.right_key)
+
+    def _define_aggregate(self, node, base):
+        spec = grouping(node, table=base)
+        group_by = spec["group_by"]
+        if not group_by:
+            raise Exception("An aggregate view needs GROUP BY")
+        for col in group_by:
+            if col not in spec["columns"]:
+                raise Exception(f"An aggregate view must select its GROUP BY column {col}")
+        self.kind = "aggregate"
+        self.bases = [base]
+        self.base = base
+        self.where = bind(node.where)
+        self.spec = {k: spec[k] for k in ("group_by", "aggregates", "having", "columns")}
+        self.group_by = group_by
+        self.columns = spec["columns"]
+        # base columns whose change can change the view
+        self.inputs = set(group_by) | _predicate_columns(self.where)
+        self.inputs.update(col for _, _, col in spec["aggregates"] if col is not None)
+        self.foldable = spec["having"] is None and all(
+            func != "AVG" for _, func, _ in spec["aggregates"]
+        )
+
+        types = {}
+        for name, func, col in spec["aggregates"]:
+            if func == "COUNT":
+                types[name] = "INT"
+            elif func == "AVG":
+                types[name] = "FLOAT"
+            else:
+                types[name] = base.types[col]
+        types.update((col, base.types[col]) for col in group_by)
+
+        table = self.table = Table(self.name, self.columns, {c: types[c] for c in self.columns})
+        table.secondary_indexes[group_by[0]] = {}
+        table.ordered_indexes[group_by[0]] = SortedIndex()
+        _view_index(base, group_by[0])
+
+    def build(self):
+        """Fill the view from its base tables (at load and on creation)."""
+        if self.kind == "join":
+            plan = plan_join(self.left, self.right, self.left_key, self.right_key, self.how)
+            rows = self._project(_joined_rows(plan.pairs(), self.left, self.right))
+        else:
+            rows = plan_aggregate(self.base, self.where, **self.spec).rows()
+        table = self.table
+        table.rows = RowStore(table.row_type(row) for row in rows)
+        table._rebuild_indexes()
+
+    def _project(self, rows):
+        columns = self.columns
+        return ({col: row[col] for col in columns} for row in rows)
+
+    # ---------- maintenance ----------
+    def apply(self, base, old, new):
+        """Apply one change of a base row: old and new are its versions
+        before and after (None for an insert / a delete). Called by the
+        base table inside the change's transaction, after the change."""
+        if self.kind == "aggregate":
+            old_in = old is not None and self._selected(old)
+            new_in = new is not None and self._selected(new)
+            if old_in and new_in and all(old[col] == new[col] for col in self.inputs):
+                return
+            # a row leaving a group re-aggregates it (its MIN may go);
+            # a row joining one is folded into the group's row
+            keys = [self._group_key(old)] if old_in else []
+            if new_in:
+                key = self._group_key(new)
+                if key not in keys and not self._fold(key, new):
+                    keys.append(key)
+            for key in keys:
+                self._regroup(key)
+            return
+
+        if base is self.left:
+            if old is not None:
+                self._drop_left(old)
+            if new is not None:
+                self._add_left(new)
+        else:
+            if old is not None:
+                self._drop_right(old)
+            if new is not None:
+                self._add_right(new)
+
+    def apply_many(self, base, rows):
+        """apply() of rows just inserted into base (insert_many)."""
+        if self.kind == "aggregate":
+            if self.foldable:
+                for row in rows:
+                    self.apply(base, None, row)
+                return
+            # re-aggregate each touched group once, not once per row
+            keys = dict.fromkeys(self._group_key(row) for row in rows if self._selected(row))
+            for key in keys:
+                self._regroup(key)
+            return
+        # the joined rows are collected and added together; a left
+        # join's NULL-extended row is still dropped on the first match
+        self._added = []
+        try:
+            for row in rows:
+                self.apply(base, None, row)
+            added = self._added
+        finally:
+            self._added = None
+        self.table._append_many(added)
+
+    def _add(self, lrow, rrow):
+        values = [
+            lrow[col] if from_left else None if rrow is None else rrow[col]
+            for from_left, col in self.picks
+        ]
+        row = self.table.row_type.from_values(values)
+        if self._added is None:
+            self.table._insert_derived(row)
+        else:
+            self._added.append(row)
+
+    def _drop_left(self, lrow):
+        table = self.table
+        for row in table.find_all(self.left_id, lrow[self.left.primary_key]):
+            table._delete_row(row)
+
+    def _add_left(self, lrow):
+        key = lrow[self.left_key]
+        matches = [] if key is None else self.right.find_all(self.right_key, key)
+        for rrow in matches:
+            self._add(lrow, rrow)
+        if not matches and self.how == "left":
+            self._add(lrow, None)
+
+    def _drop_right(self, rrow):
+        table = self.table
+        for row in table.find_all(self.right_id, rrow[self.right.primary_key]):
+            table._delete_row(row)
+            if self.how == "left" and self._first(self.left_id, row[self.left_id]) is None:
+                # the left row lost its last match: it is back with NULLs
+                lrow = self.left.find(self.left.primary_key, row[self.left_id])
+                if lrow is not None:
+                    self._add(lrow, None)
+
+    def _add_right(self, rrow):
+        key = rrow[self.right_key]
+        if key is None:
+            return
+        for lrow in self.left.find_all(self.left_key, key):
+            if self.how == "left":
+                # a NULL-extended row is the only row of its left row
+                row = self._first(self.left_id, lrow[self.left.primary_key])
+                if row is not None and row[self.right_id] is None:
+                    self.table._delete_row(row)
+            self._add(lrow, rrow)
+
+    def _first(self, col, value):
+        # any current view row with col == value; unlike find_all this
+        # stops at the first, so it stays O(1) for a left row with many
+        # matches
+        table = self.table
+        get = table.getter(col)
+        for rid in table.secondary_indexes[col].get(value, ()):
+            row = table.rows.version(rid)
+            if row is not None and get(row) == value:
+                return row
+        return None
+
+    def _selected(self, row):
+        return self.where is None or self.where.matches(row)
+
+    def _group_key(self, row):
+        return tuple(row[col] for col in self.group_by)
+
+    def _insert(self, row):
+        self.table._insert_derived(self.table.row_type(row))
+
+    def _view_row(self, key):
+        first = self.group_by[0]
+        return next(
+            (row for row in self.table.find_all(first, key[0]) if self._group_key(row) == key),
+            None
+        )
+
+    def _fold(self, key, row):
+        # add one row to its group's view row; False when that cannot be
+        # done from the view row alone (AVG, HAVING)
+        if not self.foldable:
+            return False
+        current = self._view_row(key)
+        if current is None:
+            self._insert(next(aggregate_rows([row], **self.spec).rows()))
+            return True
+        changed = {}
+        for name, func, col in self.spec["aggregates"]:
+            value = 1 if col is None else row[col]
+            if value is None:
+                continue
+            total = current[name]
+            if func == "COUNT":
+                total += 1
+            elif total is None:
+                total = value
+            elif func == "SUM":
+                total += value
+            elif func == "MIN":
+                total = min(total, value)
+            else:
+                total = max(total, value)
+            if total != current[name]:
+                changed[name] = total
+        if changed:
+            self.table._update_row(current, changed)
+        return True
+
+    def _regroup(self, key):
+        # aggregate the group again from its base rows and replace the
+        # view's row for it
+        first = self.group_by[0]
+        rows = [
+            row for row in self.base.find_all(first, key[0])
+            if self._group_key(row) == key and self._selected(row)
+        ]
+        fresh = next(aggregate_rows(rows, **self.spec).rows(), None) if rows else None
+
+        table = self.table
+        current = self._view_row(key)
+        if current is None:
+            if fresh is not None:
+                self._insert(fresh)
+        elif fresh is None:
+            table._delete_row(current)
+        else:
+            changed = {col: v for col, v in fresh.items() if current[col] != v}
+            if changed:
+                table._update_row(current, changed)
+
+    # ---------- reads ----------
+    def joined(self, after=None, search=None, columns=None, ts=None):
+        """Rows of a join view in (left pk, right pk) order, resuming
+        after a cursor as iter_join does; with search, only rows where
+        it occurs in one of columns (see Table.search)."""
+        if ts is None:
+            yield from self.table._snapshot_read(self.joined, after, search, columns)
+            return
+        table = self.table
+        start, start_right = after if after else (None, None)
+        get_left = table.getter(self.left_id)
+        get_right = table.getter(self.right_id)
+        order = lambda row: (get_right(row) is not None, get_right(row))
+        if search:
+            # matches come out of the index unordered: sort just them
+            position = lambda row: (get_left(row), *order(row))
+            rows = sorted(table.search(search, columns, ts=ts), key=position)
+            if after:
+                cursor = (start, start_right is not None, start_right)
+                rows = [row for row in rows if position(row) > cursor]
+            yield from rows
+            return
+        runs = itertools.groupby(table.range(self.left_id, lo=start, ts=ts), key=get_left)
+        for left_id, rows in runs:
+            rows = sorted(rows, key=order)
+            if after and left_id == start:
+                if start_right is None:
+                    continue
+                rows = [r for r in rows if get_right(r) is not None and get_right(r) > start_right]
+            yield from rows
+
+
+def _predicate_columns(predicate):
+    if predicate is None:
+        return set()
+    if hasattr(predicate, "items"):
+        return set().union(*map(_predicate_columns, predicate.items))
+    return {predicate.col}
+
+
+def _view_index(table, col):
+    # a view looks base rows up by col on every change; without an
+    # index that would be a scan each time
+    if not table._has_index(col):
+        table._build_index(col, "hash")
+        table.schema_version = next(_schema_versions)
 
 
 # -------------------------------
 # GLOBAL DATABASE INSTANCE
 # -------------------------------
-db = Database(DB_FILE)
+db = Database(PAGED_DB_FILE if os.path.exists(PAGED_DB_FILE) else DB_FILE)
 
@@ -0,0 +1,162 @@
+"""EXPLAIN and EXPLAIN ANALYZE.
+
+    EXPLAIN SELECT * FROM orders WHERE user_id = 3 ORDER BY amount
+    EXPLAIN ANALYZE UPDATE orders SET amount = 0 WHERE amount > 900
+
+EXPLAIN shows the plan (main/planner.py) a statement would run, one
+line per node with the planner's row estimate; a node's inputs are
+indented under it, so the access path (FullScan, IndexLookup,
+RangeScan, TextSearch, VectorScan) is at the bottom. Nothing is run.
+
+EXPLAIN ANALYZE runs the statement (its changes are made, as without
+EXPLAIN) and adds to each node what it did:
+
+    rows      rows it produced
+    examined  rows an access path read from the table, before its filter
+    time      milliseconds spent producing its rows, its inputs included
+
+then the statement's total rows (returned, or changed) and time, and
+what it added to the engine counters (main/metrics.py): full scans,
+index lookups, bytes written, ... A node that was never asked for rows
+(the row at a time fallback of a VectorAggregate, usually) says so.
+
+sql.explain() returns the same as data; the EXPLAIN statement returns
+it as text.
+"""
+import time
+
+
+class NodeStats:
+    """What one plan node did under EXPLAIN ANALYZE."""
+
+    def __init__(self):
+        self.loops = 0            # times its rows were asked for
+        self.rows = 0
+        self.examined = None      # access paths only
+        self.seconds = 0.0
+
+    def examine(self, rows):
+        self.examined = self.examined or 0
+        for row in rows:
+            self.examined += 1
+            yield row
+
+
+def inputs(node):
+    """The plan nodes node reads from."""
+    children = getattr(node, "children", None)
+    if children is not None:
+        return children
+    child = getattr(node, "child", None) or getattr(node, "fallback", None)
+    return [] if child is None else [child]
+
+
+def instrument(plan):
+    """Give every node of plan stats and time its rows (or join pairs)."""
+    for node in _walk(plan):
+        node.stats = NodeStats()
+        name = "pairs" if hasattr(node, "pairs") else "rows"
+        setattr(node, name, _timed(node.stats, getattr(node, name)))
+
+
+def _walk(node):
+    yield node
+    for child in inputs(node):
+        yield from _walk(child)
+
+
+def _timed(stats, rows):
+    # rows() of a node, with the time spent in each next() added up
+    def timed():
+        clock = time.perf_counter
+        stats.loops += 1
+        start = clock()
+        it = iter(rows())
+        stats.seconds += clock() - start
+        while True:
+            start = clock()
+            try:
+                row = next(it)
+            except StopIteration:
+                return
+            finally:
+                stats.seconds += clock() - start
+            stats.rows += 1
+            yield row
+    return timed
+
+
+# -------------------------------
+# Report
+# -------------------------------
+def nodes(plan, depth=0):
+    """The lines of plan as dicts, depth first."""
+    line = {"depth": depth, "node": plan.describe()}
+    if hasattr(plan, "estimate"):
+        line["estimate"] = plan.estimate
+    elif hasattr(plan, "cost"):
+        line["cost"] = plan.cost
+    stats = getattr(plan, "stats", None)
+    if stats is not None:
+        line["executed"] = stats.loops > 0
+        line["rows"] = stats.rows
+        if stats.examined is not None:
+            line["examined"] = stats.examined
+        line["ms"] = round(stats.seconds * 1000, 3)
+    lines = [line]
+    for child in inputs(plan):
+        lines.extend(nodes(child, depth + 1))
+    return lines
+
+
+def report(plans, heading=None, seconds=None, rows=None, counters=None):
+    """EXPLAIN's result as data: {"plan": [node lines]}, plus the
+    statement's rows, ms and counter increments under ANALYZE. heading
+    is a line of its own above the plans (the UPDATE or DELETE that
+    consumes them); it gets the statement's rows and time."""
+    depth = 0
+    lines = []
+    if heading is not None:
+        line = {"depth": 0, "node": heading}
+        if seconds is not None:
+            line.update(executed=True, rows=rows, ms=round(seconds * 1000, 3))
+        lines.append(line)
+        depth = 1
+    for plan in plans:
+        lines.extend(nodes(plan, depth))
+    result = {"plan": lines}
+    if seconds is not None:
+        result["rows"] = rows
+        result["ms"] = round(seconds * 1000, 3)
+        result["counters"] = counters or {}
+    return result
+
+
+def render(result):
+    """EXPLAIN's result as text, one line per node."""
+    out = []
+    for line in result["plan"]:
+        depth = line["depth"]
+        text = "  " * depth + ("-> " if depth else "") + line["node"]
+        if "estimate" in line:
+            text += f"  (estimate {line['estimate']})"
+        elif "cost" in line:
+            text += f"  (cost {line['cost']})"
+        if "executed" in line:
+            if not line["executed"]:
+                text += "  (never executed)"
+            else:
+                parts = [f"rows {line['rows']}"]
+                if "examined" in line:
+                    parts.append(f"examined {line['examined']}")
+                parts.append(f"time {line['ms']:.3f} ms")
+                text += "  (" + ", ".join(parts) + ")"
+        out.append(text)
+    if "ms" in result:
+        rows = "-" if result["rows"] is None else result["rows"]
+        out.append(f"Execution: {rows} rows in {result['ms']:.3f} ms")
+        if result["counters"]:
+            out.append("Counters: " + ", ".join(
+                f"{name} {value}" for name, value in result["counters"].items()
+            ))
+    return "\n".join(out)
@@ -0,0 +1,357 @@
+import time
+from bisect import bisect_left, bisect_right
+
+# Entries copied per consistent read by SortedIndex.items()
+READ_BLOCK = 256
+
+# SortedIndex.add_many() merges when it adds at least 1/MERGE_RATIO as
+# many entries as the index holds, else it inserts them one by one
+MERGE_RATIO = 4096
+
+
+# -------------------------------
+# Sorted Index
+# -------------------------------
+class SortedIndex:
+    """Ordered index kept as two parallel sorted arrays (keys, row ids).
+
+    Lookups and range bounds are binary searches; inserting at the end
+    (the usual case for increasing ids) is O(1), anywhere else it is a
+    single memmove of the arrays. Rows whose key is None are kept aside
+    and come first in ascending order.
+
+    Readers take no lock. Writers bump version before and after each
+    change (odd while one is under way), so a reader that copied some
+    entries can tell whether they were consistent and, if not, read
+    them again.
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.ids = []
+        self.nulls = []
+        self.version = 0
+
+    def __len__(self):
+        return len(self.keys) + len(self.nulls)
+
+    def add(self, key, rid):
+        if key is None:
+            self.nulls.append(rid)
+            return
+        # rows sharing a key are kept in row id order, so remove() can
+        # binary-search them too
+        start = bisect_left(self.keys, key)
+        end = bisect_right(self.keys, key, start)
+        i = bisect_right(self.ids, rid, start, end) if start < end else end
+        self.version += 1
+        self.keys.insert(i, key)
+        self.ids.insert(i, rid)
+        self.version += 1
+
+    def remove(self, key, rid):
+        if key is None:
+            if rid in self.nulls:
+                self.nulls.remove(rid)
+            return
+        start = bisect_left(self.keys, key)
+        end = bisect_right(self.keys, key, start)
+        i = bisect_left(self.ids, rid, start, end)
+        if i == end or self.ids[i] != rid:
+            return
+        self.version += 1
+        del self.keys[i]
+        del self.ids[i]
+        self.version += 1
+
+    def add_many(self, items):
+        """add() of many (key, rid) pairs: sorted once and merged with
+        the entries, rather than a memmove of the arrays per entry."""
+        items = list(items)
+        pairs = sorted(pair for pair in items if pair[0] is not None)
+        nulls = [rid for key, rid in items if key is None]
+        keys, ids = self.keys, self.ids
+        if not (pairs and keys and pairs[0] < (keys[-1], ids[-1])):
+            # all past the last entry (increasing ids): append
+            self.version += 1
+            keys.extend(key for key, _ in pairs)
+            ids.extend(rid for _, rid in pairs)
+            self.version += 1
+        elif len(pairs) * MERGE_RATIO < len(keys):
+            # a few entries into a large index
+            for key, rid in pairs:
+                self.add(key, rid)
+        else:
+            # a sort of two sorted runs is a linear merge
+            merged = list(zip(keys, ids))
+            merged.extend(pairs)
+            merged.sort()
+            self.version += 1
+            self.keys = [key for key, _ in merged]
+            self.ids = [rid for _, rid in merged]
+            self.version += 1
+        self.nulls.extend(nulls)
+
+    def build(self, items):
+        """Replace the contents with (key, rid) pairs in one sort."""
+        items = list(items)
+        pairs = sorted(pair for pair in items if pair[0] is not None)
+        self.version += 1
+        self.nulls = [rid for key, rid in items if key is None]
+        self.keys = [key for key, _ in pairs]
+        self.ids = [rid for _, rid in pairs]
+        self.version += 1
+
+    def clear(self):
+        self.version += 1
+        self.keys = []
+        self.ids = []
+        self.nulls = []
+        self.version += 1
+
+    def _bounds(self, lo, hi, lo_inclusive, hi_inclusive):
+        if lo is None:
+            start = 0
+        elif lo_inclusive:
+            start = bisect_left(self.keys, lo)
+        else:
+            start = bisect_right(self.keys, lo)
+
+        if hi is None:
+            end = len(self.keys)
+        elif hi_inclusive:
+            end = bisect_right(self.keys, hi)
+        else:
+            end = bisect_left(self.keys, hi)
+        return start, end
+
+    def count(self, lo=None, hi=None, lo_inclusive=True, hi_inclusive=True):
+        """Number of rows in the range, in O(log n)."""
+        start, end = self._bounds(lo, hi, lo_inclusive, hi_inclusive)
+        return max(0, end - start)
+
+    def range(self, lo=None, hi=None, lo_inclusive=True, hi_inclusive=True,
+              reverse=False):
+        """Yield row ids with lo <= key <= hi in key order (None = unbounded)."""
+        start, end = self._bounds(lo, hi, lo_inclusive, hi_inclusive)
+        if reverse:
+            for i in range(end - 1, start - 1, -1):
+                yield self.ids[i]
+        else:
+            for i in range(start, end):
+                yield self.ids[i]
+
+    def items(self, lo=None, hi=None, lo_inclusive=True, hi_inclusive=True,
+              reverse=False):
+        """Yield (key, row id) with lo <= key <= hi in key order; safe
+        while another thread changes the index (see blocks())."""
+        for keys, ids in self.blocks(lo, hi, lo_inclusive, hi_inclusive, reverse):
+            yield from zip(keys, ids)
+
+    def blocks(self, lo=None, hi=None, lo_inclusive=True, hi_inclusive=True,
+               reverse=False):
+        """Yield the range as (keys, row ids) lists of up to READ_BLOCK
+        entries, in key order.
+
+        Each block is copied consistently, so readers need no lock. If
+        the index changed between two blocks the walk finds its place
+        again by the last key it yielded, leaving out row ids already
+        yielded under that key.
+        """
+        last = None       # last key yielded
+        seen = set()      # row ids yielded under last
+        pos = None        # where the next block starts, while version holds
+        read_version = None
+        while True:
+            resumed = False
+            while True:
+                version = self.version
+                if version & 1:
+                    time.sleep(0)  # a writer is mid-change: let it finish
+                    continue
+                keys = self.keys
+                start, end = self._bounds(lo, hi, lo_inclusive, hi_inclusive)
+                size = READ_BLOCK
+                if pos is not None and version == read_version:
+                    if reverse:
+                        end = pos
+                    else:
+                        start = pos
+                elif last is not None:
+                    # back to the first entry under last
+                    if reverse:
+                        end = bisect_right(keys, last, start, end)
+                    else:
+                        start = bisect_left(keys, last, start, end)
+                    size += len(seen)
+                    resumed = True
+                if reverse:
+                    first = max(start, end - size)
+                    block_keys, block_ids = keys[first:end], self.ids[first:end]
+                    pos, done = first, first == start
+                else:
+                    stop = min(end, start + size)
+                    block_keys, block_ids = keys[start:stop], self.ids[start:stop]
+                    pos, done = stop, stop == end
+                if self.version == version:
+                    break
+                pos = None
+            read_version = version
+            if reverse:
+                block_keys.reverse()
+                block_ids.reverse()
+
+            if resumed:
+                keep = [
+                    i for i, (key, rid) in enumerate(zip(block_keys, block_ids))
+                    if key != last or rid not in seen
+                ]
+                block_keys = [block_keys[i] for i in keep]
+                block_ids = [block_ids[i] for i in keep]
+            if block_keys:
+                if block_keys[-1] != last:
+                    last = block_keys[-1]
+                    seen = set()
+                i = len(block_keys)
+                while i and block_keys[i - 1] == last:
+                    i -= 1
+                    seen.add(block_ids[i])
+                yield block_keys, block_ids
+            if done:
+                return
+
+    def ordered(self, reverse=False):
+        """Yield every row id in key order, NULL keys first (last if reversed)."""
+        if not reverse:
+            yield from self.nulls
+        yield from self.range(reverse=reverse)
+        if reverse:
+            yield from reversed(self.nulls)
+
+
+# -------------------------------
+# Trigram Index
+# -------------------------------
+GRAM = 3
+
+
+def text_key(value):
+    """What a text index and LIKE / CONTAINS match against."""
+    return str(value).lower()
+
+
+def grams(text):
+    return {text[i:i + GRAM] for i in range(len(text) - GRAM + 1)}
+
+
+class TrigramIndex:
+    """Inverted index of the 3-character substrings of each value (as
+    text_key(value)), for substring search.
+
+    A search for a text of 3 characters or more intersects the row ids
+    of its trigrams, smallest first, so it costs about as much as the
+    rarest trigram has rows, not as much as the table. A shorter text is
+    looked up among the distinct trigrams that contain it. The result
+    is a superset: callers check each row. NULLs are not indexed.
+
+    Like the hash indexes, searches copy each row id set in one C call,
+    so they need no lock while a writer changes the index.
+    """
+
+    def __init__(self):
+        self.grams = {}       # trigram -> {row ids}
+        self.short = {}       # text shorter than a trigram -> {row ids}
+
+    def add(self, value, rid):
+        if value is None:
+            return
+        text = str(value).lower()
+        if len(text) < GRAM:
+            self.short.setdefault(text, set()).add(rid)
+            return
+        index = self.grams
+        for i in range(len(text) - GRAM + 1):
+            gram = text[i:i + GRAM]
+            bucket = index.get(gram)
+            if bucket is None:
+                index[gram] = {rid}
+            else:
+                bucket.add(rid)
+
+    def remove(self, value, rid, keep=()):
+        # keep: other values of the same row still indexed under rid
+        if value is None:
+            return
+        text = text_key(value)
+        if len(text) < GRAM:
+            index, dropped = self.short, {text}
+        else:
+            index, dropped = self.grams, grams(text)
+        for other in keep:
+            if other is not None:
+                other = text_key(other)
+                dropped.discard(other)
+                dropped -= grams(other)
+        for gram in dropped:
+            bucket = index.get(gram)
+            if bucket is None:
+                continue
+            bucket.discard(rid)
+            if not bucket:
+                del index[gram]
+
+    def add_many(self, items):
+        """add() of many (value, rid) pairs, splitting each distinct
+        value into trigrams once."""
+        by_value = {}
+        for value, rid in items:
+            rids = by_value.get(value)
+            if rids is None:
+                by_value[value] = [rid]
+            else:
+                rids.append(rid)
+        by_value.pop(None, None)
+        for value, rids in by_value.items():
+            text = text_key(value)
+            if len(text) < GRAM:
+                self.short.setdefault(text, set()).update(rids)
+                continue
+            index = self.grams
+            for gram in grams(text):
+                bucket = index.get(gram)
+                if bucket is None:
+                    index[gram] = set(rids)
+                else:
+                    bucket.update(rids)
+
+    def build(self, items):
+        self.clear()
+        self.add_many(items)
+
+    def clear(self):
+        self.grams = {}
+        self.short = {}
+
+    def search(self, text):
+        """Row ids of every value that may contain text."""
+        text = text_key(text)
+        if len(text) >= GRAM:
+            index = self.grams
+            buckets = [index.get(gram) for gram in grams(text)]
+            if any(bucket is None for bucket in buckets):
+                return set()
+            buckets.sort(key=len)
+            return buckets[0].intersection(*buckets[1:])
+        # a short text is in a value iff it is in one of its trigrams
+        # (or in the value itself, for a short value)
+        found = set()
+        for index in (self.grams, self.short):
+            found.update(*(index.get(key, ()) for key in list(index) if text in key))
+        return found
+
+    def estimate(self, text):
+        """Upper bound of len(search(text)), without building it."""
+        text = text_key(text)
+        if len(text) >= GRAM:
+            return min((len(self.grams.get(gram, ())) for gram in grams(text)), default=0)
+        return len(self.search(text))
@@ -0,0 +1,108 @@
+"""COPY: stream the rows of a CSV or JSON Lines file into a table.
+
+    COPY orders FROM 'orders.csv' HEADER
+    COPY orders (id, user_id, amount) FROM 'orders.jsonl'
+
+The file is read lazily and its rows go through Table.insert_many, so a
+load is validated and applied in batches inside one transaction and
+committed (logged and flushed) once, however large the file.
+
+CSV: fields are in the order of the column list, else of the table;
+with HEADER the first line names them instead. An empty field is NULL,
+and INT columns are parsed as integers.
+
+JSON Lines: one JSON object per line, keyed by column (with a column
+list, only those keys are read), or one array of values per line, in
+column list or table order. Blank lines are skipped.
+"""
+import csv
+import json
+import os
+
+# File extensions COPY recognises when no FORMAT is given
+FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl"}
+
+
+def copy_from(table, path, columns=None, format=None, header=False):
+    """Insert every row of the file at path into table; returns how many."""
+    return table.insert_many(read_rows(table, path, columns, format, header))
+
+
+def read_rows(table, path, columns=None, format=None, header=False):
+    """Yield the rows of a CSV or JSON Lines file as dicts, one at a time."""
+    if format is None:
+        format = FORMATS.get(os.path.splitext(path)[1].lower())
+        if format is None:
+            raise Exception(f"Unknown file type for {path}: give FORMAT CSV or JSONL")
+    if not os.path.exists(path):
+        raise Exception(f"No such file: {path}")
+    if format == "csv":
+        return _csv_rows(table, path, columns, header)
+    return _jsonl_rows(table, path, columns)
+
+
+def _csv_rows(table, path, columns, header):
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        if header:
+            names = next(reader, None) or []
+            if columns is None:
+                columns = [name.strip() for name in names]
+        columns = columns or table.columns
+        _check_columns(table, columns)
+        ints = [table.types[col] == "INT" for col in columns]
+        for fields in reader:
+            if not fields:
+                continue
+            if len(fields) != len(columns):
+                raise Exception(
+                    f"{path} line {reader.line_num}: expected {len(columns)} "
+                    f"fields, found {len(fields)}"
+                )
+            row = {}
+            for col, is_int, field in zip(columns, ints, fields):
+                if field == "":
+                    row[col] = None
+                elif is_int:
+                    try:
+                        row[col] = int(field)
+                    except ValueError:
+                        raise Exception(
+                            f"{path} line {reader.line_num}: {col} must be INT"
+                        ) from None
+                else:
+                    row[col] = field
+            yield row
+
+
+def _jsonl_rows(table, path, columns):
+    if columns is not None:
+        _check_columns(table, columns)
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                value = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise Exception(f"{path} line {number}: {e.msg}") from None
+            if isinstance(value, dict):
+                if columns is not None:
+                    value = {col: value.get(col) for col in columns}
+                yield value
+            elif isinstance(value, list):
+                names = columns or table.columns
+                if len(value) != len(names):
+                    raise Exception(
+                        f"{path} line {number}: expected {len(names)} values, "
+                        f"found {len(value)}"
+                    )
+                yield dict(zip(names, value))
+            else:
+                raise Exception(f"{path} line {number}: expected an object or an array")
+
+
+def _check_columns(table, columns):
+    for col in columns:
+        if col not in table.types:
+            raise Exception(f"Unknown column {col} in {table.name}")
@@ -0,0 +1,129 @@
+"""Engine-wide counters and the slow query log.
+
+Counters are kept per process: with a database server (main/server.py)
+they are the server's, and clients read them with the "metrics" call
+(the web app serves them at /api/metrics/). Each is one number bumped
+once per operation, not per row, so keeping them costs next to
+nothing:
+
+    queries            statements run through sql.execute / execute_many
+    query_ms           their total time, in milliseconds
+    slow_queries       statements slower than the slow query threshold
+    scans              full table scans
+    index_lookups      equality lookups answered by an index
+    range_scans        reads of a sorted index range (or all of it)
+    text_searches      searches answered by trigram indexes
+    vector_scans       predicates and aggregates run on NumPy arrays
+    rows_inserted / rows_updated / rows_deleted
+    commits            transactions written to the log
+    log_bytes          bytes appended to the write-ahead log
+    saves              snapshots written (checkpoints)
+    save_ms            their total time, in milliseconds
+    snapshot_bytes     bytes of snapshot written
+    bytes_written      log_bytes + snapshot_bytes
+    reloads            reloads that found changes from another process
+
+Statements that take longer than metrics.slow_query_seconds (0.5 s, or
+$MINIRDBMS_SLOW_QUERY_MS; None turns the log off) are logged as a
+warning on the "main.slow_query" logger, with their parameters, time
+and rows, and the last SLOW_QUERY_KEEP of them are kept for
+metrics.snapshot().
+"""
+import logging
+import os
+import time
+from collections import deque
+
+SLOW_QUERY_ENV = "MINIRDBMS_SLOW_QUERY_MS"
+
+# Statements slower than this (seconds) go to the slow query log
+SLOW_QUERY_SECONDS = 0.5
+
+# Slow queries kept in memory for snapshot()
+SLOW_QUERY_KEEP = 100
+
+COUNTERS = (
+    "queries", "query_ms", "slow_queries",
+    "scans", "index_lookups", "range_scans", "text_searches", "vector_scans",
+    "rows_inserted", "rows_updated", "rows_deleted",
+    "commits", "log_bytes", "saves", "save_ms", "snapshot_bytes", "bytes_written",
+    "reloads",
+)
+
+logger = logging.getLogger("main.slow_query")
+
+
+def _threshold():
+    value = os.environ.get(SLOW_QUERY_ENV)
+    if value is None:
+        return SLOW_QUERY_SECONDS
+    if value.lower() in ("", "off", "none"):
+        return None
+    return float(value) / 1000
+
+
+class Metrics:
+    """The counters (a dict, updated in place) and recent slow queries."""
+
+    def __init__(self):
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.slow_query_seconds = _threshold()
+        self.slow = deque(maxlen=SLOW_QUERY_KEEP)
+        self.since = time.time()
+
+    def query(self, query, params, seconds, rows=None):
+        """Account for one statement; logs it if it was slow."""
+        counters = self.counters
+        counters["queries"] += 1
+        counters["query_ms"] += seconds * 1000
+        threshold = self.slow_query_seconds
+        if threshold is None or seconds < threshold:
+            return
+        counters["slow_queries"] += 1
+        entry = {
+            "query": query,
+            "params": list(params),
+            "ms": round(seconds * 1000, 3),
+            "rows": rows,
+            "at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        self.slow.append(entry)
+        logger.warning(
+            "slow query (%.1f ms, %s rows): %s %s",
+            entry["ms"], "-" if rows is None else rows, query, entry["params"] or "",
+        )
+
+    def wrote(self, counter, size):
+        # bytes written to the log or a snapshot
+        self.counters[counter] += size
+        self.counters["bytes_written"] += size
+
+    def snapshot(self, database=None):
+        """Counters, recent slow queries and (paged storage) buffer pool
+        statistics, as plain JSON-able values."""
+        result = {
+            "since": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.since)),
+            "counters": {
+                name: round(value, 3) if isinstance(value, float) else value
+                for name, value in self.counters.items()
+            },
+            "slow_query_ms": (
+                None if self.slow_query_seconds is None
+                else self.slow_query_seconds * 1000
+            ),
+            "slow_queries": list(self.slow),
+        }
+        if database is not None and database.buffer_pool is not None:
+            result["buffer_pool"] = database.buffer_pool.stats()
+        return result
+
+    def reset(self):
+        for name in self.counters:
+            self.counters[name] = 0
+        self.slow.clear()
+        self.since = time.time()
+
+
+# The process's metrics
+metrics = Metrics()
+counters = metrics.counters
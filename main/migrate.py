@@ -0,0 +1,57 @@
+"""Convert the database between db.json and the paged binary format.
+
+    python -m main.migrate to-paged [source] [target]   (db.json -> db.pages)
+    python -m main.migrate to-json [source] [target]    (db.pages -> db.json)
+
+The source's write-ahead log is applied first. Once the target is
+written, the source and its log are renamed to *.bak, so the app opens
+the new file (db.pages is used whenever it exists).
+"""
+import os
+import sys
+
+from main.core import DB_FILE, PAGED_DB_FILE, Database
+
+FORMATS = {
+    "to-paged": ("paged", DB_FILE, PAGED_DB_FILE),
+    "to-json": ("json", PAGED_DB_FILE, DB_FILE),
+}
+
+
+def migrate(source, target, storage):
+    if not os.path.exists(source):
+        raise Exception(f"{source} does not exist")
+    if os.path.exists(target):
+        raise Exception(f"{target} already exists")
+
+    database = Database(source, checkpoint_every=0)
+    database.write_snapshot(target, storage)
+
+    for path in (source, database.log_file):
+        if os.path.exists(path):
+            os.replace(path, path + ".bak")
+    return database
+
+
+def main(argv):
+    if not argv or argv[0] not in FORMATS:
+        print(__doc__)
+        return 1
+    storage, source, target = FORMATS[argv[0]]
+    if len(argv) > 1:
+        source = argv[1]
+    if len(argv) > 2:
+        target = argv[2]
+
+    try:
+        database = migrate(source, target, storage)
+    except Exception as e:
+        print("Error:", e)
+        return 1
+    rows = sum(len(table.rows) for table in database.tables.values())
+    print(f"Wrote {rows} rows from {source} to {target} ({storage})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
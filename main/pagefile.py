@@ -0,0 +1,265 @@
+import json
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_right
+
+# -------------------------------
+# Paged binary snapshot format
+# -------------------------------
+# Page 0 is the header. Each table's rows are packed into fixed-size
+# data pages (a row larger than a page gets a run of pages to itself);
+# the catalog at the end of the file holds the schema and, per table,
+# a page directory: [first page, page count, row count] per chunk.
+# Columns that are indexed are also stored whole as key vectors, so
+# indexes can be built at open without decoding any row.
+#
+# Data page: u16 row count, then the rows. A row is a NULL bitmap
+# followed by its non-NULL values: INT as 8-byte signed integers, TEXT
+# as u32 length + UTF-8, any other type as length + JSON text.
+
+MAGIC = b"MRDBPAGE"
+VERSION = 1
+PAGE_SIZE = 4096
+
+_HEADER = struct.Struct("<8sHIQQ")  # magic, version, page size, catalog page, catalog length
+_COUNT = struct.Struct("<H")
+_INT = struct.Struct("<q")
+_LEN = struct.Struct("<I")
+
+
+def is_paged(path):
+    """True if path is a paged database file (rather than db.json)."""
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except FileNotFoundError:
+        return False
+
+
+# -------------------------------
+# Row encoding
+# -------------------------------
+def _encoder(types):
+    kinds = list(types)
+    bitmap_size = (len(kinds) + 7) // 8
+
+    def encode(values):
+        bitmap = bytearray(bitmap_size)
+        parts = [bitmap]
+        for i, value in enumerate(values):
+            if value is None:
+                bitmap[i >> 3] |= 1 << (i & 7)
+            elif kinds[i] == "INT":
+                try:
+                    parts.append(_INT.pack(value))
+                except struct.error:
+                    raise Exception(f"INT value {value!r} does not fit in 64 bits") from None
+            else:
+                data = (value if kinds[i] == "TEXT" else json.dumps(value)).encode()
+                parts.append(_LEN.pack(len(data)))
+                parts.append(data)
+        return b"".join(parts)
+    return encode
+
+
+def _decoder(types):
+    kinds = list(types)
+    bitmap_size = (len(kinds) + 7) // 8
+    unpack_int = _INT.unpack_from
+    unpack_len = _LEN.unpack_from
+
+    def decode(buf, pos):
+        bitmap = buf[pos:pos + bitmap_size]
+        pos += bitmap_size
+        values = []
+        for i, kind in enumerate(kinds):
+            if bitmap[i >> 3] & (1 << (i & 7)):
+                values.append(None)
+            elif kind == "INT":
+                values.append(unpack_int(buf, pos)[0])
+                pos += 8
+            else:
+                size = unpack_len(buf, pos)[0]
+                pos += 4
+                text = buf[pos:pos + size].decode()
+                pos += size
+                values.append(text if kind == "TEXT" else json.loads(text))
+        return values, pos
+    return decode
+
+
+# -------------------------------
+# Writer
+# -------------------------------
+class PageWriter:
+    """Write a paged file: tables one after another, then the catalog."""
+
+    def __init__(self, path, page_size=PAGE_SIZE):
+        self.path = path
+        self.page_size = page_size
+        self.file = open(path, "wb")
+        self.file.write(bytes(page_size))  # header, filled in by close()
+        self.next_page = 1
+        self.catalog = {"tables": {}}
+
+    def _write_pages(self, data):
+        # data padded to whole pages; returns (first page, page count)
+        first = self.next_page
+        count = max(1, -(-len(data) // self.page_size))
+        self.file.write(data)
+        self.file.write(bytes(count * self.page_size - len(data)))
+        self.next_page += count
+        return first, count
+
+    def write_table(self, name, schema, rows):
+        """Write rows (sequences of values in column order) of one table.
+
+        schema holds the table's columns, types and index/key metadata;
+        it is stored as-is in the catalog.
+        """
+        columns = schema["columns"]
+        encode = _encoder(schema["types"].get(col, "") for col in columns)
+        vector_cols = [c for c in schema.get("vector_columns", []) if c in columns]
+        positions = [columns.index(c) for c in vector_cols]
+        vectors = [[] for _ in vector_cols]
+
+        capacity = self.page_size - _COUNT.size
+        chunks = []
+        page, count, used = [], 0, 0
+
+        def flush():
+            if count:
+                first, pages = self._write_pages(_COUNT.pack(count) + b"".join(page))
+                chunks.append([first, pages, count])
+
+        total = 0
+        for values in rows:
+            values = list(values)
+            data = encode(values)
+            for vector, pos in zip(vectors, positions):
+                vector.append(values[pos])
+            total += 1
+            if count and (used + len(data) > capacity or count == 0xFFFF):
+                flush()
+                page, count, used = [], 0, 0
+            page.append(data)
+            count += 1
+            used += len(data)
+        flush()
+
+        info = {k: v for k, v in schema.items() if k != "vector_columns"}
+        info["count"] = total
+        info["pages"] = chunks
+        info["vectors"] = {
+            col: self._write_vector(schema["types"].get(col), vector)
+            for col, vector in zip(vector_cols, vectors)
+        }
+        self.catalog["tables"][name] = info
+
+    def _write_vector(self, kind, values):
+        if kind == "INT":
+            nulls = [i for i, v in enumerate(values) if v is None]
+            data = array("q", (0 if v is None else v for v in values)).tobytes()
+            fmt = "int"
+        else:
+            nulls = []
+            data = json.dumps(values).encode()
+            fmt = "json"
+        first, _ = self._write_pages(data)
+        return {"page": first, "length": len(data), "format": fmt, "nulls": nulls}
+
+    def close(self, lsn=0, sync=True, views=None):
+        self.catalog["lsn"] = lsn
+        if views:
+            self.catalog["views"] = views
+        data = json.dumps(self.catalog).encode()
+        first, _ = self._write_pages(data)
+        self.file.seek(0)
+        self.file.write(_HEADER.pack(MAGIC, VERSION, self.page_size, first, len(data)))
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+        self.file.close()
+
+
+# -------------------------------
+# Reader
+# -------------------------------
+class PageFile:
+    """A paged database file, read through mmap.
+
+    Opening reads only the header and catalog; pages are decoded when
+    something asks for them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.page_size, page, length = _HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise Exception(f"{path} is not a version {VERSION} paged database")
+        start = page * self.page_size
+        self.catalog = json.loads(self.map[start:start + length])
+        self.lsn = self.catalog.get("lsn", 0)
+        self.tables = self.catalog["tables"]
+        # materialized view name -> {"query", "indexes"}
+        self.views = self.catalog.get("views", {})
+
+    def table_rows(self, name, make_row):
+        return PagedRows(self, self.tables[name], make_row)
+
+    def vectors(self, name):
+        """Key vectors of a table: column -> values in row id order."""
+        result = {}
+        for col, spec in self.tables[name]["vectors"].items():
+            start = spec["page"] * self.page_size
+            data = self.map[start:start + spec["length"]]
+            if spec["format"] == "int":
+                values = array("q", data).tolist()
+                for i in spec["nulls"]:
+                    values[i] = None
+            else:
+                values = json.loads(data)
+            result[col] = values
+        return result
+
+
+class PagedRows:
+    """The rows of one table in a PageFile, decoded one chunk at a time.
+
+    Row ids are positions in the table, so chunk i holds the rows from
+    starts[i] up to starts[i + 1].
+    """
+
+    def __init__(self, pagefile, info, make_row):
+        self.file = pagefile
+        self.make_row = make_row
+        self.count = info["count"]
+        self.chunks = info["pages"]
+        self.starts = []
+        start = 0
+        for _, _, rows in self.chunks:
+            self.starts.append(start)
+            start += rows
+        self.decode_row = _decoder(info["types"].get(col, "") for col in info["columns"])
+
+    def chunk_of(self, rid):
+        return bisect_right(self.starts, rid) - 1
+
+    def decode(self, chunk):
+        """(first row id, [row, ...]) for one chunk."""
+        first_page = self.chunks[chunk][0]
+        buf = self.file.map
+        pos = first_page * self.file.page_size
+        count = _COUNT.unpack_from(buf, pos)[0]
+        pos += _COUNT.size
+        decode_row = self.decode_row
+        make_row = self.make_row
+        rows = []
+        for _ in range(count):
+            values, pos = decode_row(buf, pos)
+            rows.append(make_row(values))
+        return self.starts[chunk], rows
@@ -0,0 +1,634 @@
+import re
+
+# Aggregate functions of SELECT lists, HAVING and ORDER BY
+AGGREGATES = ("COUNT", "SUM", "AVG", "MIN", "MAX")
+
+
+# -------------------------------
+# AST
+# -------------------------------
+class Node:
+    def __repr__(self):
+        fields = ", ".join(f"{k}={v!r}" for k, v in vars(self).items())
+        return f"{type(self).__name__}({fields})"
+
+
+class Literal(Node):
+    def __init__(self, value):
+        self.value = value
+
+
+class Param(Node):
+    """A ? placeholder; index is its position in the statement."""
+
+    def __init__(self, index):
+        self.index = index
+
+
+class Aggregate(Node):
+    """COUNT/SUM/AVG/MIN/MAX over a column (col None: COUNT(*))."""
+
+    def __init__(self, func, col, alias=None):
+        self.func = func
+        self.col = col
+        self.alias = alias
+
+    @property
+    def name(self):
+        # output column: the alias, else e.g. "sum(amount)", "count(*)"
+        return self.alias or f"{self.func.lower()}({self.col or '*'})"
+
+
+class Comparison(Node):
+    def __init__(self, col, op, value):
+        self.col = col
+        self.op = op
+        self.value = value
+
+
+class BetweenExpr(Node):
+    def __init__(self, col, lo, hi):
+        self.col = col
+        self.lo = lo
+        self.hi = hi
+
+
+class AndExpr(Node):
+    def __init__(self, items):
+        self.items = items
+
+
+class OrExpr(Node):
+    def __init__(self, items):
+        self.items = items
+
+
+class References(Node):
+    def __init__(self, table, column, on_delete):
+        self.table = table
+        self.column = column      # None = the table's primary key
+        self.on_delete = on_delete
+
+
+class ColumnDef(Node):
+    def __init__(self, name, type, constraints, references=None):
+        self.name = name
+        self.type = type
+        self.constraints = constraints
+        self.references = references
+
+
+class CreateTable(Node):
+    def __init__(self, name, columns):
+        self.name = name
+        self.columns = columns
+
+
+class CreateIndex(Node):
+    def __init__(self, name, table, column, using):
+        self.name = name
+        self.table = table
+        self.column = column
+        self.using = using
+
+
+class CreateView(Node):
+    def __init__(self, name, query):
+        self.name = name
+        self.query = query        # text of the defining SELECT
+
+
+class Insert(Node):
+    def __init__(self, table, columns, rows):
+        self.table = table
+        self.columns = columns    # None = table order
+        self.rows = rows          # [[value, ...], ...]
+
+
+class Copy(Node):
+    def __init__(self, table, columns, path, format, header):
+        self.table = table
+        self.columns = columns    # None = table order (CSV) / all keys (JSONL)
+        self.path = path          # Literal or Param
+        self.format = format      # "csv", "jsonl" or None: by file extension
+        self.header = header      # CSV: first line names the columns
+
+
+class Join(Node):
+    def __init__(self, kind, table, left_key, right_key):
+        self.kind = kind          # "INNER" or "LEFT"
+        self.table = table
+        self.left_key = left_key
+        self.right_key = right_key
+
+
+class Select(Node):
+    def __init__(self, table, columns, where=None, order_by=None, desc=False,
+                 limit=None, offset=0, join=None, group_by=None, having=None):
+        self.table = table
+        self.columns = columns    # None = *; names and Aggregates
+        self.where = where
+        self.order_by = order_by  # name or Aggregate
+        self.desc = desc
+        self.limit = limit
+        self.offset = offset
+        self.join = join
+        self.group_by = group_by  # None or [col, ...]
+        self.having = having
+
+    @property
+    def grouped(self):
+        """True for GROUP BY or aggregate queries (one row per group)."""
+        return self.group_by is not None or any(
+            isinstance(col, Aggregate) for col in self.columns or ()
+        )
+
+
+class Update(Node):
+    def __init__(self, table, assignments, where):
+        self.table = table
+        self.assignments = assignments
+        self.where = where
+
+
+class Delete(Node):
+    def __init__(self, table, where):
+        self.table = table
+        self.where = where
+
+
+class TransactionControl(Node):
+    def __init__(self, action):
+        self.action = action      # "BEGIN", "COMMIT" or "ROLLBACK"
+
+
+class Explain(Node):
+    def __init__(self, statement, analyze):
+        self.statement = statement    # the SELECT, INSERT, COPY, UPDATE or DELETE
+        self.analyze = analyze        # run it and report what each node did
+
+
+# -------------------------------
+# Lexer
+# -------------------------------
+TOKEN_RE = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<number>-?\d+(?:\.\d+)?)
+  | (?P<string>'(?:[^']|'')*')
+  | (?P<ident>"(?:[^"]|"")*")
+  | (?P<word>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<param>\?)
+  | (?P<op><=|>=|<>|!=|=|<|>)
+  | (?P<punct>[(),.*;])
+""", re.VERBOSE)
+
+
+class Token:
+    __slots__ = ("kind", "value", "pos")
+
+    def __init__(self, kind, value, pos):
+        self.kind = kind
+        self.value = value
+        self.pos = pos
+
+    def is_keyword(self, *words):
+        return self.kind == "word" and self.value.upper() in words
+
+    def __repr__(self):
+        return f"Token({self.kind}, {self.value!r})"
+
+
+def tokenize(query):
+    tokens = []
+    pos = 0
+    while pos < len(query):
+        match = TOKEN_RE.match(query, pos)
+        if not match:
+            raise Exception(f"Syntax error at position {pos}: {query[pos:pos + 10]!r}")
+        kind = match.lastgroup
+        text = match.group()
+        if kind == "number":
+            tokens.append(Token(kind, float(text) if "." in text else int(text), pos))
+        elif kind == "string":
+            tokens.append(Token(kind, text[1:-1].replace("''", "'"), pos))
+        elif kind == "ident":
+            tokens.append(Token("word", text[1:-1].replace('""', '"'), pos))
+        elif kind != "space":
+            tokens.append(Token(kind, text, pos))
+        pos = match.end()
+    tokens.append(Token("end", None, pos))
+    return tokens
+
+
+# -------------------------------
+# Parser
+# -------------------------------
+class Parser:
+    """Recursive-descent parser for the engine's SQL dialect.
+
+    Besides standard quoted literals, a bare word in a value position is
+    read as a TEXT literal, so the original shorthand keeps working:
+    INSERT INTO users VALUES 1 Alice / UPDATE users SET name=Bob WHERE id=1
+    """
+
+    def __init__(self, query):
+        self.query = query
+        self.tokens = tokenize(query)
+        self.pos = 0
+        self.params = 0
+
+    # ---------- token helpers ----------
+    def peek(self, offset=0):
+        return self.tokens[min(self.pos + offset, len(self.tokens) - 1)]
+
+    def next(self):
+        token = self.tokens[self.pos]
+        if token.kind != "end":
+            self.pos += 1
+        return token
+
+    def error(self, expected):
+        token = self.peek()
+        found = "end of query" if token.kind == "end" else repr(token.value)
+        return Exception(f"Syntax error: expected {expected}, found {found}")
+
+    def accept(self, *words):
+        if self.peek().is_keyword(*words):
+            return self.next().value.upper()
+        return None
+
+    def expect(self, *words):
+        word = self.accept(*words)
+        if word is None:
+            raise self.error(" or ".join(words))
+        return word
+
+    def accept_punct(self, char):
+        token = self.peek()
+        if token.kind == "punct" and token.value == char:
+            self.next()
+            return True
+        return False
+
+    def expect_punct(self, char):
+        if not self.accept_punct(char):
+            raise self.error(repr(char))
+
+    def name(self):
+        token = self.peek()
+        if token.kind != "word":
+            raise self.error("a name")
+        return self.next().value
+
+    def column(self):
+        # col or table.col (the qualifier is dropped)
+        name = self.name()
+        if self.accept_punct("."):
+            name = self.name()
+        return name
+
+    def operand(self):
+        # column or aggregate: FUNC(col) / COUNT(*)
+        token = self.peek()
+        following = self.peek(1)
+        if not (token.kind == "word" and token.value.upper() in AGGREGATES
+                and following.kind == "punct" and following.value == "("):
+            return self.column()
+        func = self.next().value.upper()
+        self.expect_punct("(")
+        if func == "COUNT" and self.accept_punct("*"):
+            col = None
+        else:
+            col = self.column()
+        self.expect_punct(")")
+        return Aggregate(func, col)
+
+    def integer(self):
+        token = self.peek()
+        if token.kind != "number" or not isinstance(token.value, int):
+            raise self.error("an integer")
+        return self.next().value
+
+    def value(self):
+        token = self.peek()
+        if token.kind == "param":
+            self.next()
+            self.params += 1
+            return Param(self.params - 1)
+        if token.kind in ("number", "string"):
+            return Literal(self.next().value)
+        if token.kind == "word":
+            self.next()
+            if token.value.upper() == "NULL":
+                return Literal(None)
+            return Literal(token.value)
+        raise self.error("a value")
+
+    # ---------- statements ----------
+    def parse(self):
+        node = self.statement()
+        self.accept_punct(";")
+        if self.peek().kind != "end":
+            raise self.error("end of query")
+        return node
+
+    def statement(self):
+        token = self.peek()
+        if token.is_keyword("EXPLAIN"):
+            node = self.explain()
+        elif token.is_keyword("CREATE"):
+            node = self.create()
+        elif token.is_keyword("INSERT"):
+            node = self.insert()
+        elif token.is_keyword("COPY"):
+            node = self.copy()
+        elif token.is_keyword("SELECT"):
+            node = self.select()
+        elif token.is_keyword("UPDATE"):
+            node = self.update()
+        elif token.is_keyword("DELETE"):
+            node = self.delete()
+        elif token.is_keyword("BEGIN", "START"):
+            self.next()
+            self.accept("TRANSACTION")
+            node = TransactionControl("BEGIN")
+        elif token.is_keyword("COMMIT", "END"):
+            self.next()
+            node = TransactionControl("COMMIT")
+        elif token.is_keyword("ROLLBACK"):
+            self.next()
+            node = TransactionControl("ROLLBACK")
+        else:
+            raise Exception("Unsupported SQL")
+        return node
+
+    def explain(self):
+        # EXPLAIN [ANALYZE] statement
+        self.expect("EXPLAIN")
+        analyze = self.accept("ANALYZE") is not None
+        node = self.statement()
+        if not isinstance(node, (Select, Insert, Copy, Update, Delete)):
+            raise Exception("EXPLAIN takes a SELECT, INSERT, COPY, UPDATE or DELETE")
+        return Explain(node, analyze)
+
+    def create(self):
+        self.expect("CREATE")
+        if self.accept("INDEX"):
+            return self.create_index()
+        if self.accept("MATERIALIZED"):
+            self.expect("VIEW")
+            return self.create_view()
+        self.expect("TABLE")
+        name = self.name()
+        self.expect_punct("(")
+        columns = [self.column_def()]
+        while self.accept_punct(","):
+            columns.append(self.column_def())
+        self.expect_punct(")")
+        return CreateTable(name, columns)
+
+    def column_def(self):
+        # name TYPE [PRIMARY KEY] [UNIQUE] [REFERENCES t[(col)] [ON DELETE action]]
+        name = self.name()
+        col_type = self.name().upper()
+        constraints = []
+        references = None
+        while self.peek().kind == "word":
+            if self.accept("REFERENCES"):
+                references = self.references()
+            else:
+                constraints.append(self.next().value.upper())
+        return ColumnDef(name, col_type, constraints, references)
+
+    def references(self):
+        table = self.name()
+        column = None
+        if self.accept_punct("("):
+            column = self.name()
+            self.expect_punct(")")
+        on_delete = "RESTRICT"
+        if self.accept("ON"):
+            self.expect("DELETE")
+            action = self.expect("CASCADE", "RESTRICT", "SET", "NO")
+            if action == "SET":
+                self.expect("NULL")
+                on_delete = "SET NULL"
+            elif action == "NO":
+                self.expect("ACTION")
+            else:
+                on_delete = action
+        return References(table, column, on_delete)
+
+    def create_index(self):
+        # CREATE INDEX [name] ON table(col) [USING HASH|SORTED|BTREE|TRIGRAM]
+        name = None
+        if not self.peek().is_keyword("ON"):
+            name = self.name()
+        self.expect("ON")
+        table = self.name()
+        self.expect_punct("(")
+        column = self.name()
+        self.expect_punct(")")
+        using = "hash"
+        if self.accept("USING"):
+            using = self.expect("HASH", "SORTED", "BTREE", "TRIGRAM").lower()
+            if using == "btree":
+                using = "sorted"
+        return CreateIndex(name, table, column, using)
+
+    def create_view(self):
+        # CREATE MATERIALIZED VIEW name AS SELECT ...
+        name = self.name()
+        self.expect("AS")
+        start = self.peek().pos
+        self.select()
+        end = self.peek().pos
+        return CreateView(name, self.query[start:end].strip())
+
+    def insert(self):
+        # INSERT INTO t [(cols)] VALUES (v, ...), (v, ...)  |  INSERT INTO t VALUES v v ...
+        self.expect("INSERT")
+        self.expect("INTO")
+        table = self.name()
+        columns = self.column_list()
+        self.expect("VALUES")
+
+        if self.accept_punct("("):
+            rows = [self.row()]
+            while self.accept_punct(","):
+                self.expect_punct("(")
+                rows.append(self.row())
+        else:
+            values = []
+            while self.peek().kind not in ("end", "punct"):
+                values.append(self.value())
+            rows = [values]
+        return Insert(table, columns, rows)
+
+    def column_list(self):
+        # [(col, ...)]
+        if not self.accept_punct("("):
+            return None
+        columns = [self.name()]
+        while self.accept_punct(","):
+            columns.append(self.name())
+        self.expect_punct(")")
+        return columns
+
+    def row(self):
+        # v, ...) after the opening parenthesis
+        values = [self.value()]
+        while self.accept_punct(","):
+            values.append(self.value())
+        self.expect_punct(")")
+        return values
+
+    def copy(self):
+        # COPY t [(cols)] FROM 'file' [[WITH] FORMAT CSV|JSONL] [HEADER]
+        self.expect("COPY")
+        table = self.name()
+        columns = self.column_list()
+        self.expect("FROM")
+        path = self.value()
+        file_format = None
+        self.accept("WITH")
+        if self.accept("FORMAT"):
+            file_format = self.expect("CSV", "JSONL").lower()
+        header = self.accept("HEADER") is not None
+        return Copy(table, columns, path, file_format, header)
+
+    def select(self):
+        self.expect("SELECT")
+        if self.accept_punct("*"):
+            columns = None
+        else:
+            columns = [self.select_item()]
+            while self.accept_punct(","):
+                columns.append(self.select_item())
+        self.expect("FROM")
+        table = self.name()
+
+        join = None
+        kind = self.accept("LEFT", "INNER", "JOIN")
+        if kind:
+            if kind != "JOIN":
+                self.accept("OUTER")
+                self.expect("JOIN")
+            right = self.name()
+            self.expect("ON")
+            left_key = self.column()
+            op = self.next()
+            if op.kind != "op" or op.value != "=":
+                raise Exception("Syntax error: JOIN ... ON needs an equality")
+            right_key = self.column()
+            join = Join("LEFT" if kind == "LEFT" else "INNER", right, left_key, right_key)
+
+        where = self.where()
+
+        group_by = None
+        if self.accept("GROUP"):
+            self.expect("BY")
+            group_by = [self.column()]
+            while self.accept_punct(","):
+                group_by.append(self.column())
+        having = None
+        if self.accept("HAVING"):
+            having = self.or_expr()
+
+        order_by, desc = None, False
+        if self.accept("ORDER"):
+            self.expect("BY")
+            order_by = self.operand()
+            desc = self.accept("ASC", "DESC") == "DESC"
+
+        limit = None
+        if self.accept("LIMIT"):
+            limit = self.integer()
+        offset = 0
+        if self.accept("OFFSET"):
+            offset = self.integer()
+
+        return Select(table, columns, where, order_by, desc, limit, offset, join,
+                      group_by, having)
+
+    def select_item(self):
+        # col, table.col or FUNC(col) [AS alias]
+        item = self.operand()
+        if isinstance(item, Aggregate) and self.accept("AS"):
+            item.alias = self.name()
+        return item
+
+    def update(self):
+        # UPDATE t SET col=v [, col=v] WHERE ...
+        self.expect("UPDATE")
+        table = self.name()
+        self.expect("SET")
+        assignments = {}
+        while True:
+            col = self.name()
+            op = self.next()
+            if op.kind != "op" or op.value != "=":
+                raise Exception("Syntax error: expected '=' in SET")
+            assignments[col] = self.value()
+            if not self.accept_punct(","):
+                break
+        where = self.where()
+        if where is None:
+            raise self.error("WHERE")
+        return Update(table, assignments, where)
+
+    def delete(self):
+        self.expect("DELETE")
+        self.expect("FROM")
+        table = self.name()
+        where = self.where()
+        if where is None:
+            raise self.error("WHERE")
+        return Delete(table, where)
+
+    # ---------- WHERE ----------
+    def where(self):
+        if not self.accept("WHERE"):
+            return None
+        return self.or_expr()
+
+    def or_expr(self):
+        items = [self.and_expr()]
+        while self.accept("OR"):
+            items.append(self.and_expr())
+        return items[0] if len(items) == 1 else OrExpr(items)
+
+    def and_expr(self):
+        items = [self.predicate()]
+        while self.accept("AND"):
+            items.append(self.predicate())
+        return items[0] if len(items) == 1 else AndExpr(items)
+
+    def predicate(self):
+        if self.accept_punct("("):
+            node = self.or_expr()
+            self.expect_punct(")")
+            return node
+
+        col = self.operand()
+        if self.accept("BETWEEN"):
+            lo = self.value()
+            self.expect("AND")
+            hi = self.value()
+            return BetweenExpr(col, lo, hi)
+        # col LIKE 'pattern' / col CONTAINS 'text'
+        op = self.accept("LIKE", "CONTAINS")
+        if op:
+            return Comparison(col, op, self.value())
+
+        op = self.next()
+        if op.kind != "op":
+            raise Exception(f"Syntax error: expected a comparison after {col}")
+        return Comparison(col, op.value, self.value())
+
+
+def parse(query):
+    """Parse one statement into an AST; returns (node, number of ? params)."""
+    parser = Parser(query)
+    node = parser.parse()
+    return node, parser.params
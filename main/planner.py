@@ -0,0 +1,1275 @@
+from bisect import bisect_left, bisect_right
+import heapq
+import itertools
+import operator
+import re
+
+from main import vector
+from main.metrics import counters
+from main.index import text_key
+from main.parser import Aggregate, AndExpr, BetweenExpr, Comparison, OrExpr, Param
+
+# Rows folded at a time into an aggregate without GROUP BY
+AGGREGATE_BLOCK = 1024
+
+# An AND branch is intersected with the driving index only if it is
+# expected to return at most this many times as many rows
+INTERSECT_RATIO = 4
+
+
+OPERATORS = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<>": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+
+# -------------------------------
+# Predicates
+# -------------------------------
+# matches(row) checks one row; compile(table) returns an equivalent
+# function bound to the table's column accessors, for scan loops. When
+# vectorizable(table), vector(cache, ts) returns the same test as a
+# boolean mask over a ColumnCache (main/vector.py), or None if a column
+# turned out not to fit in one. str() gives the predicate as SQL, for
+# EXPLAIN.
+
+def _sql(value):
+    # a value as SQL text
+    if value is None:
+        return "NULL"
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return str(value)
+
+
+class Compare:
+    def __init__(self, col, op, value):
+        self.col = col
+        self.op = op
+        self.value = value
+
+    def __str__(self):
+        return f"{self.col} {self.op} {_sql(self.value)}"
+
+    def compile(self, table):
+        get = table.getter(self.col)
+        value = self.value
+        if self.op == "=":
+            return lambda row: get(row) == value
+        cmp = OPERATORS[self.op]
+
+        def check(row):
+            v = get(row)
+            return v is not None and cmp(v, value)
+        return check
+
+    def matches(self, row):
+        v = row[self.col]
+        if self.op == "=":
+            return v == self.value
+        if v is None:
+            return False
+        if self.op == "<":
+            return v < self.value
+        if self.op == "<=":
+            return v <= self.value
+        if self.op == ">":
+            return v > self.value
+        if self.op == ">=":
+            return v >= self.value
+        if self.op in ("!=", "<>"):
+            return v != self.value
+        raise Exception(f"Unsupported operator {self.op}")
+
+    def vectorizable(self, table):
+        return table.types.get(self.col) == "INT" and vector.is_number(self.value)
+
+    def vector(self, cache, ts):
+        column = cache.column(self.col, ts)
+        if column is None:
+            return None
+        mask = OPERATORS[self.op](column.values, self.value)
+        if column.nulls is not None:
+            mask &= ~column.nulls
+        return mask
+
+    def bounds(self):
+        # (lo, hi, lo_inclusive, hi_inclusive) for a range scan
+        if self.op == "=":
+            return self.value, self.value, True, True
+        if self.op in ("<", "<="):
+            return None, self.value, True, self.op == "<="
+        return self.value, None, self.op == ">=", True
+
+
+class Between:
+    def __init__(self, col, lo, hi):
+        self.col = col
+        self.lo = lo
+        self.hi = hi
+
+    def __str__(self):
+        return f"{self.col} BETWEEN {_sql(self.lo)} AND {_sql(self.hi)}"
+
+    def matches(self, row):
+        v = row[self.col]
+        return v is not None and self.lo <= v <= self.hi
+
+    def compile(self, table):
+        get = table.getter(self.col)
+        lo, hi = self.lo, self.hi
+
+        def check(row):
+            v = get(row)
+            return v is not None and lo <= v <= hi
+        return check
+
+    def vectorizable(self, table):
+        return (table.types.get(self.col) == "INT"
+                and vector.is_number(self.lo) and vector.is_number(self.hi))
+
+    def vector(self, cache, ts):
+        column = cache.column(self.col, ts)
+        if column is None:
+            return None
+        mask = (column.values >= self.lo) & (column.values <= self.hi)
+        if column.nulls is not None:
+            mask &= ~column.nulls
+        return mask
+
+    def bounds(self):
+        return self.lo, self.hi, True, True
+
+
+class Like:
+    """col LIKE pattern (% any text, _ one character) or, with contains,
+    col CONTAINS text. Both ignore case and match INT values by their
+    text, as a trigram index does."""
+
+    def __init__(self, col, pattern, contains=False):
+        self.col = col
+        self.pattern = pattern
+        self.contains = contains
+        if pattern is None:
+            raise Exception("LIKE / CONTAINS need a value, not NULL")
+        pattern = text_key(pattern)
+        if contains:
+            # the literal pieces a matching value must contain
+            self.parts = [pattern]
+            regex = ".*" + re.escape(pattern) + ".*"
+        else:
+            self.parts = [part for part in re.split("[%_]+", pattern) if part]
+            regex = "".join(
+                ".*" if c == "%" else "." if c == "_" else re.escape(c) for c in pattern
+            )
+        self.regex = re.compile(regex, re.DOTALL)
+
+    def __str__(self):
+        op = "CONTAINS" if self.contains else "LIKE"
+        return f"{self.col} {op} {_sql(self.pattern)}"
+
+    def matches(self, row):
+        v = row[self.col]
+        return v is not None and self.regex.fullmatch(text_key(v)) is not None
+
+    def compile(self, table):
+        get = table.getter(self.col)
+        fullmatch = self.regex.fullmatch
+
+        def check(row):
+            v = get(row)
+            return v is not None and fullmatch(text_key(v)) is not None
+        return check
+
+    def vectorizable(self, table):
+        return False
+
+
+class And:
+    def __init__(self, items):
+        self.items = items
+
+    def __str__(self):
+        return " AND ".join(f"({p})" if isinstance(p, Or) else str(p) for p in self.items)
+
+    def matches(self, row):
+        return all(p.matches(row) for p in self.items)
+
+    def compile(self, table):
+        checks = [p.compile(table) for p in self.items]
+        return lambda row: all(check(row) for check in checks)
+
+    def vectorizable(self, table):
+        return all(p.vectorizable(table) for p in self.items)
+
+    def vector(self, cache, ts):
+        return _combine(self.items, cache, ts, operator.and_)
+
+
+class Or:
+    def __init__(self, items):
+        self.items = items
+
+    def __str__(self):
+        return " OR ".join(str(p) for p in self.items)
+
+    def matches(self, row):
+        return any(p.matches(row) for p in self.items)
+
+    def compile(self, table):
+        checks = [p.compile(table) for p in self.items]
+        return lambda row: any(check(row) for check in checks)
+
+    def vectorizable(self, table):
+        return all(p.vectorizable(table) for p in self.items)
+
+    def vector(self, cache, ts):
+        return _combine(self.items, cache, ts, operator.or_)
+
+
+def _combine(items, cache, ts, op):
+    mask = None
+    for p in items:
+        item = p.vector(cache, ts)
+        if item is None:
+            return None
+        mask = item if mask is None else op(mask, item)
+    return mask
+
+
+# -------------------------------
+# Plan nodes
+# -------------------------------
+# Every node has an estimate (rows it will produce), rows() which
+# yields them, and ordered_by: (col, desc) if rows come out sorted.
+# describe() is its line in EXPLAIN (main/explain.py); under EXPLAIN
+# ANALYZE a node also has stats, and the access paths count the rows
+# they read into it through _examined.
+
+def _examined(node, rows):
+    # rows, counted into the node's stats under EXPLAIN ANALYZE
+    stats = getattr(node, "stats", None)
+    if stats is None:
+        return rows
+    return stats.examine(rows)
+
+
+class FullScan:
+    def __init__(self, table, predicate=None):
+        self.table = table
+        self.predicate = predicate
+        self.estimate = len(table.rows)
+        self.ordered_by = None
+
+    def rows(self):
+        rows = _examined(self, self.table.scan())
+        if self.predicate is None:
+            yield from rows
+            return
+        check = self.predicate.compile(self.table)
+        for row in rows:
+            if check(row):
+                yield row
+
+    def describe(self):
+        if self.predicate is None:
+            return f"FullScan on {self.table.name}"
+        return f"FullScan on {self.table.name} filter {self.predicate}"
+
+
+class VectorScan:
+    """Full scan with the INT comparisons of the predicate evaluated on
+    NumPy column arrays (main/vector.py): only the rows their mask picks
+    are read, and checked against the rest of the predicate. Falls back
+    to a plain scan when the table has no usable column cache."""
+
+    def __init__(self, table, predicate):
+        self.table = table
+        self.predicate = predicate
+        items = predicate.items if isinstance(predicate, And) else [predicate]
+        self.vectorized = _conjunction([p for p in items if p.vectorizable(table)])
+        self.residual = _conjunction([p for p in items if not p.vectorizable(table)])
+        self.estimate = len(table.rows)
+        self.ordered_by = None
+
+    def rows(self):
+        table = self.table
+        with table.reading() as ts:
+            cache = vector.cache_for(table, ts)
+            mask = None if cache is None else self.vectorized.vector(cache, ts)
+            if mask is None:
+                counters["scans"] += 1
+                rows = table.rows.scan(ts)
+                check = self.predicate.compile(table)
+            else:
+                counters["vector_scans"] += 1
+                rows = table.rows.fetch(cache.row_ids(ts)[mask].tolist(), ts)
+                check = None if self.residual is None else self.residual.compile(table)
+            for row in _examined(self, rows):
+                if check is None or check(row):
+                    yield row
+
+    def describe(self):
+        text = f"VectorScan on {self.table.name} mask {self.vectorized}"
+        if self.residual is not None:
+            text += f" filter {self.residual}"
+        return text
+
+
+def _conjunction(items):
+    if not items:
+        return None
+    return items[0] if len(items) == 1 else And(items)
+
+
+class IndexLookup:
+    """Equality probe of a primary key, UNIQUE or hash index."""
+
+    def __init__(self, table, col, value):
+        self.table = table
+        self.col = col
+        self.value = value
+        if col in table.indexes:
+            self.estimate = 1 if value in table.indexes[col] else 0
+        else:
+            self.estimate = len(table.secondary_indexes[col].get(value, ()))
+        self.ordered_by = None
+
+    def rows(self):
+        yield from _examined(self, self.table.find_all(self.col, self.value))
+
+    def describe(self):
+        kind = "unique index" if self.col in self.table.indexes else "hash index"
+        return (f"IndexLookup on {self.table.name} using {kind} "
+                f"{self.col} = {_sql(self.value)}")
+
+
+class RangeScan:
+    """Range (or full ordered) scan of a sorted index."""
+
+    def __init__(self, table, col, lo=None, hi=None, lo_inclusive=True,
+                 hi_inclusive=True, reverse=False):
+        self.table = table
+        self.col = col
+        self.bounds = (lo, hi, lo_inclusive, hi_inclusive)
+        self.reverse = reverse
+        index = table.ordered_indexes[col]
+        if lo is None and hi is None:
+            self.estimate = len(index)
+        else:
+            self.estimate = index.count(*self.bounds)
+        self.ordered_by = (col, reverse)
+
+    def rows(self):
+        lo, hi, lo_inclusive, hi_inclusive = self.bounds
+        if lo is None and hi is None:
+            yield from _examined(self, self.table.ordered(self.col, self.reverse))
+            return
+        yield from _examined(self, self.table.range(
+            self.col, lo, hi, lo_inclusive, hi_inclusive, self.reverse
+        ))
+
+    def describe(self):
+        lo, hi, lo_inclusive, hi_inclusive = self.bounds
+        text = f"RangeScan on {self.table.name} using sorted index {self.col}"
+        if lo is not None or hi is not None:
+            text += " {}{}, {}{}".format(
+                "[" if lo_inclusive else "(", "-inf" if lo is None else _sql(lo),
+                "+inf" if hi is None else _sql(hi), "]" if hi_inclusive else ")",
+            )
+        return text + (" backward" if self.reverse else "")
+
+
+class TextSearch:
+    """LIKE / CONTAINS through a trigram index: rows holding every
+    literal part of the pattern, checked against the whole pattern."""
+
+    def __init__(self, table, predicate):
+        self.table = table
+        self.predicate = predicate
+        index = table.text_indexes[predicate.col]
+        self.estimate = min(index.estimate(part) for part in predicate.parts)
+        self.ordered_by = None
+
+    def rows(self):
+        counters["text_searches"] += 1
+        index = self.table.text_indexes[self.predicate.col]
+        rids = set.intersection(*(index.search(part) for part in self.predicate.parts))
+        check = self.predicate.compile(self.table)
+        for row in _examined(self, self.table.fetch(sorted(rids))):
+            if check(row):
+                yield row
+
+    def describe(self):
+        return (f"TextSearch on {self.table.name} using trigram index "
+                f"{self.predicate.col} for {self.predicate}")
+
+
+class Intersect:
+    """Rows produced by every child (AND of indexed predicates)."""
+
+    def __init__(self, children):
+        self.children = sorted(children, key=lambda p: p.estimate)
+        self.estimate = self.children[0].estimate
+        self.ordered_by = self.children[0].ordered_by
+
+    def rows(self):
+        # probe the smallest input against the others' row sets
+        others = [{id(r) for r in child.rows()} for child in self.children[1:]]
+        for row in self.children[0].rows():
+            if all(id(row) in ids for ids in others):
+                yield row
+
+    def describe(self):
+        return "Intersect"
+
+
+class Union:
+    """Rows produced by any child (OR of indexed predicates), without duplicates."""
+
+    def __init__(self, children):
+        self.children = children
+        self.estimate = sum(p.estimate for p in children)
+        self.ordered_by = None
+
+    def rows(self):
+        seen = set()
+        for child in self.children:
+            for row in child.rows():
+                if id(row) not in seen:
+                    seen.add(id(row))
+                    yield row
+
+    def describe(self):
+        return "Union"
+
+
+class Filter:
+    """Residual predicates the access path could not answer.
+
+    With table None the rows are dicts (groups of an aggregate).
+    """
+
+    def __init__(self, table, child, predicate):
+        self.table = table
+        self.child = child
+        self.predicate = predicate
+        self.estimate = child.estimate
+        self.ordered_by = child.ordered_by
+
+    def rows(self):
+        if self.table is None:
+            check = self.predicate.matches
+        else:
+            check = self.predicate.compile(self.table)
+        for row in self.child.rows():
+            if check(row):
+                yield row
+
+    def describe(self):
+        return f"Filter {self.predicate}"
+
+
+class Sort:
+    """ORDER BY; with table None the rows are dicts."""
+
+    def __init__(self, table, child, col, desc=False, limit=None):
+        self.table = table
+        self.child = child
+        self.col = col
+        self.desc = desc
+        self.limit = limit
+        self.estimate = child.estimate if limit is None else min(limit, child.estimate)
+        self.ordered_by = (col, desc)
+
+    def rows(self):
+        if self.table is None:
+            get = operator.itemgetter(self.col)
+        else:
+            get = self.table.getter(self.col)
+        key = lambda r: (get(r) is not None, get(r))
+        if self.limit is not None:
+            # top-N with a heap instead of sorting everything
+            pick = heapq.nlargest if self.desc else heapq.nsmallest
+            yield from pick(self.limit, self.child.rows(), key=key)
+        else:
+            yield from sorted(self.child.rows(), key=key, reverse=self.desc)
+
+    def describe(self):
+        text = f"Sort by {self.col}" + (" DESC" if self.desc else "")
+        return text if self.limit is None else f"{text}, top {self.limit}"
+
+
+class Limit:
+    """LIMIT / OFFSET: stops pulling from the child once count rows are out."""
+
+    def __init__(self, child, count=None, offset=0):
+        self.child = child
+        self.count = count
+        self.offset = offset
+        remaining = max(0, child.estimate - offset)
+        self.estimate = remaining if count is None else min(count, remaining)
+        self.ordered_by = child.ordered_by
+
+    def rows(self):
+        stop = None if self.count is None else self.offset + self.count
+        return itertools.islice(self.child.rows(), self.offset, stop)
+
+    def describe(self):
+        text = "Limit" if self.count is None else f"Limit {self.count}"
+        return f"{text} offset {self.offset}" if self.offset else text
+
+
+class Project:
+    """Keep only the selected columns; builds one dict per output row."""
+
+    def __init__(self, child, columns):
+        self.child = child
+        self.columns = columns
+        self.estimate = child.estimate
+        self.ordered_by = child.ordered_by
+
+    def rows(self):
+        columns = self.columns
+        for row in self.child.rows():
+            yield {col: row[col] for col in columns}
+
+    def describe(self):
+        return "Project " + ", ".join(self.columns)
+
+
+# -------------------------------
+# Binding
+# -------------------------------
+# Parsed clauses (main/parser.py) -> the predicates and aggregate specs
+# above, with ? parameter values filled in. Used by main/sql.py, and by
+# materialized views, which compile their definition on load.
+
+def bind_value(node, params=()):
+    if isinstance(node, Param):
+        return params[node.index]
+    return node.value
+
+
+def _where_column(col):
+    if isinstance(col, Aggregate):
+        raise Exception("Aggregates are not allowed in WHERE; use HAVING")
+    return col
+
+
+def bind(node, params=(), column=_where_column):
+    """WHERE AST -> planner predicate; column(col) gives the name to test
+    (for HAVING, an aggregate's output name)."""
+    if node is None:
+        return None
+    if isinstance(node, Comparison):
+        if node.op in ("LIKE", "CONTAINS"):
+            return Like(
+                column(node.col), bind_value(node.value, params), node.op == "CONTAINS"
+            )
+        return Compare(column(node.col), node.op, bind_value(node.value, params))
+    if isinstance(node, BetweenExpr):
+        return Between(
+            column(node.col), bind_value(node.lo, params), bind_value(node.hi, params)
+        )
+    if isinstance(node, AndExpr):
+        return And([bind(item, params, column) for item in node.items])
+    if isinstance(node, OrExpr):
+        return Or([bind(item, params, column) for item in node.items])
+    raise Exception("Unsupported WHERE clause")
+
+
+def grouping(node, params=(), table=None):
+    """plan_aggregate arguments for a grouped SELECT node.
+
+    SELECT user_id, SUM(amount) AS total FROM orders GROUP BY user_id
+        HAVING COUNT(*) > 1 ORDER BY total DESC LIMIT 10
+    -> aggregates as (name, func, col), HAVING and ORDER BY in terms of
+    output names. An aggregate used only in HAVING / ORDER BY is
+    computed but not selected. With table, columns are checked against it.
+    """
+    if node.columns is None:
+        raise Exception("SELECT * cannot be used with GROUP BY or aggregates")
+    group_by = node.group_by or []
+    if table is not None:
+        for col in group_by:
+            if col not in table.columns:
+                raise Exception(f"Unknown column {col}")
+    aggregates = []
+    computed = set()
+    names = {}
+
+    def aggregate(item, reuse=False):
+        # reuse: HAVING / ORDER BY SUM(x) means the selected SUM(x), aliased or not
+        key = (item.func, item.col)
+        if reuse and key in names and not item.alias:
+            return names[key]
+        if item.name not in computed:
+            if table is not None and item.col is not None:
+                if item.col not in table.columns:
+                    raise Exception(f"Unknown column {item.col}")
+                if item.func in ("SUM", "AVG") and table.types.get(item.col) == "TEXT":
+                    raise Exception(f"{item.func} needs a numeric column, {item.col} is TEXT")
+            aggregates.append((item.name, item.func, item.col))
+            computed.add(item.name)
+            names.setdefault(key, item.name)
+        return item.name
+
+    columns = []
+    for item in node.columns:
+        if isinstance(item, Aggregate):
+            columns.append(aggregate(item))
+        elif item in group_by:
+            columns.append(item)
+        else:
+            raise Exception(f"Column {item} must appear in GROUP BY or be used in an aggregate")
+
+    def output(col):
+        # a HAVING / ORDER BY operand -> name of a group column or aggregate
+        if isinstance(col, Aggregate):
+            return aggregate(col, reuse=True)
+        if col not in group_by and col not in columns:
+            raise Exception(f"{col} is neither a GROUP BY column nor a selected aggregate")
+        return col
+
+    having = bind(node.having, params, output)
+    order_by = None if node.order_by is None else output(node.order_by)
+    return {
+        "group_by": group_by,
+        "aggregates": aggregates,
+        "having": having,
+        "order_by": order_by,
+        "desc": node.desc,
+        "limit": node.limit,
+        "offset": node.offset,
+        "columns": columns,
+    }
+
+
+# -------------------------------
+# Planning
+# -------------------------------
+def plan_where(table, predicate):
+    """Choose an access path that yields exactly the rows matching predicate."""
+    if predicate is None:
+        return FullScan(table)
+    plan = _access(table, predicate)
+    if plan is None:
+        if vector.available(table) and _vectorizable(table, predicate):
+            return VectorScan(table, predicate)
+        return FullScan(table, predicate)
+    return plan
+
+
+def _vectorizable(table, predicate):
+    # whether a VectorScan can evaluate some of the predicate on arrays
+    if isinstance(predicate, And):
+        return any(p.vectorizable(table) for p in predicate.items)
+    return predicate.vectorizable(table)
+
+
+def plan_select(table, predicate=None, order_by=None, desc=False, limit=None,
+                offset=0, columns=None):
+    """Plan SELECT cols FROM table [WHERE] [ORDER BY] [LIMIT] [OFFSET].
+
+    The plan is a pipeline of generators (scan -> filter -> sort ->
+    limit -> project): rows are produced one at a time, so LIMIT stops
+    the scan as soon as enough rows are out.
+    """
+    plan = plan_where(table, predicate)
+    top_n = None if limit is None else limit + offset
+
+    if order_by is not None and plan.ordered_by != (order_by, desc):
+        if isinstance(plan, RangeScan) and plan.col == order_by:
+            # same index, other direction: just walk it backwards
+            lo, hi, lo_inclusive, hi_inclusive = plan.bounds
+            plan = RangeScan(table, order_by, lo, hi, lo_inclusive,
+                             hi_inclusive, reverse=desc)
+        elif (order_by in table.ordered_indexes
+              and plan.estimate * 2 > len(table.rows)):
+            # the predicate is not selective: walking the ORDER BY index
+            # and filtering lets LIMIT stop early
+            plan = RangeScan(table, order_by, reverse=desc)
+            if predicate is not None:
+                plan = Filter(table, plan, predicate)
+        else:
+            plan = Sort(table, plan, order_by, desc, top_n)
+
+    if limit is not None or offset:
+        plan = Limit(plan, limit, offset)
+    if columns is not None:
+        plan = Project(plan, columns)
+    return plan
+
+
+def _access(table, predicate):
+    # Index plan that produces exactly the matching rows, or None
+    if isinstance(predicate, (Compare, Between, Like)):
+        return _leaf(table, predicate)
+
+    if isinstance(predicate, And):
+        indexed = []
+        residual = []
+        for p in predicate.items:
+            plan = _access(table, p)
+            if plan is None:
+                residual.append(p)
+            else:
+                indexed.append((plan, p))
+        if not indexed:
+            return None
+
+        # drive with the most selective index; intersect with the others
+        # only when they are about as selective, otherwise reading them
+        # costs more than re-checking their predicate on each row
+        indexed.sort(key=lambda item: item[0].estimate)
+        driver = indexed[0][0]
+        merged = [driver]
+        for plan, p in indexed[1:]:
+            if plan.estimate <= INTERSECT_RATIO * max(driver.estimate, 1):
+                merged.append(plan)
+            else:
+                residual.append(p)
+
+        plan = driver if len(merged) == 1 else Intersect(merged)
+        if residual:
+            plan = Filter(table, plan, And(residual))
+        return plan
+
+    if isinstance(predicate, Or):
+        children = [_access(table, p) for p in predicate.items]
+        if any(plan is None for plan in children):
+            # one branch needs a scan anyway
+            return None
+        return Union(children)
+
+    raise Exception("Unsupported predicate")
+
+
+def _leaf(table, predicate):
+    col = predicate.col
+    if isinstance(predicate, Like):
+        if col in table.text_indexes and predicate.parts:
+            return TextSearch(table, predicate)
+        return None
+    if isinstance(predicate, Compare) and predicate.op in ("!=", "<>"):
+        return None
+    if isinstance(predicate, Compare) and predicate.op == "=":
+        if col in table.indexes or col in table.secondary_indexes:
+            return IndexLookup(table, col, predicate.value)
+    if col in table.ordered_indexes:
+        return RangeScan(table, col, *predicate.bounds())
+    return None
+
+
+# -------------------------------
+# Aggregation
+# -------------------------------
+# An aggregate is (name, func, col): func is COUNT, SUM, AVG, MIN or
+# MAX and col None for COUNT(*). NULL values are skipped; over no values
+# an aggregate is NULL, except COUNT which is 0. Aggregate nodes yield
+# one dict per group: the GROUP BY columns plus each aggregate's name.
+
+def _new_state(aggregates):
+    # running state of one group: a count, [total, count] or a value
+    return [
+        0 if func == "COUNT" else [0, 0] if func in ("SUM", "AVG") else None
+        for _, func, _ in aggregates
+    ]
+
+
+def _steps(aggregates, getter):
+    # step(state, row) per aggregate, folding one row into a group
+    steps = []
+    for i, (_, func, col) in enumerate(aggregates):
+        if col is None:
+            def step(state, row, i=i):
+                state[i] += 1
+        elif func == "COUNT":
+            def step(state, row, i=i, get=getter(col)):
+                if get(row) is not None:
+                    state[i] += 1
+        elif func in ("SUM", "AVG"):
+            def step(state, row, i=i, get=getter(col)):
+                v = get(row)
+                if v is not None:
+                    total = state[i]
+                    total[0] += v
+                    total[1] += 1
+        else:
+            better = operator.lt if func == "MIN" else operator.gt
+
+            def step(state, row, i=i, get=getter(col), better=better):
+                v = get(row)
+                if v is not None and (state[i] is None or better(v, state[i])):
+                    state[i] = v
+        steps.append(step)
+    return steps
+
+
+def _fold(state, aggregates, gets, rows):
+    # fold a block of rows into one group at once, with builtins
+    for i, (_, func, col) in enumerate(aggregates):
+        if col is None:
+            state[i] += len(rows)
+            continue
+        values = [v for v in map(gets[i], rows) if v is not None]
+        if func == "COUNT":
+            state[i] += len(values)
+        elif func in ("SUM", "AVG"):
+            state[i][0] += sum(values)
+            state[i][1] += len(values)
+        elif values:
+            best = min(values) if func == "MIN" else max(values)
+            if state[i] is None or (best < state[i] if func == "MIN" else best > state[i]):
+                state[i] = best
+
+
+def _describe_aggregates(group_by, aggregates):
+    # "COUNT(*), SUM(amount) by user_id", for EXPLAIN
+    text = ", ".join(f"{func}({col or '*'})" for _, func, col in aggregates)
+    if group_by:
+        text += (" by " if text else "by ") + ", ".join(group_by)
+    return text
+
+
+def _result(group_by, key, aggregates, state):
+    row = dict(zip(group_by, key))
+    for (name, func, _), value in zip(aggregates, state):
+        if func == "SUM":
+            value = value[0] if value[1] else None
+        elif func == "AVG":
+            value = value[0] / value[1] if value[1] else None
+        row[name] = value
+    return row
+
+
+class HashAggregate:
+    """GROUP BY in one pass: a dict of running aggregates per group."""
+
+    def __init__(self, child, getter, group_by, aggregates):
+        self.child = child
+        self.getter = getter
+        self.group_by = group_by
+        self.aggregates = aggregates
+        self.estimate = child.estimate if group_by else 1
+        self.ordered_by = None
+
+    def rows(self):
+        group_by = self.group_by
+        aggregates = self.aggregates
+        if not group_by:
+            # one group, even over no rows
+            state = _new_state(aggregates)
+            gets = [col and self.getter(col) for _, _, col in aggregates]
+            rows = self.child.rows()
+            for block in iter(lambda: list(itertools.islice(rows, AGGREGATE_BLOCK)), []):
+                _fold(state, aggregates, gets, block)
+            yield _result((), (), aggregates, state)
+            return
+
+        if len(group_by) == 1:
+            key_of = self.getter(group_by[0])
+        else:
+            gets = [self.getter(col) for col in group_by]
+            key_of = lambda row: tuple(get(row) for get in gets)
+        steps = _steps(aggregates, self.getter)
+        groups = {}
+        for row in self.child.rows():
+            key = key_of(row)
+            state = groups.get(key)
+            if state is None:
+                state = groups[key] = _new_state(aggregates)
+            for step in steps:
+                step(state, row)
+        for key, state in groups.items():
+            if len(group_by) == 1:
+                key = (key,)
+            yield _result(group_by, key, aggregates, state)
+
+    def describe(self):
+        return "HashAggregate " + _describe_aggregates(self.group_by, self.aggregates)
+
+
+class StreamAggregate:
+    """GROUP BY over input sorted by the group column (a sorted index).
+
+    Each group is finished as soon as the key changes, so only one group
+    is held at a time, groups come out in key order and LIMIT stops the
+    scan early.
+    """
+
+    def __init__(self, child, getter, col, aggregates):
+        self.child = child
+        self.getter = getter
+        self.col = col
+        self.aggregates = aggregates
+        self.estimate = child.estimate
+        self.ordered_by = child.ordered_by
+
+    def rows(self):
+        get = self.getter(self.col)
+        steps = _steps(self.aggregates, self.getter)
+        group_by = (self.col,)
+        state = None
+        current = None
+        for row in self.child.rows():
+            key = get(row)
+            if state is None or key != current:
+                if state is not None:
+                    yield _result(group_by, (current,), self.aggregates, state)
+                state = _new_state(self.aggregates)
+                current = key
+            for step in steps:
+                step(state, row)
+        if state is not None:
+            yield _result(group_by, (current,), self.aggregates, state)
+
+    def describe(self):
+        return "StreamAggregate " + _describe_aggregates([self.col], self.aggregates)
+
+
+class VectorAggregate:
+    """Aggregates of INT columns, grouped by at most one INT column,
+    computed on NumPy column arrays (main/vector.py) with the WHERE as a
+    mask. Groups come out in the order a HashAggregate over a scan
+    yields them; without a usable column cache it is that HashAggregate."""
+
+    def __init__(self, table, predicate, fallback):
+        self.table = table
+        self.predicate = predicate
+        self.group_col = fallback.group_by[0] if fallback.group_by else None
+        self.aggregates = fallback.aggregates
+        self.fallback = fallback
+        self.estimate = fallback.estimate
+        self.ordered_by = None
+
+    def rows(self):
+        results = None
+        with self.table.reading() as ts:
+            cache = vector.cache_for(self.table, ts)
+            if cache is not None:
+                mask = None
+                if self.predicate is not None:
+                    mask = self.predicate.vector(cache, ts)
+                if self.predicate is None or mask is not None:
+                    results = vector.aggregate(
+                        cache, ts, mask, self.group_col, self.aggregates
+                    )
+            if results is not None:
+                counters["vector_scans"] += 1
+                stats = getattr(self, "stats", None)
+                if stats is not None:
+                    stats.examined = len(cache.row_ids(ts))
+        if results is None:
+            results = self.fallback.rows()
+        yield from results
+
+    def describe(self):
+        group_by = [self.group_col] if self.group_col else []
+        text = (f"VectorAggregate on {self.table.name} "
+                f"{_describe_aggregates(group_by, self.aggregates)}")
+        if self.predicate is not None:
+            text += f" mask {self.predicate}"
+        return text
+
+
+def _vector_aggregate(table, plan, predicate, group_by, aggregates):
+    # whether VectorAggregate can replace a HashAggregate over plan
+    types = table.types
+    return (
+        vector.available(table)
+        and isinstance(plan, (FullScan, VectorScan))
+        and len(group_by) <= 1
+        and all(types.get(col) == "INT" for col in group_by)
+        and all(col is None or types.get(col) == "INT" for _, _, col in aggregates)
+        and (predicate is None or predicate.vectorizable(table))
+    )
+
+
+class Rows:
+    """Rows produced outside the planner (a join), as a plan input."""
+
+    def __init__(self, rows, estimate=0):
+        self._rows = rows
+        self.estimate = estimate
+        self.ordered_by = None
+
+    def rows(self):
+        return iter(self._rows)
+
+    def describe(self):
+        return "Rows"
+
+
+def plan_aggregate(table, predicate=None, group_by=(), aggregates=(), having=None,
+                   order_by=None, desc=False, limit=None, offset=0, columns=None):
+    """Plan SELECT ... [WHERE] GROUP BY ... [HAVING] [ORDER BY] [LIMIT].
+
+    Rows are hashed by group in one pass (HashAggregate), or, for INT
+    columns of a large table with NumPy installed, aggregated as arrays
+    (VectorAggregate). When they
+    already come out ordered by the one GROUP BY column, or ORDER BY
+    that column with a LIMIT can walk its sorted index, each run of
+    equal keys is aggregated as it goes by (StreamAggregate) and LIMIT
+    stops the scan early. Walking a whole index is slower than a scan,
+    so it is not used just to group.
+    """
+    plan = plan_where(table, predicate)
+    if len(group_by) == 1:
+        col = group_by[0]
+        if ((plan.ordered_by is None or plan.ordered_by[0] != col)
+                and order_by == col and limit is not None
+                and col in table.ordered_indexes
+                and plan.estimate * 2 > len(table.rows)):
+            plan = RangeScan(table, col, reverse=order_by == col and desc)
+            if predicate is not None:
+                plan = Filter(table, plan, predicate)
+        if plan.ordered_by is not None and plan.ordered_by[0] == col:
+            plan = StreamAggregate(plan, table.getter, col, aggregates)
+    if not isinstance(plan, StreamAggregate):
+        hashed = HashAggregate(plan, table.getter, list(group_by), aggregates)
+        if _vector_aggregate(table, plan, predicate, group_by, aggregates):
+            plan = VectorAggregate(table, predicate, hashed)
+        else:
+            plan = hashed
+    return _aggregate_output(plan, having, order_by, desc, limit, offset, columns)
+
+
+def aggregate_rows(rows, group_by=(), aggregates=(), having=None, order_by=None,
+                   desc=False, limit=None, offset=0, columns=None):
+    """Like plan_aggregate, over dict rows (of a join) instead of a table."""
+    plan = HashAggregate(Rows(rows), operator.itemgetter, list(group_by), aggregates)
+    return _aggregate_output(plan, having, order_by, desc, limit, offset, columns)
+
+
+def _aggregate_output(plan, having, order_by, desc, limit, offset, columns):
+    # HAVING -> ORDER BY -> LIMIT -> the selected columns, over groups
+    if having is not None:
+        plan = Filter(None, plan, having)
+    if order_by is not None and plan.ordered_by != (order_by, desc):
+        top_n = None if limit is None else limit + offset
+        plan = Sort(None, plan, order_by, desc, top_n)
+    if limit is not None or offset:
+        plan = Limit(plan, limit, offset)
+    if columns is not None:
+        plan = Project(plan, columns)
+    return plan
+
+
+# -------------------------------
+# Joins
+# -------------------------------
+# Join nodes yield (left row, right row) pairs from pairs(); the right
+# row is None for a LEFT JOIN row without a match. NULL keys never
+# match. cost is a rough count of row visits and probes, used only to
+# compare strategies for the same join.
+
+def _describe_join(plan):
+    kind = "Left join" if plan.how == "left" else "Join"
+    return (f"{kind} {plan.left.name}.{plan.left_key} = "
+            f"{plan.right.name}.{plan.right_key}: {plan.method}")
+
+
+def _probe_cost(table, col):
+    # cost of one equality lookup on col, or None if col has no index
+    if col in table.indexes or col in table.secondary_indexes:
+        return 1
+    if col in table.ordered_indexes:
+        return max(1, len(table.rows).bit_length())
+    return None
+
+
+class IndexNestedLoopJoin:
+    """Walk one table and look each key up in an index of the other.
+
+    Normally the left table is walked and the right one probed; an inner
+    join may be swapped to walk the right table and probe the left.
+    """
+
+    def __init__(self, left, right, left_key, right_key, how="inner", swap=False):
+        self.left = left
+        self.right = right
+        self.left_key = left_key
+        self.right_key = right_key
+        self.how = how
+        self.swap = swap
+        outer, inner, inner_key = (right, left, left_key) if swap else (left, right, right_key)
+        self.method = f"index nested loop on {inner.name}.{inner_key}"
+        self.cost = len(outer.rows) * _probe_cost(inner, inner_key)
+
+    def pairs(self):
+        with self.left.reading() as ts:
+            yield from self._pairs(ts)
+
+    def describe(self):
+        return _describe_join(self)
+
+    def _pairs(self, ts):
+        if self.swap:
+            get = self.right.getter(self.right_key)
+            for rrow in self.right.all(ts):
+                key = get(rrow)
+                if key is None:
+                    continue
+                for lrow in self.left.find_all(self.left_key, key, ts):
+                    yield lrow, rrow
+            return
+
+        get = self.left.getter(self.left_key)
+        left_outer = self.how == "left"
+        for lrow in self.left.all(ts):
+            key = get(lrow)
+            matches = self.right.find_all(self.right_key, key, ts) if key is not None else ()
+            if matches:
+                for rrow in matches:
+                    yield lrow, rrow
+            elif left_outer:
+                yield lrow, None
+
+
+class HashJoin:
+    """Build a hash table on the smaller input and probe it with the other."""
+
+    def __init__(self, left, right, left_key, right_key, how="inner"):
+        self.left = left
+        self.right = right
+        self.left_key = left_key
+        self.right_key = right_key
+        self.how = how
+        self.build_left = len(left.rows) < len(right.rows)
+        build = left if self.build_left else right
+        self.method = f"hash join, build on {build.name}"
+        self.cost = len(left.rows) + len(right.rows) + len(build.rows)
+
+    def pairs(self):
+        with self.left.reading() as ts:
+            yield from self._pairs(ts)
+
+    def describe(self):
+        return _describe_join(self)
+
+    def _pairs(self, ts):
+        if self.build_left:
+            build, build_key, probe, probe_key = self.left, self.left_key, self.right, self.right_key
+        else:
+            build, build_key, probe, probe_key = self.right, self.right_key, self.left, self.left_key
+
+        buckets = {}
+        get = build.getter(build_key)
+        for row in build.scan(ts):
+            key = get(row)
+            if key is not None:
+                buckets.setdefault(key, []).append(row)
+
+        get = probe.getter(probe_key)
+        left_outer = self.how == "left"
+        if not self.build_left:
+            for lrow in probe.all(ts):
+                matches = buckets.get(get(lrow))
+                if matches:
+                    for rrow in matches:
+                        yield lrow, rrow
+                elif left_outer:
+                    yield lrow, None
+            return
+
+        # left side was hashed: remember which left rows matched so a
+        # LEFT JOIN can add the rest afterwards
+        matched = set()
+        for rrow in probe.all(ts):
+            for lrow in buckets.get(get(rrow), ()):
+                if left_outer:
+                    matched.add(id(lrow))
+                yield lrow, rrow
+        if left_outer:
+            for lrow in self.left.all(ts):
+                if id(lrow) not in matched:
+                    yield lrow, None
+
+
+class MergeJoin:
+    """Walk the sorted indexes of both join keys side by side.
+
+    Needs no hash table; output comes in join key order (with unmatched
+    NULL-key rows of a LEFT JOIN first).
+    """
+
+    def __init__(self, left, right, left_key, right_key, how="inner"):
+        self.left = left
+        self.right = right
+        self.left_key = left_key
+        self.right_key = right_key
+        self.how = how
+        self.method = "merge join"
+        self.cost = len(left.rows) + len(right.rows)
+
+    def pairs(self):
+        with self.left.reading() as ts:
+            yield from self._pairs(ts)
+
+    def describe(self):
+        return _describe_join(self)
+
+    def _pairs(self, ts):
+        # both sides in key order, read from the sorted indexes in one go
+        left_rows = list(self.left.ordered(self.left_key, ts=ts))
+        right_rows = list(self.right.ordered(self.right_key, ts=ts))
+        get = self.left.getter(self.left_key)
+        left_keys = [get(row) for row in left_rows]
+        get = self.right.getter(self.right_key)
+        right_keys = [get(row) for row in right_rows]
+        left_outer = self.how == "left"
+
+        # NULL keys come first and never match
+        nulls = left_keys.count(None)
+        if left_outer:
+            for lrow in left_rows[:nulls]:
+                yield lrow, None
+        del left_keys[:nulls], left_rows[:nulls]
+        nulls = right_keys.count(None)
+        del right_keys[:nulls], right_rows[:nulls]
+
+        i, j = 0, 0
+        n, m = len(left_keys), len(right_keys)
+        while i < n:
+            key = left_keys[i]
+            # skip right keys below this one with a binary search, so a
+            # small left side does not walk the whole right index
+            j = bisect_left(right_keys, key, j)
+            end = bisect_right(right_keys, key, j)
+            while i < n and left_keys[i] == key:
+                if end > j:
+                    for k in range(j, end):
+                        yield left_rows[i], right_rows[k]
+                elif left_outer:
+                    yield left_rows[i], None
+                i += 1
+            j = end
+            if j >= m and not left_outer:
+                return
+
+
+def plan_join(left, right, left_key, right_key, how="inner"):
+    """Cheapest way to join left.left_key = right.right_key.
+
+    Index nested loop when either side already has an index on its key
+    (the left side only for an inner join), merge join when both keys
+    have sorted indexes, otherwise a hash join built on the smaller table.
+    """
+    candidates = []
+    if _probe_cost(right, right_key) is not None:
+        candidates.append(IndexNestedLoopJoin(left, right, left_key, right_key, how))
+    if how == "inner" and _probe_cost(left, left_key) is not None:
+        candidates.append(
+            IndexNestedLoopJoin(left, right, left_key, right_key, how, swap=True)
+        )
+    if left_key in left.ordered_indexes and right_key in right.ordered_indexes:
+        candidates.append(MergeJoin(left, right, left_key, right_key, how))
+    candidates.append(HashJoin(left, right, left_key, right_key, how))
+    return min(candidates, key=lambda plan: plan.cost)
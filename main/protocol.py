@@ -0,0 +1,74 @@
+import json
+import os
+import socket
+import struct
+
+# -------------------------------
+# Wire protocol of main/server.py
+# -------------------------------
+# A connection carries frames both ways: a 4-byte big-endian length,
+# then that many bytes of UTF-8 JSON.
+#
+# Request:   {"id": 1, "sql": "SELECT * FROM users WHERE id = ?", "params": [1]}
+#            {"id": 2, "call": "page", "args": {"table": "users", "after": 50}}
+#            {"id": 3, "sql": "INSERT INTO users VALUES (?, ?)", "many": [[1, "a"], [2, "b"]]}
+# Response:  {"id": 1, "ok": true, "result": [...]}
+#            {"id": 2, "ok": false, "error": "Row not found"}
+#
+# A frame may also hold a JSON list of requests (a batch): they run in
+# order and the answer is one frame with the list of responses. Clients
+# may pipeline: send any number of frames before reading; responses come
+# back in request order. "many" runs the statement once per list of
+# params, in one transaction (main.sql.execute_many). "txn": true is added to a response while the
+# connection has a transaction open (BEGIN without COMMIT/ROLLBACK).
+#
+# This module imports nothing from the engine, so clients (every web
+# worker) do not load the database just to talk to the server.
+
+# Environment variable naming the server: "unix:/path/db.sock",
+# "/path/db.sock" or "host:port"
+SERVER_ENV = "MINIRDBMS_SERVER"
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_ADDRESS = "unix:" + os.path.join(BASE_DIR, "db.sock")
+
+# Largest frame either side accepts
+MAX_FRAME = 64 * 1024 * 1024
+
+_LENGTH = struct.Struct(">I")
+
+
+def parse_address(text):
+    """(socket family, address) for an address string."""
+    if text.startswith("unix:"):
+        return socket.AF_UNIX, text[len("unix:"):]
+    if "/" in text:
+        return socket.AF_UNIX, text
+    host, sep, port = text.rpartition(":")
+    if not sep or not port.isdigit():
+        raise Exception(f"Bad server address {text!r}: use unix:/path or host:port")
+    return socket.AF_INET, (host or "127.0.0.1", int(port))
+
+
+def encode(message, default=None):
+    """One frame for message."""
+    data = json.dumps(message, separators=(",", ":"), default=default).encode()
+    if len(data) > MAX_FRAME:
+        raise Exception(f"Message of {len(data)} bytes is larger than {MAX_FRAME}")
+    return _LENGTH.pack(len(data)) + data
+
+
+def read_frame(stream):
+    """Next message from a binary file object, or None at end of stream."""
+    header = stream.read(_LENGTH.size)
+    if not header:
+        return None
+    if len(header) < _LENGTH.size:
+        raise Exception("Connection closed in the middle of a frame")
+    (length,) = _LENGTH.unpack(header)
+    if length > MAX_FRAME:
+        raise Exception(f"Frame of {length} bytes is larger than {MAX_FRAME}")
+    data = stream.read(length)
+    if len(data) < length:
+        raise Exception("Connection closed in the middle of a frame")
+    return json.loads(data)
@@ -1,17 +1,21 @@
-from main.sql import execute
+from main.client import connect
 
 print("MiniRDBMS REPL (type exit to quit)")
 
-while True:
-    q = input("sql> ")
-    if q.lower() == "exit":
-        break
-    try:
-        result = execute(q)
-        if isinstance(result, list):
-            for r in result:
-                print(r)
-        else:
-            print(result)
-    except Exception as e:
-        print("Error:", e)
+# the server when MINIRDBMS_SERVER is set, else this process's copy
+# (reloaded before each statement to pick up changes from the web app);
+# one connection throughout, so BEGIN ... COMMIT spans statements
+with connect().connection() as database:
+    while True:
+        q = input("sql> ")
+        if q.lower() == "exit":
+            break
+        try:
+            result = database.execute(q)
+            if isinstance(result, list):
+                for r in result:
+                    print(r)
+            else:
+                print(result)
+        except Exception as e:
+            print("Error:", e)
@@ -0,0 +1,451 @@
+import threading
+from functools import partial
+from itertools import chain, repeat
+from operator import attrgetter, is_not
+from sys import getrefcount
+
+
+# -------------------------------
+# Versions
+# -------------------------------
+# Timestamps are commit numbers (Database.clock). A version made by a
+# transaction that has not committed is stamped PENDING, newer than any
+# snapshot; reading at LATEST sees those too (the writer's own view).
+PENDING = LATEST = float("inf")
+
+
+def visible(row, ts):
+    """The version of a row (its head version) a snapshot at ts sees."""
+    while row is not None and row._begin > ts:
+        row = row._prev
+    if row is None or row._deleted:
+        return None
+    return row
+
+
+def _visible_rows(slots, ts):
+    for row in slots:
+        if row is None:
+            continue
+        if row._begin > ts or row._deleted:
+            row = visible(row, ts)
+            if row is None:
+                continue
+        yield row
+
+
+_is_row = partial(is_not, None)
+
+
+# -------------------------------
+# Compact rows
+# -------------------------------
+class Row:
+    """Base class for a table's row type.
+
+    Each table gets a subclass whose values live in __slots__ instead of a
+    per-row dict, so a row costs one small object rather than a hash table
+    repeating every column name. Rows still behave like a read/write
+    mapping (row["id"], row.get, items(), dict(row)), which is what the
+    SQL layer, joins and templates rely on. Plain dicts are made only at
+    the API boundary (JSON, DRF responses) with dict(row).
+    """
+
+    # _rid: the row's slot in its table's RowStore. _begin: commit
+    # timestamp of this version (PENDING until its transaction commits).
+    # _prev: the version this one replaced, kept while a snapshot may
+    # still read it
+    __slots__ = ("_rid", "_begin", "_prev")
+    _columns = ()
+    _fields = {}  # column -> slot name
+    _deleted = False
+
+    def __init__(self, values):
+        self._begin = 0
+        self._prev = None
+        for col, slot in self._fields.items():
+            setattr(self, slot, values.get(col))
+
+    @classmethod
+    def from_values(cls, values):
+        """Build a row from values in column order."""
+        row = cls.__new__(cls)
+        row._begin = 0
+        row._prev = None
+        for slot, value in zip(cls._fields.values(), values):
+            setattr(row, slot, value)
+        return row
+
+    def __getitem__(self, col):
+        try:
+            slot = self._fields[col]
+        except KeyError:
+            raise KeyError(col) from None
+        return getattr(self, slot)
+
+    def __setitem__(self, col, value):
+        try:
+            slot = self._fields[col]
+        except KeyError:
+            raise KeyError(col) from None
+        setattr(self, slot, value)
+
+    def __contains__(self, col):
+        return col in self._fields
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self):
+        return len(self._columns)
+
+    def __eq__(self, other):
+        if isinstance(other, Row):
+            return self.items() == other.items()
+        if isinstance(other, dict):
+            return dict(self.items()) == other
+        return NotImplemented
+
+    # rows are compared by identity in indexes and undo entries
+    __hash__ = object.__hash__
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def get(self, col, default=None):
+        slot = self._fields.get(col)
+        if slot is None:
+            return default
+        return getattr(self, slot)
+
+    def keys(self):
+        return list(self._columns)
+
+    def values(self):
+        return [getattr(self, slot) for slot in self._fields.values()]
+
+    def items(self):
+        return [(col, getattr(self, slot)) for col, slot in self._fields.items()]
+
+    def copy(self):
+        """A plain dict snapshot of the row."""
+        return dict(self.items())
+
+    to_dict = copy
+
+    def update(self, values):
+        for col, value in values.items():
+            self[col] = value
+
+
+class Deleted:
+    """Head version of a deleted row.
+
+    A delete is a version like any other: snapshots taken before it
+    commits walk past it to the row, later ones see nothing.
+    """
+
+    __slots__ = ("_rid", "_begin", "_prev")
+    _deleted = True
+
+    def __init__(self, row):
+        self._rid = row._rid
+        self._begin = PENDING
+        self._prev = row
+
+
+def row_class(table_name, columns):
+    """Build the compact row type for a table with these columns."""
+    slots = tuple(f"_{i}" for i in range(len(columns)))
+    namespace = {
+        "__slots__": slots,
+        "_columns": tuple(columns),
+        "_fields": dict(zip(columns, slots)),
+    }
+    return type(f"{table_name.title().replace('_', '')}Row", (Row,), namespace)
+
+
+def getter(row_type, col):
+    """Fast accessor for one column, for scan and join loops."""
+    return attrgetter(row_type._fields[col])
+
+
+def encode_row(value):
+    # json.dump default= hook: rows are written out as plain objects
+    if isinstance(value, Row):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+# -------------------------------
+# Row storage
+# -------------------------------
+# Tombstoned slots handed back to the free list per compact() call
+COMPACT_STEP = 256
+
+# Placeholder in the slot of a row that is still only on disk
+UNLOADED = object()
+
+# Slots copied per step of a snapshot scan
+SCAN_BLOCK = 1024
+
+
+class RowStore:
+    """A table's rows in stable slots, addressed by row id.
+
+    A row keeps its slot (its row id) for as long as it lives, so
+    indexes store row ids instead of row objects. Each slot holds the
+    row's newest version; an update or delete puts a new version (for a
+    delete, a Deleted marker) in front of the old one, which stays
+    linked through _prev while a snapshot may still read it (see
+    Database.reading). Once no snapshot can see a deleted row its slot
+    becomes a tombstone (None); compact() hands tombstoned slots to the
+    free list a few at a time, outside transactions, and inserts reuse
+    them. Iteration yields the latest live rows in slot order; scan(ts)
+    yields what a snapshot at ts sees.
+
+    stable is a timestamp from which every head version is committed and
+    visible: writers set it to PENDING before touching a slot and the
+    commit sets it to its timestamp. A scan whose snapshot is at least
+    that new can take the heads as they are, a block of slots at a time.
+
+    With pages (a PagedRows of a paged database file) the store starts
+    with every row still on disk: each slot holds UNLOADED until a scan
+    or index probe touches it, and then the whole page is decoded. With
+    a pool (a BufferPool) decoded pages are also dropped again when the
+    pool is over budget.
+    """
+
+    def __init__(self, rows=(), pages=None, pool=None):
+        self.slots = []
+        self.free = []       # reusable row ids
+        self.dead = []       # tombstoned row ids not yet reclaimed
+        self.live = 0
+        self.deleted = 0     # slots whose head version is a Deleted
+        self.stable = 0
+        self.pages = pages
+        self.pool = pool if pages is not None else None
+        self.base = 0        # row ids below this come from pages
+        self.unloaded = 0    # chunks with rows not decoded
+        self.dirty = set()   # chunks with changed rows: never evicted
+        self._lock = pool.lock if self.pool is not None else threading.Lock()
+        if pages is not None:
+            self.slots = [UNLOADED] * pages.count
+            self.live = self.base = pages.count
+            self.unloaded = len(pages.chunks)
+        for row in rows:
+            self.append(row)
+
+    def __len__(self):
+        return self.live
+
+    def __iter__(self):
+        if not self.unloaded and self.pool is None and not self.deleted:
+            return filter(_is_row, self.slots)
+        return self.scan()
+
+    def scan(self, ts=LATEST):
+        """Yield the rows a snapshot at ts sees, in slot order."""
+        if not self.unloaded and self.pool is None:
+            return chain.from_iterable(self._blocks(ts))
+        return self._scan_paged(ts)
+
+    def _blocks(self, ts):
+        slots = self.slots
+        start = 0
+        while start < len(slots):
+            # deleted is read before the copy and stable after it, so a
+            # change racing with the copy always shows up in one of them
+            deleted = self.deleted
+            block = slots[start:start + SCAN_BLOCK]
+            start += SCAN_BLOCK
+            if not deleted and ts >= self.stable:
+                yield filter(_is_row, block)
+            else:
+                yield _visible_rows(block, ts)
+
+    def _scan_paged(self, ts):
+        slots = self.slots
+        pages, pool = self.pages, self.pool
+        rid = 0
+        chunk_end = 0
+        while rid < len(slots):
+            row = slots[rid]
+            if chunk_end <= rid < self.base:
+                # first row of the next page: one hit or miss per page
+                chunk = pages.chunk_of(rid)
+                chunk_end = pages.starts[chunk] + pages.chunks[chunk][2]
+                if row is UNLOADED:
+                    row = self._load(rid)
+                elif pool is not None:
+                    pool.hit(self, chunk)
+            elif row is UNLOADED:
+                row = self._load(rid)
+            row = visible(row, ts)
+            if row is not None:
+                yield row
+            rid += 1
+
+    def __getitem__(self, rid):
+        """The head version in slot rid (None for a tombstone)."""
+        row = self.slots[rid]
+        if row is UNLOADED:
+            return self._load(rid)
+        if self.pool is not None and rid < self.base:
+            self.pool.hit(self, self.pages.chunk_of(rid))
+        return row
+
+    def version(self, rid, ts=LATEST):
+        """The version of row rid a snapshot at ts sees, or None."""
+        if rid >= len(self.slots):
+            return None
+        return visible(self[rid], ts)
+
+    def versions(self, rids, ts=LATEST):
+        """version() of each of rids, None where the snapshot sees nothing.
+
+        Lazy for a paged store, so pages are only decoded for the rows a
+        caller actually takes.
+        """
+        if self.unloaded or self.pool is not None:
+            return map(self.version, rids, repeat(ts))
+        slots = self.slots
+        try:
+            rows = [slots[rid] for rid in rids]
+        except IndexError:
+            # a slot reclaimed and trimmed since the ids were read
+            return [self.version(rid, ts) for rid in rids]
+        for i, row in enumerate(rows):
+            if row is not None and (row._begin > ts or row._deleted):
+                rows[i] = visible(row, ts)
+        return rows
+
+    def fetch(self, rids, ts=LATEST):
+        """Rows for a sequence of row ids, in the same order, leaving out
+        the ones a snapshot at ts does not see."""
+        version = self.version
+        return [row for row in (version(rid, ts) for rid in rids) if row is not None]
+
+    def is_live(self, rid):
+        return self.version(rid) is not None
+
+    def _load(self, rid):
+        # decode the chunk holding rid into the slots it covers
+        with self._lock:
+            slots = self.slots
+            if slots[rid] is not UNLOADED:
+                return slots[rid]  # another thread got here first
+            chunk = self.pages.chunk_of(rid)
+            first, rows = self.pages.decode(chunk)
+            for i, row in enumerate(rows, first):
+                if slots[i] is UNLOADED:
+                    row._rid = i
+                    slots[i] = row
+            self.unloaded -= 1
+            row = slots[rid]
+            if self.pool is not None and chunk not in self.dirty:
+                self.pool.admit(self, chunk)
+            return row
+
+    def evict(self, chunk):
+        """Drop the decoded rows of a clean chunk (called by the pool).
+
+        A row still referenced outside the store (a query result, the
+        undo log) keeps its slot, so there is never a second copy of a
+        row in memory.
+        """
+        start = self.pages.starts[chunk]
+        slots = self.slots
+        end = min(start + self.pages.chunks[chunk][2], len(slots))
+        dropped = False
+        for rid in range(start, end):
+            row = slots[rid]
+            if row is None or row is UNLOADED:
+                continue
+            # references: the slot, row, and getrefcount's argument
+            if getrefcount(row) <= 3:
+                slots[rid] = UNLOADED
+                dropped = True
+        if dropped:
+            self.unloaded += 1
+
+    def mark_dirty(self, rid):
+        # a row changed in memory must not be dropped and re-read from
+        # the file, which still has the old version: pin its page
+        if self.pool is not None and rid < self.base:
+            chunk = self.pages.chunk_of(rid)
+            if chunk not in self.dirty:
+                self.dirty.add(chunk)
+                self.pool.discard(self, chunk)
+
+    def append(self, row):
+        self.stable = PENDING
+        if self.free:
+            rid = self.free.pop()
+            self.slots[rid] = row
+            self.mark_dirty(rid)
+        else:
+            rid = len(self.slots)
+            self.slots.append(row)
+        row._rid = rid
+        self.live += 1
+        return rid
+
+    def push(self, version):
+        """Make version (an update of the head, or a Deleted) the head."""
+        rid = version._rid
+        self.mark_dirty(rid)
+        self.stable = PENDING
+        self.slots[rid] = version
+        if version._deleted:
+            self.deleted += 1
+            self.live -= 1
+
+    def revert(self, version):
+        # rollback of push(): the version it replaced is the head again
+        self.slots[version._rid] = version._prev
+        if version._deleted:
+            self.deleted -= 1
+            self.live += 1
+
+    def reclaim(self, rid):
+        # a deleted row no snapshot can see any more: tombstone its slot
+        self.slots[rid] = None
+        self.dead.append(rid)
+        self.deleted -= 1
+
+    def discard(self, rid):
+        # undo of insert: the row was never committed, so its slot can
+        # be reused straight away
+        self.slots[rid] = None
+        self.live -= 1
+        if rid == len(self.slots) - 1:
+            self.slots.pop()
+        else:
+            self.free.append(rid)
+
+    def compact(self, budget=COMPACT_STEP):
+        """Reclaim up to budget tombstones (all of them if budget is None)."""
+        if not self.dead:
+            return 0
+        if self.live == 0 and self.deleted == 0:
+            # nothing left, not even a delete an open snapshot still
+            # reads: start over with an empty slot array
+            count = len(self.dead)
+            self.slots, self.free, self.dead = [], [], []
+            return count
+        if budget is None or budget >= len(self.dead):
+            reclaimed, self.dead = self.dead, []
+        else:
+            reclaimed = self.dead[-budget:]
+            del self.dead[-budget:]
+        self.free.extend(reclaimed)
+
+        # drop free slots at the end of the array
+        if self.slots[-1] is None:
+            while self.slots and self.slots[-1] is None:
+                self.slots.pop()
+            end = len(self.slots)
+            self.free = [rid for rid in self.free if rid < end]
+            self.dead = [rid for rid in self.dead if rid < end]
+        return len(reclaimed)
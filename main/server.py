@@ -0,0 +1,258 @@
+"""Standalone database server: one process owns the database and serves
+every client (web workers, scripts) over a Unix or TCP socket.
+
+    python -m main.server [address]
+
+address is unix:/path/db.sock, /path/db.sock or host:port; by default
+$MINIRDBMS_SERVER, else unix:db.sock next to db.json. Clients use
+main.client (ConnectionPool); the protocol is described in
+main/protocol.py.
+"""
+import itertools
+import os
+import socket
+import socketserver
+import sys
+
+from main.core import PAGE_SIZE, db, iter_join
+from main.metrics import metrics
+from main.protocol import DEFAULT_ADDRESS, SERVER_ENV, encode, parse_address, read_frame
+from main.rows import encode_row
+from main.sql import execute, execute_many
+
+
+# -------------------------------
+# Calls
+# -------------------------------
+# Besides SQL, clients can run these by name ({"call": ..., "args": {...}});
+# they cover what the web app does that SQL cannot express, such as
+# keyset pages of a join. Rows are returned as plain dicts.
+
+def _search(rows, text, columns):
+    # substring search of a join no view holds (tables and views have
+    # Table.search)
+    text = text.lower()
+    return (
+        row for row in rows
+        if any(text in str(row[col]).lower() for col in columns or row.keys())
+    )
+
+
+def page(table, after=None, limit=PAGE_SIZE, key=None, search=None, columns=None):
+    """Up to limit rows ordered by key (the primary key) after the cursor,
+    optionally only rows where search occurs in one of columns."""
+    table = db.table(table)
+    key = key or table.primary_key
+    if search:
+        # through the columns' trigram indexes: only the matches are
+        # read, then put in key order
+        get = table.getter(key)
+        rows = sorted(table.search(search, columns), key=get)
+        if after is not None:
+            rows = [row for row in rows if get(row) > after]
+    else:
+        rows = table.range(key, lo=after, lo_inclusive=False)
+    return [row.to_dict() for row in itertools.islice(rows, limit)]
+
+
+def join_page(left, right, left_key, right_key, how="inner", after=None,
+              limit=PAGE_SIZE, search=None, columns=None):
+    """Up to limit rows of iter_join after the (left pk, right pk) cursor.
+
+    Read from a materialized view of the join when there is one."""
+    after = tuple(after) if after else None
+    view = db.join_view(left, right, left_key, right_key, how)
+    if view is not None:
+        rows = (row.to_dict() for row in view.joined(after, search, columns))
+    else:
+        rows = iter_join(
+            db.table(left), db.table(right), left_key, right_key, how=how, after=after
+        )
+        if search:
+            rows = _search(rows, search, columns)
+    return list(itertools.islice(rows, limit))
+
+
+def find(table, col, value):
+    row = db.table(table).find(col, value)
+    return None if row is None else row.to_dict()
+
+
+def all_rows(table):
+    return [row.to_dict() for row in db.table(table).all()]
+
+
+def insert(table, row):
+    db.table(table).insert(row)
+    return "Inserted"
+
+
+def update(table, col, value, updates):
+    db.table(table).update(col, value, updates)
+    return "Updated"
+
+
+def delete(table, col, value):
+    db.table(table).delete(col, value)
+    return "Deleted"
+
+
+def engine_metrics(reset=False):
+    """The engine counters and recent slow queries (main/metrics.py);
+    reset starts them over after reading."""
+    result = metrics.snapshot(db)
+    if reset:
+        metrics.reset()
+    return result
+
+
+CALLS = {
+    "page": page,
+    "join_page": join_page,
+    "find": find,
+    "all": all_rows,
+    "insert": insert,
+    "update": update,
+    "delete": delete,
+    "metrics": engine_metrics,
+}
+
+
+# -------------------------------
+# Requests
+# -------------------------------
+def respond(message):
+    """Response to one request, or the list of responses to a batch.
+
+    A batch stops at its first failure; if the batch itself opened a
+    transaction that is still open then, it is rolled back, so a batch
+    of BEGIN ... COMMIT is all or nothing.
+    """
+    if not isinstance(message, list):
+        return _respond(message)
+
+    had_transaction = db.in_transaction()
+    responses = []
+    for request in message:
+        if responses and not responses[-1]["ok"]:
+            responses.append({
+                "id": request.get("id"), "ok": False,
+                "error": "Skipped: an earlier request in the batch failed",
+            })
+            continue
+        responses.append(_respond(request))
+    if responses and not responses[-1]["ok"] and not had_transaction:
+        while db.in_transaction():
+            db.rollback()
+    return responses
+
+
+def _respond(request):
+    response = {"id": request.get("id")}
+    try:
+        if "sql" in request and "many" in request:
+            result = execute_many(request["sql"], request["many"])
+        elif "sql" in request:
+            result = execute(request["sql"], request.get("params") or ())
+        elif "call" in request:
+            call = CALLS.get(request["call"])
+            if call is None:
+                raise Exception(f"Unknown call {request['call']}")
+            result = call(**request.get("args", {}))
+        else:
+            raise Exception("Request has neither sql nor call")
+        response["ok"] = True
+        response["result"] = result
+    except Exception as e:
+        response["ok"] = False
+        response["error"] = str(e)
+    if db.in_transaction():
+        response["txn"] = True
+    return response
+
+
+# -------------------------------
+# Server
+# -------------------------------
+class Handler(socketserver.StreamRequestHandler):
+    """One client connection, served by its own thread.
+
+    Frames are answered in order as they arrive, so a client may send
+    many before reading any answer (pipelining). Transactions belong
+    to the connection's thread; one left open when the client goes
+    away is rolled back.
+    """
+
+    def setup(self):
+        super().setup()
+        if self.server.address_family == socket.AF_INET:
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        try:
+            while True:
+                message = read_frame(self.rfile)
+                if message is None:
+                    break
+                self.wfile.write(encode(respond(message), default=encode_row))
+        except ConnectionError:
+            pass
+        except Exception as e:
+            # malformed frame: drop the client
+            print("Closing connection:", e, file=sys.stderr)
+        finally:
+            while db.in_transaction():
+                db.rollback()
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_server(address=None):
+    address = address or os.environ.get(SERVER_ENV) or DEFAULT_ADDRESS
+    family, addr = parse_address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(addr):
+            # a socket file left by a server that is gone, or a live one
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(addr)
+            except OSError:
+                os.unlink(addr)
+            else:
+                raise Exception(f"A server is already listening on {addr}")
+            finally:
+                probe.close()
+        return UnixServer(addr, Handler)
+    return TCPServer(addr, Handler)
+
+
+def main(argv):
+    address = argv[0] if argv else None
+    try:
+        server = make_server(address)
+    except Exception as e:
+        print("Error:", e)
+        return 1
+    print(f"MiniRDBMS server on {server.server_address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if server.address_family == socket.AF_UNIX:
+            os.unlink(server.server_address)
+        # fold the log into the snapshot on the way out
+        db.checkpoint()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
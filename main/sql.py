@@ -1,163 +1,405 @@
+import time
+from functools import lru_cache
+
 from main.core import db, inner_join, left_join
+from main.explain import instrument, render, report
+from main.load import copy_from
+from main.metrics import counters, metrics
+from main.parser import (
+    Aggregate, Copy, CreateIndex, CreateTable, CreateView, Delete, Explain, Insert,
+    Select, TransactionControl, Update, parse,
+)
+from main.planner import (
+    aggregate_rows, bind, bind_value, grouping, plan_aggregate, plan_join,
+    plan_select, plan_where,
+)
+
+# Parsed statements kept by query text
+STATEMENT_CACHE_SIZE = 256
+
+
+def execute(query: str, params=()):
+    """Run one SQL statement; ? placeholders are filled from params.
+
+    Its time goes into the engine metrics, and the slow query log when
+    it is over the threshold (main/metrics.py)."""
+    start = time.perf_counter()
+    result = prepare(query).execute(params)
+    rows = len(result) if isinstance(result, list) else None
+    metrics.query(query, params, time.perf_counter() - start, rows)
+    return result
+
+
+def execute_many(query: str, params_seq):
+    """Run one statement once per tuple of params_seq, in one
+    transaction; returns how many times it ran. An INSERT's rows go in
+    through Table.insert_many (batched checks and log records)."""
+    start = time.perf_counter()
+    count = prepare(query).execute_many(params_seq)
+    metrics.query(query, (), time.perf_counter() - start, count)
+    return count
+
+
+def explain(query: str, params=(), analyze=False):
+    """The plan of a SELECT, INSERT, COPY, UPDATE or DELETE as data (see
+    main/explain.py); with analyze the statement is run, and what each
+    plan node did is added."""
+    stmt = prepare(query)
+    if isinstance(stmt.node, Explain):
+        raise Exception("Give explain() the statement without EXPLAIN")
+    traced = _Traced(stmt.query, stmt.node, stmt.param_count, analyze)
+    return _explained(traced, stmt._check(params))
+
+
+def stream(query: str, params=()):
+    """Run a SELECT and yield its rows one at a time instead of a list."""
+    return prepare(query).stream(params)
+
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def prepare(query: str):
+    """Parse query once; the Statement can be executed many times."""
+    node, param_count = parse(query)
+    return Statement(query, node, param_count)
 
 
-def execute(query: str):
-    query = query.strip().rstrip(";")
-    tokens = query.split()
-    cmd = tokens[0].upper()
+# -------------------------
+# PREPARED STATEMENTS
+# -------------------------
 
-    if cmd == "CREATE":
-        return _create_table(query)
+class Statement:
+    def __init__(self, query, node, param_count):
+        self.query = query
+        self.node = node
+        self.param_count = param_count
+
+        # Plan of a statement without parameters, reused while the table
+        # keeps the same indexes and roughly the same size
+        self._plan = None
+        self._plan_key = None
+
+    def execute(self, params=()):
+        params = self._check(params)
+        result = _EXECUTORS[type(self.node)](self, params)
+        if isinstance(self.node, Select):
+            return list(result)
+        return result
+
+    def execute_many(self, params_seq):
+        if isinstance(self.node, Insert):
+            table = db.table(self.node.table)
+            rows = (row for params in params_seq for row in _rows(self, self._check(params)))
+            return table.insert_many(rows)
+        if not isinstance(self.node, (Update, Delete)):
+            raise Exception("execute_many runs INSERT, UPDATE or DELETE statements")
+        count = 0
+        with db.transaction():
+            for params in params_seq:
+                self.execute(params)
+                count += 1
+        return count
+
+    def stream(self, params=()):
+        if not isinstance(self.node, Select):
+            raise Exception("Only SELECT statements can be streamed")
+        return _select(self, self._check(params))
+
+    def _check(self, params):
+        params = tuple(params)
+        if len(params) != self.param_count:
+            raise Exception(
+                f"Statement takes {self.param_count} parameters, got {len(params)}"
+            )
+        return params
+
+    def plan(self, table, params, build):
+        if self.param_count:
+            return build()
+        key = (id(table), table.schema_version, len(table.rows).bit_length())
+        if self._plan is None or self._plan_key != key:
+            self._plan = build()
+            self._plan_key = key
+        return self._plan
 
-    if cmd == "INSERT":
-        return _insert(query)
 
-    if cmd == "SELECT":
-        return _select(query)
+# -------------------------
+# EXPLAIN
+# -------------------------
+
+class _Traced(Statement):
+    """A statement under EXPLAIN: its plans are built anew rather than
+    taken from the cache (instrumenting changes them) and kept in plans."""
+
+    def __init__(self, query, node, param_count, analyze):
+        super().__init__(query, node, param_count)
+        self.analyze = analyze
+        self.plans = []
+
+    def plan(self, table, params, build):
+        plan = build()
+        if self.analyze:
+            instrument(plan)
+        self.plans.append(plan)
+        return plan
+
+
+def _explain(stmt, params):
+    # EXPLAIN [ANALYZE] SELECT ... / INSERT / COPY / UPDATE / DELETE
+    node = stmt.node
+    traced = _Traced(stmt.query, node.statement, stmt.param_count, node.analyze)
+    return render(_explained(traced, params))
+
+
+def _explained(stmt, params):
+    node = stmt.node
+    heading = None
+    if isinstance(node, (Update, Delete)):
+        heading = f"{type(node).__name__} on {node.table}"
+    elif isinstance(node, Insert):
+        heading = f"Insert on {node.table}, {len(node.rows)} rows"
+    elif isinstance(node, Copy):
+        heading = f"Copy into {node.table} from {bind_value(node.path, params)}"
+
+    join = []
+    if isinstance(node, Select) and node.join:
+        # inner_join / left_join plan the join the same way
+        how = "inner" if node.join.kind == "INNER" else "left"
+        join = [plan_join(db.table(node.table), db.table(node.join.table),
+                          node.join.left_key, node.join.right_key, how)]
+
+    if not stmt.analyze:
+        if isinstance(node, Select) and not node.join:
+            # plans the query; the rows are never asked for
+            _select(stmt, params)
+        elif isinstance(node, (Update, Delete)):
+            table = db.table(node.table)
+            stmt.plan(table, params, lambda: plan_where(table, bind(node.where, params)))
+        return report(join + stmt.plans, heading)
+
+    before = dict(counters)
+    start = time.perf_counter()
+    result = stmt.execute(params)
+    seconds = time.perf_counter() - start
+    changed = {name: round(value - before[name], 3) for name, value in counters.items()
+               if value != before[name]}
+    if isinstance(node, Select):
+        rows = len(result)
+    else:
+        rows = sum(changed.get(name, 0)
+                   for name in ("rows_inserted", "rows_updated", "rows_deleted"))
+    return report(join + stmt.plans, heading, seconds, rows, changed)
 
-    if cmd == "UPDATE":
-        return _update(query)
 
-    if cmd == "DELETE":
-        return _delete(query)
+# -------------------------
+# TRANSACTIONS
+# -------------------------
 
-    raise Exception("Unsupported SQL")
+def _transaction(stmt, params):
+    action = stmt.node.action
+    if action == "BEGIN":
+        if db.in_transaction():
+            raise Exception("Transaction already in progress")
+        db.begin()
+        return "Transaction started"
+    if action == "COMMIT":
+        db.commit()
+        return "Committed"
+    db.rollback()
+    return "Rolled back"
 
 
 # -------------------------
 # CREATE TABLE
 # -------------------------
 
-def _create_table(query):
+def _create_table(stmt, params):
     # CREATE TABLE users (id INT PRIMARY KEY, name TEXT)
-    name = query.split()[2]
-    cols_part = query[query.index("(") + 1: query.index(")")]
-
+    # CREATE TABLE orders (id INT PRIMARY KEY,
+    #     user_id INT REFERENCES users(id) ON DELETE CASCADE, amount INT)
+    node = stmt.node
     columns = []
     types = {}
     pk = None
     unique = []
+    foreign_keys = {}
+
+    for col in node.columns:
+        columns.append(col.name)
+        types[col.name] = col.type
 
-    for col in cols_part.split(","):
-        parts = col.strip().split()
-        col_name = parts[0]
-        col_type = parts[1]
+        if "PRIMARY" in col.constraints:
+            pk = col.name
+        if "UNIQUE" in col.constraints:
+            unique.append(col.name)
+        if col.references:
+            foreign_keys[col.name] = col.references
 
-        columns.append(col_name)
-        types[col_name] = col_type
+    for col, ref in foreign_keys.items():
+        column = ref.column
+        if column is None:
+            # REFERENCES t with no column: t's primary key
+            if ref.table == node.name:
+                column = pk
+            elif ref.table in db.tables:
+                column = db.table(ref.table).primary_key
+        foreign_keys[col] = {"table": ref.table, "column": column, "on_delete": ref.on_delete}
 
-        if "PRIMARY" in parts:
-            pk = col_name
-        if "UNIQUE" in parts:
-            unique.append(col_name)
+    db.create_table(node.name, columns, types, pk, unique, foreign_keys)
+    return f"Table '{node.name}' created"
 
-    db.create_table(name, columns, types, pk, unique)
-    return f"Table '{name}' created"
+
+# -------------------------
+# CREATE INDEX
+# -------------------------
+
+def _create_index(stmt, params):
+    # CREATE INDEX idx_orders_user ON orders(user_id)
+    # CREATE INDEX ON orders(user_id)
+    # CREATE INDEX idx_orders_amount ON orders(amount) USING SORTED
+    node = stmt.node
+    table = db.table(node.table)
+    table.create_index(node.column, node.name, node.using)
+    return f"Index on {node.table}({node.column}) created"
+
+
+# -------------------------
+# CREATE MATERIALIZED VIEW
+# -------------------------
+
+def _create_view(stmt, params):
+    # CREATE MATERIALIZED VIEW user_orders AS
+    #     SELECT * FROM users JOIN orders ON users.id = orders.user_id
+    # CREATE MATERIALIZED VIEW totals AS
+    #     SELECT user_id, SUM(amount) AS total FROM orders GROUP BY user_id
+    node = stmt.node
+    db.create_view(node.name, node.query)
+    return f"Materialized view '{node.name}' created"
 
 
 # -------------------------
 # INSERT
 # -------------------------
 
-def _insert(query):
+def _insert(stmt, params):
     # INSERT INTO users VALUES 1 Alice
-    parts = query.split()
-    table = db.table(parts[2])
-    values = [_parse(v) for v in parts[4:]]
-    row = dict(zip(table.columns, values))
-    table.insert(row)
-    return "Inserted"
+    # INSERT INTO users (id, name) VALUES (?, ?)
+    # INSERT INTO users (id, name) VALUES (1, 'Ann'), (2, 'Bob')
+    table = db.table(stmt.node.table)
+    rows = _rows(stmt, params)
+    if len(rows) == 1:
+        table.insert(rows[0])
+        return "Inserted"
+    table.insert_many(rows)
+    return f"Inserted {len(rows)} rows"
+
+
+def _rows(stmt, params):
+    # the rows an INSERT adds, as dicts
+    node = stmt.node
+    columns = node.columns or db.table(node.table).columns
+    rows = []
+    for values in node.rows:
+        if len(values) > len(columns):
+            raise Exception(f"Too many values for {node.table}")
+        rows.append(dict(zip(columns, [bind_value(v, params) for v in values])))
+    return rows
 
 
 # -------------------------
-# SELECT + JOIN
+# COPY
 # -------------------------
 
-def _select(query):
-    tokens = query.split()
+def _copy(stmt, params):
+    # COPY orders FROM 'orders.csv' HEADER
+    # COPY orders (id, user_id, amount) FROM 'orders.jsonl'
+    node = stmt.node
+    table = db.table(node.table)
+    count = copy_from(
+        table, bind_value(node.path, params), node.columns, node.format, node.header
+    )
+    return f"Copied {count} rows"
 
-    # -------------------------------
-    # SELECT * FROM table
-    # -------------------------------
-    if (
-        len(tokens) == 4
-        and tokens[0] == "SELECT"
-        and tokens[1] == "*"
-        and tokens[2] == "FROM"
-    ):
-        table = db.table(tokens[3])
-        return table.all()
 
-    # -------------------------------
-    # SELECT * FROM table WHERE col=value
-    # -------------------------------
-    if "WHERE" in tokens and "JOIN" not in tokens:
-        table = db.table(tokens[3])
-        where_index = tokens.index("WHERE")
-        col, val = tokens[where_index + 1].split("=")
+# -------------------------
+# SELECT + JOIN
+# -------------------------
 
-        val = _parse(val)
-        return [row for row in table.rows if row[col] == val]
+def _select(stmt, params):
+    node = stmt.node
+
+    if not node.grouped and (node.having or isinstance(node.order_by, Aggregate)):
+        raise Exception("HAVING and ORDER BY an aggregate need GROUP BY or aggregates")
 
     # -------------------------------
-    # SELECT * FROM A LEFT JOIN B ON A.x = B.y
+    # SELECT * FROM A [LEFT] JOIN B ON A.x = B.y
     # -------------------------------
-    if "LEFT" in tokens and "JOIN" in tokens:
-        left = tokens[3]
-        right = tokens[6]
-        left_key = tokens[8].split(".")[1]
-        right_key = tokens[10].split(".")[1]
-
-        return left_join(
-            db.table(left),
-            db.table(right),
-            left_key,
-            right_key
+    if node.join:
+        if node.where or (not node.grouped and (
+                node.order_by or node.limit is not None or node.offset)):
+            raise Exception("WHERE / ORDER BY / LIMIT are not supported on JOIN")
+        join = inner_join if node.join.kind == "INNER" else left_join
+        rows = join(
+            db.table(node.table),
+            db.table(node.join.table),
+            node.join.left_key,
+            node.join.right_key
         )
+        if node.grouped:
+            return aggregate_rows(rows, **grouping(node, params)).rows()
+        if node.columns is None:
+            return iter(rows)
+        return ({col: row[col] for col in node.columns} for row in rows)
 
     # -------------------------------
-    # SELECT * FROM A JOIN B ON A.x = B.y
+    # SELECT cols FROM table [WHERE pred] [GROUP BY cols [HAVING pred]]
+    #     [ORDER BY col [ASC|DESC]] [LIMIT n] [OFFSET m]
     # -------------------------------
-    if "JOIN" in tokens:
-        left = tokens[3]
-        right = tokens[5]
-        left_key = tokens[7].split(".")[1]
-        right_key = tokens[9].split(".")[1]
-
-        return inner_join(
-            db.table(left),
-            db.table(right),
-            left_key,
-            right_key
-        )
-
-    raise Exception("Unsupported SELECT query")
-
-
+    table = db.table(node.table)
+    if node.grouped:
+        spec = grouping(node, params, table)
+        plan = stmt.plan(table, params, lambda: plan_aggregate(
+            table, bind(node.where, params), **spec
+        ))
+        return _in_snapshot(plan.rows())
+
+    plan = stmt.plan(table, params, lambda: plan_select(
+        table,
+        bind(node.where, params),
+        order_by=node.order_by,
+        desc=node.desc,
+        limit=node.limit,
+        offset=node.offset,
+        columns=node.columns,
+    ))
+    return _in_snapshot(plan.rows())
+
+
+def _in_snapshot(rows):
+    # every access path of the plan reads the same snapshot
+    with db.snapshot():
+        yield from rows
 
 
 # -------------------------
 # UPDATE
 # -------------------------
 
-def _update(query):
+def _update(stmt, params):
     # UPDATE users SET name=Bob WHERE id=1
-    tokens = query.split()
+    # UPDATE orders SET amount=0, user_id=2 WHERE user_id=1 AND amount<10
+    node = stmt.node
+    table = db.table(node.table)
 
-    table_name = tokens[1]
-    table = db.table(table_name)
+    updates = {col: bind_value(v, params) for col, v in node.assignments.items()}
 
-    set_index = tokens.index("SET")
-    where_index = tokens.index("WHERE")
-
-    set_col, set_val = tokens[set_index + 1].split("=")
-    where_col, where_val = tokens[where_index + 1].split("=")
-
-    table.update(
-        where_col,
-        _parse(where_val),
-        {set_col: _parse(set_val)}
-    )
+    # the WHERE is evaluated under the writer lock, on the latest
+    # versions, so rows it finds cannot be changed under it
+    plan = stmt.plan(table, params, lambda: plan_where(table, bind(node.where, params)))
+    with db.transaction():
+        rows = list(plan.rows())
+        if not rows:
+            raise Exception("Row not found")
+        table.update_rows(rows, updates)
 
     return "Updated"
 
@@ -167,23 +409,30 @@ def _update(query):
 # DELETE
 # -------------------------
 
-def _delete(query):
+def _delete(stmt, params):
     # DELETE FROM orders WHERE id=1
-    tokens = query.split()
-
-    table_name = tokens[tokens.index("FROM") + 1]
-    table = db.table(table_name)
+    node = stmt.node
+    table = db.table(node.table)
 
-    where_index = tokens.index("WHERE")
-    where_col, where_val = tokens[where_index + 1].split("=")
-
-    table.delete(where_col, _parse(where_val))
+    plan = stmt.plan(table, params, lambda: plan_where(table, bind(node.where, params)))
+    with db.transaction():
+        rows = list(plan.rows())
+        if not rows:
+            raise Exception("Row not found")
+        table.delete_rows(rows)
 
     return "Deleted"
 
 
-
-def _parse(value):
-    if value.isdigit():
-        return int(value)
-    return value
+_EXECUTORS = {
+    TransactionControl: _transaction,
+    CreateTable: _create_table,
+    CreateIndex: _create_index,
+    CreateView: _create_view,
+    Insert: _insert,
+    Copy: _copy,
+    Select: _select,
+    Update: _update,
+    Delete: _delete,
+    Explain: _explain,
+}
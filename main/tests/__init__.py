@@ -0,0 +1,24 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from main.core import Database
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """Each test opens its databases in a directory of its own, never on
+    the project's db.json."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+
+    def path(self, name="db.json"):
+        return os.path.join(self.dir, name)
+
+    def open(self, name="db.json", **kwargs):
+        kwargs.setdefault("sync", False)
+        database = Database(self.path(name), **kwargs)
+        self.addCleanup(database.close)
+        return database
@@ -0,0 +1,74 @@
+import threading
+
+from main.tests import DatabaseTestCase
+
+
+def _in_snapshot(database, read):
+    """Start read() in a snapshot on another thread; the returned
+    finish(change) applies change and returns what read() saw before
+    and after it, in the same snapshot."""
+    started, changed = threading.Event(), threading.Event()
+    results = []
+
+    def reader():
+        with database.snapshot():
+            results.append(read())
+            started.set()
+            changed.wait()
+            results.append(read())
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    started.wait()
+
+    def finish(change):
+        try:
+            change()
+        finally:
+            changed.set()
+            thread.join()
+        return results
+
+    return finish
+
+
+class CompactionTest(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db = self.open()
+        self.db.create_table("t", ["id"], {"id": "INT"}, pk="id")
+        self.table = self.db.table("t")
+        self.table.insert_many({"id": i} for i in range(300))
+
+    def test_snapshot_sees_row_deleted_after_it_started(self):
+        finish = _in_snapshot(self.db, lambda: self.table.find("id", 7))
+        before, after = finish(lambda: self.table.delete("id", 7))
+        self.assertEqual(before, {"id": 7})
+        self.assertEqual(after, {"id": 7})
+        self.assertIsNone(self.table.find("id", 7))
+
+    def test_compacting_keeps_last_row_a_snapshot_reads(self):
+        # leave tombstones behind for the next commit to compact
+        with self.db.transaction():
+            for i in range(299):
+                self.table.delete("id", i)
+        self.assertTrue(self.table.rows.dead)
+
+        # deleting the last row empties the table, but not for the snapshot
+        finish = _in_snapshot(self.db, lambda: self.table.find("id", 299))
+        before, after = finish(lambda: self.table.delete("id", 299))
+        self.assertEqual(before, {"id": 299})
+        self.assertEqual(after, {"id": 299})
+
+        # once the snapshot is gone the delete is reclaimed
+        self.assertIsNone(self.table.find("id", 299))
+        self.assertEqual(self.table.rows.deleted, 0)
+        self.assertEqual(self.table.rows.live, 0)
+
+    def test_slots_are_reused_after_compaction(self):
+        for i in range(100):
+            self.table.delete("id", i)
+        size = len(self.table.rows.slots)
+        self.table.insert_many({"id": 1000 + i} for i in range(100))
+        self.assertEqual(len(self.table.rows.slots), size)
+        self.assertEqual(len(self.table.all()), 300)
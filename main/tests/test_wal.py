@@ -0,0 +1,64 @@
+import multiprocessing
+
+from main.core import Database
+from main.tests import DatabaseTestCase
+
+
+def _insert_users(path, first, count):
+    # run in a child process: its own Database on the shared file
+    database = Database(path, sync=False, checkpoint_every=25)
+    users = database.table("users")
+    for i in range(first, first + count):
+        users.insert({"id": i, "name": f"user {i}"})
+    database.close()
+
+
+class SharedLogTest(DatabaseTestCase):
+    def test_write_after_another_process_checkpointed_is_kept(self):
+        a = self.open()
+        b = self.open()
+        a.table("users").insert({"id": 1, "name": "Ann"})
+        a.table("users").insert({"id": 2, "name": "Bob"})
+        a.checkpoint()
+
+        # b has not seen the checkpoint: its record must still be
+        # numbered after the snapshot's lsn
+        b.table("users").insert({"id": 100, "name": "Cy"})
+
+        b.reload()
+        self.assertEqual(b.table("users").find("id", 100), {"id": 100, "name": "Cy"})
+        self.assertEqual(len(b.table("users").all()), 3)
+        fresh = self.open()
+        self.assertEqual(len(fresh.table("users").all()), 3)
+
+    def test_processes_writing_and_checkpointing_lose_nothing(self):
+        self.open()  # create the file before the writers start
+        path = self.path()
+        context = multiprocessing.get_context("spawn")
+        workers = [
+            context.Process(target=_insert_users, args=(path, first, 100))
+            for first in (0, 1000, 2000)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+            self.assertEqual(worker.exitcode, 0)
+
+        users = self.open().table("users")
+        self.assertEqual(len(users.all()), 300)
+
+
+class TornRecordTest(DatabaseTestCase):
+    def test_append_after_torn_record_is_replayed(self):
+        database = self.open(checkpoint_every=0)
+        database.table("users").insert({"id": 1, "name": "Ann"})
+        # a writer crashed halfway through its record
+        with open(database.log_file, "a") as f:
+            f.write('{"op":"insert","table":"users","row":{"id":2,')
+
+        other = self.open(checkpoint_every=0)
+        other.table("users").insert({"id": 3, "name": "Cy"})
+
+        users = self.open().table("users")
+        self.assertEqual([row["id"] for row in users.all()], [1, 3])
@@ -0,0 +1,215 @@
+"""Optional NumPy column cache for INT columns.
+
+With NumPy installed, the planner evaluates WHERE predicates and
+aggregates on INT columns of large tables as whole-array operations:
+a predicate becomes a boolean mask over a column array, the mask picks
+the row ids, and only those rows are read. Without NumPy, or while a
+table has uncommitted changes, the same plans run row at a time.
+
+A table's cache holds the rows of one committed state: it is rebuilt,
+a column at a time as queries need them, after the table's next commit
+(rows.stable moves) and is only used by reads that see that state.
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from main.rows import PENDING
+
+# Tables smaller than this are read row at a time: building the arrays
+# would cost more than it saves
+VECTOR_MIN_ROWS = 1024
+
+# int64 range: INT values (and sums) outside it stay in Python
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+# Integers up to this size are exact in a float64
+FLOAT_EXACT = 2 ** 53
+
+
+def available(table):
+    return numpy is not None and len(table.rows) >= VECTOR_MIN_ROWS
+
+
+def is_number(value):
+    # a value an int64 array can be compared with exactly
+    return isinstance(value, int) and INT64_MIN <= value <= INT64_MAX
+
+
+# -------------------------------
+# Column cache
+# -------------------------------
+class Column:
+    """One INT column: values (int64, 0 where NULL), nulls (a bool
+    array, None when the column has no NULL) and the largest absolute
+    value, to tell whether a sum fits in int64."""
+
+    def __init__(self, values, nulls, bound):
+        self.values = values
+        self.nulls = nulls
+        self.bound = bound
+
+    def present(self):
+        # mask of non-NULL values, or None for all of them
+        return None if self.nulls is None else ~self.nulls
+
+
+class ColumnCache:
+    """Arrays of a table's rows as of one commit (stable), in slot
+    order; rids[i] is the row id of element i of every column."""
+
+    def __init__(self, table, stable):
+        self.table = table
+        self.rows = table.rows
+        self.stable = stable
+        self.rids = None
+        self.columns = {}
+
+    def row_ids(self, ts):
+        if self.rids is None:
+            rows = self.rows.scan(ts)
+            self.rids = numpy.fromiter((row._rid for row in rows), numpy.int64)
+        return self.rids
+
+    def column(self, col, ts):
+        """Column col, or None when its values are not all int64."""
+        if col not in self.columns:
+            self.columns[col] = self._build(col, ts)
+        return self.columns[col]
+
+    def _build(self, col, ts):
+        get = self.table.getter(col)
+        rows = list(self.rows.scan(ts))
+        if self.rids is None:
+            self.rids = numpy.fromiter((row._rid for row in rows), numpy.int64, len(rows))
+        elif len(rows) != len(self.rids):
+            return None
+        values = [get(row) for row in rows]
+        nulls = None
+        if None in values:
+            nulls = numpy.fromiter((v is None for v in values), bool, len(values))
+            values = [0 if v is None else v for v in values]
+        # values outside int64 (or not ints at all, in a view) give
+        # another dtype
+        array = numpy.array(values, dtype=None if values else numpy.int64)
+        if array.dtype.kind not in "bi":
+            return None
+        array = array.astype(numpy.int64)
+        bound = max(int(array.max()), -int(array.min())) if len(array) else 0
+        return Column(array, nulls, bound)
+
+
+def cache_for(table, ts):
+    """The table's ColumnCache for a read at ts, or None when that read
+    cannot use one (no NumPy, a small table, uncommitted changes, or a
+    snapshot older than the table's last commit)."""
+    if not available(table):
+        return None
+    rows = table.rows
+    stable = rows.stable
+    if stable == PENDING or ts < stable:
+        return None
+    cache = table.vectors
+    if cache is None or cache.rows is not rows or cache.stable != stable:
+        cache = table.vectors = ColumnCache(table, stable)
+    return cache
+
+
+# -------------------------------
+# Aggregates
+# -------------------------------
+def aggregate(cache, ts, mask, group_col, aggregates):
+    """Result rows of aggregates (as HashAggregate yields them) over the
+    cached rows selected by mask (None: all), grouped by group_col or
+    not grouped; None if a column cannot be used (the caller falls back
+    to rows)."""
+    if mask is None:
+        picked = numpy.arange(len(cache.row_ids(ts)))
+    else:
+        picked = numpy.flatnonzero(mask)
+
+    columns = {}
+    for _, _, col in aggregates:
+        if col is not None and col not in columns:
+            column = cache.column(col, ts)
+            if column is None or column.bound * len(picked) > INT64_MAX:
+                return None
+            columns[col] = column
+
+    if group_col is None:
+        groups, gid, keys = 1, numpy.zeros(len(picked), numpy.int64), [()]
+    else:
+        key = cache.column(group_col, ts)
+        if key is None:
+            return None
+        groups, gid, keys = _groups(key, picked)
+
+    results = [dict(zip((group_col,) if group_col else (), k)) for k in keys]
+    for name, func, col in aggregates:
+        if col is None:
+            values = numpy.bincount(gid, minlength=groups).tolist()
+        else:
+            values = _aggregate_column(func, columns[col], picked, gid, groups)
+        for row, value in zip(results, values):
+            row[name] = value
+    return results
+
+
+def _groups(key, picked):
+    # (number of groups, group of each picked row, group keys), groups
+    # numbered in order of first appearance like a dict of groups
+    values = key.values[picked]
+    nulls = None if key.nulls is None else key.nulls[picked]
+    if nulls is None or not nulls.any():
+        unique, first, gid = numpy.unique(values, return_index=True, return_inverse=True)
+        keys = unique.tolist()
+    else:
+        present = numpy.flatnonzero(~nulls)
+        unique, first, inverse = numpy.unique(
+            values[present], return_index=True, return_inverse=True
+        )
+        gid = numpy.full(len(picked), len(unique), numpy.int64)
+        gid[present] = inverse
+        first = numpy.append(present[first], numpy.flatnonzero(nulls)[0])
+        keys = unique.tolist() + [None]
+    # renumber by first appearance
+    order = numpy.argsort(first, kind="stable")
+    rank = numpy.empty(len(order), numpy.int64)
+    rank[order] = numpy.arange(len(order))
+    return len(keys), rank[gid.reshape(-1)], [(keys[i],) for i in order]
+
+
+def _aggregate_column(func, column, picked, gid, groups):
+    present = column.present()
+    if present is not None:
+        keep = present[picked]
+        picked, gid = picked[keep], gid[keep]
+    counts = numpy.bincount(gid, minlength=groups)
+    if func == "COUNT":
+        return counts.tolist()
+
+    values = column.values[picked]
+    if func in ("SUM", "AVG") and column.bound * len(values) <= FLOAT_EXACT:
+        # every partial sum is exact in a float64
+        totals = numpy.bincount(gid, values, groups).astype(numpy.int64)
+    elif func in ("SUM", "AVG"):
+        totals = numpy.zeros(groups, numpy.int64)
+        numpy.add.at(totals, gid, values)
+    elif func == "MIN":
+        totals = numpy.full(groups, INT64_MAX, numpy.int64)
+        numpy.minimum.at(totals, gid, values)
+    else:
+        totals = numpy.full(groups, INT64_MIN, numpy.int64)
+        numpy.maximum.at(totals, gid, values)
+
+    result = []
+    for total, count in zip(totals.tolist(), counts.tolist()):
+        if not count:
+            result.append(None)
+        elif func == "AVG":
+            result.append(total / count)
+        else:
+            result.append(total)
+    return result
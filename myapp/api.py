@@ -1,17 +1,62 @@
+import csv
+import itertools
+import json
+from urllib.parse import urlencode
+
+from django.http import (
+    HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse,
+)
+from django.views.decorators.http import require_GET
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
-from main.core import db, inner_join
+from main.client import PAGE_SIZE, connect
+
+# Largest page a client can ask for with ?limit=
+MAX_PAGE_SIZE = 1000
+
+# Rows fetched from the database at a time by the export endpoints
+EXPORT_CHUNK = 1000
+
+database = connect()
+
+
+# -------- Keyset pagination --------
+# GET endpoints return one page (?after=<key>&limit=<n>) as a JSON list;
+# the URL of the next page is sent in a Link: <...>; rel="next" header.
+
+def _limit(request):
+    return min(int(request.query_params.get("limit", PAGE_SIZE)), MAX_PAGE_SIZE)
+
+
+def _paged_response(request, rows, key):
+    # rows: up to _limit(request) + 1 rows, the extra one only to tell
+    # whether there is a next page
+    limit = _limit(request)
+    page = list(itertools.islice(rows, limit + 1))
 
-users = db.table("users")
-orders = db.table("orders")
+    headers = {}
+    if len(page) > limit:
+        page = page[:limit]
+        query = urlencode({"after": key(page[-1]), "limit": limit})
+        headers["Link"] = f'<{request.path}?{query}>; rel="next"'
+
+    return Response(page, headers=headers)
+
+
+def _after_id(request):
+    after = request.query_params.get("after")
+    return int(after) if after else None
 
 
 @api_view(["GET", "POST"])
 def users_api(request):
     if request.method == "GET":
-        return Response(users.all())
+        rows = database.call(
+            "page", table="users", after=_after_id(request), limit=_limit(request) + 1
+        )
+        return _paged_response(request, rows, lambda row: row["id"])
 
-    users.insert({
+    database.call("insert", table="users", row={
         "id": int(request.data["id"]),
         "name": request.data["name"]
     })
@@ -21,19 +66,25 @@ def users_api(request):
 @api_view(["PUT", "DELETE"])
 def user_detail_api(request, user_id):
     if request.method == "PUT":
-        users.update("id", user_id, {"name": request.data["name"]})
+        database.call(
+            "update", table="users", col="id", value=user_id,
+            updates={"name": request.data["name"]}
+        )
         return Response({"status": "updated"})
 
-    users.delete("id", user_id)
+    database.call("delete", table="users", col="id", value=user_id)
     return Response({"status": "deleted"})
 
 
 @api_view(["GET", "POST"])
 def orders_api(request):
     if request.method == "GET":
-        return Response(orders.all())
+        rows = database.call(
+            "page", table="orders", after=_after_id(request), limit=_limit(request) + 1
+        )
+        return _paged_response(request, rows, lambda row: row["id"])
 
-    orders.insert({
+    database.call("insert", table="orders", row={
         "id": int(request.data["id"]),
         "user_id": int(request.data["user_id"]),
         "product": request.data["product"]
@@ -43,4 +94,120 @@ def orders_api(request):
 
 @api_view(["GET"])
 def user_orders_api(request):
-    return Response(inner_join(users, orders, "id", "user_id"))
+    # cursor is "<user id>:<order id>" of the last row of the previous page
+    after = request.query_params.get("after")
+    if after:
+        user_id, _, order_id = after.partition(":")
+        after = (int(user_id), int(order_id))
+    rows = database.call(
+        "join_page", left="users", right="orders", left_key="id", right_key="user_id",
+        after=after, limit=_limit(request) + 1
+    )
+    return _paged_response(request, rows, lambda r: f"{r['user_id']}:{r['order_id']}")
+
+
+# -------- Streaming export --------
+# GET /api/export/<users|orders|user-orders>/?format=jsonl|csv returns
+# every row without building the whole result: rows are fetched as
+# keyset pages of EXPORT_CHUNK rows and written out as each page
+# arrives, so memory holds one page and the first bytes go out as soon
+# as the first page is read. The response has no length, so it is sent
+# with chunked encoding. Each page is read separately, so a dump taken
+# while rows change is not one snapshot, but it never repeats or skips
+# a row that stays.
+
+def _pages(call, key, **args):
+    # the rows of a keyset-paged call, one page at a time
+    after = None
+    while True:
+        rows = database.call(call, after=after, limit=EXPORT_CHUNK, **args)
+        yield rows
+        if len(rows) < EXPORT_CHUNK:
+            return
+        after = key(rows[-1])
+
+
+class _Echo:
+    # file-like object for csv.writer: writerow() returns the line
+    def write(self, value):
+        return value
+
+
+def _jsonl(pages):
+    for rows in pages:
+        yield "".join(json.dumps(row) + "\n" for row in rows)
+
+
+def _csv(pages):
+    # a header line of the columns, then one line per row; NULL is an
+    # empty field, as COPY reads it
+    writer = csv.writer(_Echo())
+    columns = None
+    for rows in pages:
+        if rows and columns is None:
+            columns = list(rows[0])
+            yield writer.writerow(columns)
+        yield "".join(writer.writerow([row[col] for col in columns]) for row in rows)
+
+
+EXPORT_FORMATS = {
+    "jsonl": (_jsonl, "application/x-ndjson"),
+    "csv": (_csv, "text/csv"),
+}
+
+
+def _export(request, name, pages):
+    file_format = request.GET.get("format", "jsonl")
+    if file_format not in EXPORT_FORMATS:
+        return HttpResponseBadRequest("format must be jsonl or csv")
+    encode, content_type = EXPORT_FORMATS[file_format]
+    response = StreamingHttpResponse(encode(pages), content_type=content_type)
+    response["Content-Disposition"] = f'attachment; filename="{name}.{file_format}"'
+    return response
+
+
+@require_GET
+def users_export(request):
+    return _export(request, "users", _pages("page", lambda row: row["id"], table="users"))
+
+
+@require_GET
+def orders_export(request):
+    return _export(request, "orders", _pages("page", lambda row: row["id"], table="orders"))
+
+
+@require_GET
+def user_orders_export(request):
+    pages = _pages(
+        "join_page", lambda row: [row["user_id"], row["order_id"]],
+        left="users", right="orders", left_key="id", right_key="user_id",
+    )
+    return _export(request, "user_orders", pages)
+
+
+# -------- Metrics --------
+# GET /api/metrics/ returns the engine counters and recent slow queries
+# (main/metrics.py) as JSON, or with ?format=prometheus in the
+# Prometheus text format for a scraper. They are the database server's
+# when there is one, else this worker's own.
+
+def _prometheus(snapshot):
+    lines = []
+    for name, value in snapshot["counters"].items():
+        lines.append(f"# TYPE minirdbms_{name}_total counter")
+        lines.append(f"minirdbms_{name}_total {value}")
+    for name, value in snapshot.get("buffer_pool", {}).items():
+        lines.append(f"# TYPE minirdbms_buffer_pool_{name} gauge")
+        lines.append(f"minirdbms_buffer_pool_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+@require_GET
+def metrics_api(request):
+    snapshot = database.call("metrics")
+    file_format = request.GET.get("format", "json")
+    if file_format == "prometheus":
+        return HttpResponse(_prometheus(snapshot), content_type="text/plain; version=0.0.4")
+    if file_format != "json":
+        return HttpResponseBadRequest("format must be json or prometheus")
+    return JsonResponse(snapshot)
@@ -6,4 +6,8 @@ urlpatterns = [
     path("users/<int:user_id>/", user_detail_api),
     path("orders/", orders_api),
     path("user-orders/", user_orders_api),
+    path("export/users/", users_export),
+    path("export/orders/", orders_export),
+    path("export/user-orders/", user_orders_export),
+    path("metrics/", metrics_api),
 ]
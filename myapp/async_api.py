@@ -0,0 +1,215 @@
+import csv
+import functools
+import itertools
+import json
+from urllib.parse import urlencode
+
+from django.http import (
+    HttpResponse, HttpResponseBadRequest, JsonResponse, QueryDict, StreamingHttpResponse,
+)
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_http_methods
+from main.aio import connect
+from main.client import PAGE_SIZE
+
+from .api import EXPORT_CHUNK, MAX_PAGE_SIZE, _Echo, _prometheus
+
+# -------- Database access --------
+# Async versions of api.py, served under ASGI (see RDBMS/urls.py). DRF's
+# @api_view cannot wrap a coroutine, so these are plain Django async
+# views answering the same URLs with the same JSON, status codes and
+# Link headers. Like DRF's views they are exempt from CSRF, and take a
+# JSON or form body.
+
+database = connect()
+
+
+def _data(request):
+    # the request body, as DRF's request.data reads it
+    if request.content_type == "application/json":
+        return json.loads(request.body or b"{}")
+    if request.method == "POST":
+        return request.POST
+    return QueryDict(request.body)
+
+
+def _bad_body(view):
+    # a body that is not valid JSON is a 400, not a 500
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        try:
+            return await view(request, *args, **kwargs)
+        except json.JSONDecodeError as e:
+            return JsonResponse({"detail": f"JSON parse error - {e}"}, status=400)
+    return wrapper
+
+
+# -------- Keyset pagination --------
+# As in api.py: one page (?after=<key>&limit=<n>) as a JSON list, and the
+# next page's URL in a Link: <...>; rel="next" header.
+
+def _limit(request):
+    return min(int(request.GET.get("limit", PAGE_SIZE)), MAX_PAGE_SIZE)
+
+
+def _paged_response(request, rows, key):
+    limit = _limit(request)
+    page = list(itertools.islice(rows, limit + 1))
+
+    headers = {}
+    if len(page) > limit:
+        page = page[:limit]
+        query = urlencode({"after": key(page[-1]), "limit": limit})
+        headers["Link"] = f'<{request.path}?{query}>; rel="next"'
+
+    return JsonResponse(page, safe=False, headers=headers)
+
+
+def _after_id(request):
+    after = request.GET.get("after")
+    return int(after) if after else None
+
+
+@csrf_exempt
+@require_http_methods(["GET", "POST"])
+@_bad_body
+async def users_api(request):
+    if request.method == "GET":
+        rows = await database.call(
+            "page", table="users", after=_after_id(request), limit=_limit(request) + 1
+        )
+        return _paged_response(request, rows, lambda row: row["id"])
+
+    data = _data(request)
+    await database.call("insert", table="users", row={
+        "id": int(data["id"]),
+        "name": data["name"]
+    })
+    return JsonResponse({"status": "created"}, status=201)
+
+
+@csrf_exempt
+@require_http_methods(["PUT", "DELETE"])
+@_bad_body
+async def user_detail_api(request, user_id):
+    if request.method == "PUT":
+        data = _data(request)
+        await database.call(
+            "update", table="users", col="id", value=user_id,
+            updates={"name": data["name"]}
+        )
+        return JsonResponse({"status": "updated"})
+
+    await database.call("delete", table="users", col="id", value=user_id)
+    return JsonResponse({"status": "deleted"})
+
+
+@csrf_exempt
+@require_http_methods(["GET", "POST"])
+@_bad_body
+async def orders_api(request):
+    if request.method == "GET":
+        rows = await database.call(
+            "page", table="orders", after=_after_id(request), limit=_limit(request) + 1
+        )
+        return _paged_response(request, rows, lambda row: row["id"])
+
+    data = _data(request)
+    await database.call("insert", table="orders", row={
+        "id": int(data["id"]),
+        "user_id": int(data["user_id"]),
+        "product": data["product"]
+    })
+    return JsonResponse({"status": "created"}, status=201)
+
+
+@require_GET
+async def user_orders_api(request):
+    # cursor is "<user id>:<order id>" of the last row of the previous page
+    after = request.GET.get("after")
+    if after:
+        user_id, _, order_id = after.partition(":")
+        after = (int(user_id), int(order_id))
+    rows = await database.call(
+        "join_page", left="users", right="orders", left_key="id", right_key="user_id",
+        after=after, limit=_limit(request) + 1
+    )
+    return _paged_response(request, rows, lambda r: f"{r['user_id']}:{r['order_id']}")
+
+
+# -------- Streaming export --------
+# As in api.py, but the pages are fetched with await, so a long export
+# holds no worker thread between pages: StreamingHttpResponse iterates
+# the async generators below on the event loop.
+
+async def _pages(call, key, **args):
+    after = None
+    while True:
+        rows = await database.call(call, after=after, limit=EXPORT_CHUNK, **args)
+        yield rows
+        if len(rows) < EXPORT_CHUNK:
+            return
+        after = key(rows[-1])
+
+
+async def _jsonl(pages):
+    async for rows in pages:
+        yield "".join(json.dumps(row) + "\n" for row in rows)
+
+
+async def _csv(pages):
+    writer = csv.writer(_Echo())
+    columns = None
+    async for rows in pages:
+        if rows and columns is None:
+            columns = list(rows[0])
+            yield writer.writerow(columns)
+        yield "".join(writer.writerow([row[col] for col in columns]) for row in rows)
+
+
+EXPORT_FORMATS = {
+    "jsonl": (_jsonl, "application/x-ndjson"),
+    "csv": (_csv, "text/csv"),
+}
+
+
+def _export(request, name, pages):
+    file_format = request.GET.get("format", "jsonl")
+    if file_format not in EXPORT_FORMATS:
+        return HttpResponseBadRequest("format must be jsonl or csv")
+    encode, content_type = EXPORT_FORMATS[file_format]
+    response = StreamingHttpResponse(encode(pages), content_type=content_type)
+    response["Content-Disposition"] = f'attachment; filename="{name}.{file_format}"'
+    return response
+
+
+@require_GET
+async def users_export(request):
+    return _export(request, "users", _pages("page", lambda row: row["id"], table="users"))
+
+
+@require_GET
+async def orders_export(request):
+    return _export(request, "orders", _pages("page", lambda row: row["id"], table="orders"))
+
+
+@require_GET
+async def user_orders_export(request):
+    pages = _pages(
+        "join_page", lambda row: [row["user_id"], row["order_id"]],
+        left="users", right="orders", left_key="id", right_key="user_id",
+    )
+    return _export(request, "user_orders", pages)
+
+
+# -------- Metrics --------
+
+@require_GET
+async def metrics_api(request):
+    snapshot = await database.call("metrics")
+    file_format = request.GET.get("format", "json")
+    if file_format == "prometheus":
+        return HttpResponse(_prometheus(snapshot), content_type="text/plain; version=0.0.4")
+    if file_format != "json":
+        return HttpResponseBadRequest("format must be json or prometheus")
+    return JsonResponse(snapshot)
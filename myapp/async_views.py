@@ -0,0 +1,124 @@
+from django.shortcuts import render, redirect
+from main.aio import connect
+from main.client import PAGE_SIZE
+
+from .views import _after_id, _join_cursor, _join_key, _page
+
+
+# -------- Database access --------
+# Async versions of views.py, served under ASGI (see RDBMS/urls.py).
+# Database calls run on main.aio's threads, so a request waiting on the
+# database holds no worker thread and the event loop serves others.
+
+database = connect()
+
+
+# -------- Views --------
+
+async def list_users(request):
+    query = request.GET.get("q", "")
+    # search by ID or name
+    results = await database.call(
+        "page", table="users", after=_after_id(request), limit=PAGE_SIZE + 1,
+        search=query, columns=["id", "name"]
+    )
+
+    results, next_after = _page(results, lambda row: row["id"])
+
+    return render(
+        request,
+        "users.html",
+        {"users": results, "query": query, "next_after": next_after}
+    )
+
+
+async def create_user(request):
+    if request.method == "POST":
+        await database.call("insert", table="users", row={
+            "id": int(request.POST["id"]),
+            "name": request.POST["name"]
+        })
+        return redirect("/")
+    return render(request, "create_user.html")
+
+
+async def update_user(request, user_id):
+    if request.method == "POST":
+        await database.call(
+            "update", table="users", col="id", value=int(user_id),
+            updates={"name": request.POST["name"]}
+        )
+        return redirect("/")
+
+    user = await database.call("find", table="users", col="id", value=int(user_id))
+    return render(request, "update_user.html", {"user": user})
+
+
+async def delete_user(request, user_id):
+    await database.call("delete", table="users", col="id", value=int(user_id))
+    return redirect("/")
+
+
+async def user_orders(request):
+    q = request.GET.get("q", "").lower()
+    rows = await database.call(
+        "join_page", left="users", right="orders", left_key="id", right_key="user_id",
+        after=_join_cursor(request), limit=PAGE_SIZE + 1,
+        search=q, columns=["user_id", "user_name", "order_id", "order_amount"]
+    )
+
+    rows, next_after = _page(rows, _join_key)
+
+    return render(
+        request,
+        "user_orders.html",
+        {"rows": rows, "query": q, "next_after": next_after}
+    )
+
+
+async def list_orders(request):
+    query = request.GET.get("q", "")
+    # search by ID, user_id, or amount
+    results = await database.call(
+        "page", table="orders", after=_after_id(request), limit=PAGE_SIZE + 1,
+        search=query, columns=["id", "user_id", "amount"]
+    )
+
+    results, next_after = _page(results, lambda row: row["id"])
+
+    return render(
+        request,
+        "orders.html",
+        {"orders": results, "query": query, "next_after": next_after}
+    )
+
+
+async def create_order(request):
+    users = await database.call("all", table="users")  # get all users
+
+    if request.method == "POST":
+        await database.call("insert", table="orders", row={
+            "id": int(request.POST["id"]),
+            "user_id": int(request.POST["user_id"]),
+            "amount": int(request.POST["amount"]),
+        })
+        return redirect("/orders/")
+
+    return render(request, "create_order.html", {"users": users})
+
+
+async def user_orders_left(request):
+    q = request.GET.get("q", "").lower()
+    rows = await database.call(
+        "join_page", left="users", right="orders", left_key="id", right_key="user_id", how="left",
+        after=_join_cursor(request), limit=PAGE_SIZE + 1,
+        search=q, columns=["user_id", "user_name", "order_id", "order_amount"]
+    )
+
+    rows, next_after = _page(rows, _join_key)
+
+    return render(
+        request,
+        "user_orders_left.html",
+        {"rows": rows, "query": q, "next_after": next_after}
+    )
@@ -1,45 +1,69 @@
+import itertools
+
 from django.shortcuts import render, redirect
-from main.core import db, inner_join, left_join
+from main.client import PAGE_SIZE, connect
+
+
+# -------- Database access --------
+# The database server when MINIRDBMS_SERVER is set (one engine for all
+# workers), otherwise this process's own copy (see main/client.py).
+
+database = connect()
+
+
+# -------- Keyset pagination --------
+# Pages are addressed by the key of the last row shown (?after=...), so a
+# page costs the same wherever it is in the table.
+
+def _page(rows, key):
+    """Take one page from a row stream; returns (page, cursor of next page)."""
+    rows = list(itertools.islice(rows, PAGE_SIZE + 1))
+    if len(rows) > PAGE_SIZE:
+        return rows[:PAGE_SIZE], key(rows[PAGE_SIZE - 1])
+    return rows, None
+
 
+def _after_id(request):
+    after = request.GET.get("after")
+    return int(after) if after else None
 
-# -------- Lazy table access (FIX) --------
 
-def users_table():
-    db.reload()
-    return db.table("users")
+def _join_cursor(request):
+    # "<user id>:<order id>", order id empty for a user with no orders
+    after = request.GET.get("after")
+    if not after:
+        return None
+    user_id, _, order_id = after.partition(":")
+    return int(user_id), int(order_id) if order_id else None
 
 
-def orders_table():
-    db.reload()
-    return db.table("orders")
+def _join_key(row):
+    order_id = row["order_id"]
+    return f"{row['user_id']}:{'' if order_id is None else order_id}"
 
 
 # -------- Views --------
 
 def list_users(request):
-    db.reload()
-    table = users_table()
     query = request.GET.get("q", "")
-    results = table.all()
+    # search by ID or name
+    results = database.call(
+        "page", table="users", after=_after_id(request), limit=PAGE_SIZE + 1,
+        search=query, columns=["id", "name"]
+    )
 
-    if query:
-        # search by ID or name
-        results = [
-            row for row in table.rows
-            if query.lower() in str(row["id"]).lower() or query.lower() in row["name"].lower()
-        ]
+    results, next_after = _page(results, lambda row: row["id"])
 
     return render(
         request,
         "users.html",
-        {"users": results, "query": query}
+        {"users": results, "query": query, "next_after": next_after}
     )
 
 
 def create_user(request):
-    db.reload()
     if request.method == "POST":
-        users_table().insert({
+        database.call("insert", table="users", row={
             "id": int(request.POST["id"]),
             "name": request.POST["name"]
         })
@@ -48,80 +72,61 @@ def create_user(request):
 
 
 def update_user(request, user_id):
-    db.reload()
     if request.method == "POST":
-        users_table().update(
-            "id",
-            int(user_id),
-            {"name": request.POST["name"]}
+        database.call(
+            "update", table="users", col="id", value=int(user_id),
+            updates={"name": request.POST["name"]}
         )
         return redirect("/")
 
-    user = users_table().find("id", int(user_id))
+    user = database.call("find", table="users", col="id", value=int(user_id))
     return render(request, "update_user.html", {"user": user})
 
 
 def delete_user(request, user_id):
-    db.reload()
-    users_table().delete("id", int(user_id))
+    database.call("delete", table="users", col="id", value=int(user_id))
     return redirect("/")
 
 
 def user_orders(request):
-    db.reload()
-    rows = inner_join(
-        users_table(),
-        orders_table(),
-        "id",
-        "user_id"
-    )
-
     q = request.GET.get("q", "").lower()
+    rows = database.call(
+        "join_page", left="users", right="orders", left_key="id", right_key="user_id",
+        after=_join_cursor(request), limit=PAGE_SIZE + 1,
+        search=q, columns=["user_id", "user_name", "order_id", "order_amount"]
+    )
 
-    if q:
-        rows = [
-            r for r in rows
-            if q in str(r["user_id"]).lower()
-            or q in r["user_name"].lower()
-            or q in str(r["order_id"]).lower()
-            or q in str(r["order_amount"]).lower()
-        ]
+    rows, next_after = _page(rows, _join_key)
 
     return render(
         request,
         "user_orders.html",
-        {"rows": rows, "query": q}
+        {"rows": rows, "query": q, "next_after": next_after}
     )
 
 
 def list_orders(request):
-    db.reload()
-    table = orders_table()
     query = request.GET.get("q", "")
-    results = table.all()
+    # search by ID, user_id, or amount
+    results = database.call(
+        "page", table="orders", after=_after_id(request), limit=PAGE_SIZE + 1,
+        search=query, columns=["id", "user_id", "amount"]
+    )
 
-    if query:
-        # search by ID, user_id, or amount
-        results = [
-            row for row in table.rows
-            if query.lower() in str(row["id"]).lower()
-            or query.lower() in str(row["user_id"]).lower()
-            or query.lower() in str(row["amount"]).lower()
-        ]
+    results, next_after = _page(results, lambda row: row["id"])
 
     return render(
         request,
         "orders.html",
-        {"orders": results, "query": query}
+        {"orders": results, "query": query, "next_after": next_after}
     )
 
 
 def create_order(request):
-    db.reload()
-    users = users_table().all()  # get all users
+    users = database.call("all", table="users")  # get all users
 
     if request.method == "POST":
-        orders_table().insert({
+        database.call("insert", table="orders", row={
             "id": int(request.POST["id"]),
             "user_id": int(request.POST["user_id"]),
             "amount": int(request.POST["amount"]),
@@ -132,27 +137,17 @@ def create_order(request):
 
 
 def user_orders_left(request):
-    db.reload()
-    rows = left_join(
-        users_table(),
-        orders_table(),
-        "id",
-        "user_id"
-    )
-
     q = request.GET.get("q", "").lower()
+    rows = database.call(
+        "join_page", left="users", right="orders", left_key="id", right_key="user_id", how="left",
+        after=_join_cursor(request), limit=PAGE_SIZE + 1,
+        search=q, columns=["user_id", "user_name", "order_id", "order_amount"]
+    )
 
-    if q:
-        rows = [
-            r for r in rows
-            if q in str(r["user_id"]).lower()
-            or q in r["user_name"].lower()
-            or q in str(r["order_id"]).lower()
-            or q in str(r["order_amount"]).lower()
-        ]
+    rows, next_after = _page(rows, _join_key)
 
     return render(
         request,
         "user_orders_left.html",
-        {"rows": rows, "query": q}
+        {"rows": rows, "query": q, "next_after": next_after}
     )